@@ -2,15 +2,20 @@
 import argparse
 import os
 import subprocess
-import numpy
+import time
 import json
-from glob import glob
 import joblib
+from joblib import Parallel, delayed, cpu_count
+import nibabel
 import numpy as np
-from nibabel import save
-from voxelwiseencoding.process_bids import run_model_for_subject, create_output_filename_from_args
-from nilearn.masking import unmask
-from nilearn.image import concat_imgs
+from threadpoolctl import threadpool_limits
+from voxelwiseencoding.process_bids import (BIDSIndex, run_model_for_subject, run_model_for_subjects,
+                                            process_bids_subject, compute_subject_mask, compute_group_mask,
+                                            create_output_filename_from_args, config_hash,
+                                            estimate_subject_memory, plan_workers, save_voxel_maps)
+from voxelwiseencoding.encoding import RunwiseRidgeCV
+from voxelwiseencoding.preprocessing import mask_voxels
+from voxelwiseencoding.cache import ArrayCache
 
 __version__ = open(os.path.join(os.path.dirname(os.path.realpath(__file__)),
                                 'version')).read()
@@ -29,6 +34,84 @@ def run(command, env={}):
     if process.returncode != 0:
         raise Exception("Non zero return code: {}".format(process.returncode))
 
+# arguments that only change how the outputs are computed, but not the outputs themselves
+RUNTIME_ARGS = ['bids_dir', 'output_dir', 'participant_label', 'skip_bids_validator', 'log', 'cache_dir',
+                'cache_max_size', 'load_jobs', 'stim_sidecar', 'sparse_stimulus', 'mask_jobs', 'subject_jobs',
+                'memory_budget', 'no_resume', 'fold_checkpoints', 'compress_level', 'write_jobs']
+
+def outputs_complete(output_prefix, subject_hash, model_store=False, extension='.nii.gz'):
+    '''Returns whether all outputs of a subject exist and were computed with the configuration hashed to subject_hash'''
+    ridges = output_prefix + ('models' if model_store else 'ridges.pkl')
+    if not all(os.path.exists(fl) for fl in [ridges, output_prefix + 'scores' + extension, output_prefix + 'scores.json']):
+        return False
+    with open(output_prefix + 'scores.json', 'r') as fl:
+        return json.load(fl).get('ConfigHash') == subject_hash
+
+def subject_config_hash(subject_label, mask, *configs, **kwargs):
+    '''Returns the hash of configs, the mask, and the BOLD and stimulus files of a subject, which identifies its outputs
+
+    Files are identified by their path, size, and modification time, so changed inputs are fit again when resuming'''
+    bold_files, _, stim_tsv, stim_json = process_bids_subject(subject_label, **kwargs)
+    inputs = ArrayCache.key(list(bold_files) + list(stim_tsv) + list(stim_json), hash_files=False)
+    return config_hash(__version__, *configs, mask, os.stat(mask).st_mtime_ns if mask else None, inputs)
+
+def output_mask(mask, subject_label, **kwargs):
+    '''Returns mask, or a mask of all voxels of the first BOLD file of the subject if the data was not masked'''
+    if mask is not None:
+        return mask
+    bold = nibabel.load(process_bids_subject(subject_label, **kwargs)[0][0])
+    return nibabel.Nifti1Image(np.ones(bold.shape[:3], dtype=np.uint8), bold.affine)
+
+def save_outputs(results, mask, output_prefix, subject_hash, model_store=False, log_config=None,
+                 extension='.nii.gz', write_kwargs=None):
+    '''Saves the models, scores, (alphas,) and log of a subject, followed by the sidecar that marks them as complete
+
+    Volumes are written as .nii or .nii.gz files depending on extension, with write_kwargs passed to save_voxel_maps'''
+    if write_kwargs is None:
+        write_kwargs = {}
+    ridges, scores = results[:2]
+    if not model_store:
+        joblib.dump(ridges, output_prefix + 'ridges.pkl')
+
+    # all folds are written into one volume, and the voxels of the mask are computed once for scores and alphas
+    mask_img = nibabel.load(mask) if isinstance(mask, str) else mask
+    voxels = mask_voxels(mask_img)
+    save_voxel_maps(scores, mask_img, output_prefix + 'scores' + extension, voxels=voxels, **write_kwargs)
+    if len(results) > 2:
+        save_voxel_maps(results[2], mask_img, output_prefix + 'alphas' + extension, voxels=voxels, **write_kwargs)
+    if log_config is not None:
+        log_config['bold_preprocessing'] = dict(log_config['bold_preprocessing'],
+                                                mask=mask if isinstance(mask, str) else None)
+        with open(output_prefix + 'log_config.json', 'w+') as fl:
+            json.dump(log_config, fl)
+    # written last and atomically, so that interrupted subjects are fit again when resuming
+    with open(output_prefix + 'scores.json.tmp', 'w') as fl:
+        json.dump({'ConfigHash': subject_hash, 'Version': __version__}, fl)
+    os.replace(output_prefix + 'scores.json.tmp', output_prefix + 'scores.json')
+
+def fit_subject(subject_label, mask, output_prefix, subject_hash, n_threads, encoding_kwargs,
+                model_store=False, model_store_dtype='float64', fold_checkpoints=False, log_config=None,
+                extension='.nii.gz', write_kwargs=None, **kwargs):
+    '''Fits and saves the models of one subject with n_threads BLAS threads, returns the subject label and the time it took'''
+    start = time.time()
+    encoding_kwargs = dict(encoding_kwargs)
+    if fold_checkpoints:
+        # finished folds are loaded from here if the subject is interrupted and fit again
+        encoding_kwargs['checkpoint_dir'] = output_prefix + 'checkpoints'
+    if model_store:
+        # folds are written to the store while training instead of being kept in memory
+        encoding_kwargs['model_store'] = output_prefix + 'models'
+        encoding_kwargs['model_store_dtype'] = model_store_dtype
+    with threadpool_limits(limits=n_threads):
+        *results, mask = run_model_for_subject(subject_label, mask=mask, encoding_kwargs=encoding_kwargs, **kwargs)
+    save_outputs(results, output_mask(mask, subject_label, **kwargs), output_prefix, subject_hash,
+                 model_store=model_store, log_config=log_config, extension=extension, write_kwargs=write_kwargs)
+    duration = time.time() - start
+    # printed by the worker, so that progress is shown while other subjects are still being fit,
+    # with the newline in the same write so that lines of parallel workers are not interleaved
+    print('sub-{} finished in {:.1f}s.\n'.format(subject_label, duration), end='', flush=True)
+    return subject_label, duration
+
 if __name__=='__main__':
     __version__ = open(os.path.join(os.path.dirname(os.path.realpath(__file__)),
                                 'version')).read()
@@ -39,7 +122,8 @@ if __name__=='__main__':
                         'should be stored. If you want to mask the data please include '
                         'folder called masks that contains either subject-specific NifTI '
                         'masks named sub-<participant_label>_mask.nii.gz or a group-level '
-                        'mask named group_mask.nii.gz.')
+                        'mask named group_mask.nii.gz. Otherwise EPI masks are computed and stored in this folder '
+                        'together with a JSON file of their provenance, so that they are reused in later runs.')
     parser.add_argument('--participant_label', help='The label(s) of the participant(s) that should be analyzed. The label '
                     'corresponds to sub-<participant_label> from the BIDS spec '
                     '(so it does not include "sub-"). If this parameter is not '
@@ -74,8 +158,69 @@ if __name__=='__main__':
     parser.add_argument('--no-masking', help='Flag to disable masking. This will lead to many non-brain voxels being included.',
                         default=False, action='store_true')
     parser.add_argument('--log', help='Save preprocessing and model configuration together with model output.', default=False, action='store_true')
+    parser.add_argument('--model-store', help='Save the models of all folds as a directory of memory-mappable arrays '
+                        '(coefficients, intercepts, alphas, and voxel mask) instead of a pickle of the estimators. '
+                        'Requires an estimator with coef_ and intercept_ attributes.',
+                        default=False, action='store_true')
+    parser.add_argument('--float32-models', help='Store model coefficients in single precision when using --model-store.',
+                        default=False, action='store_true')
+    parser.add_argument('--group-fit', help='Fit all subjects together, which requires that they were presented with the same stimulus. '
+                        'The lagged stimulus is then decomposed only once per fold for all subjects instead of once per subject. '
+                        'Cannot be combined with --model-store.',
+                        default=False, action='store_true')
+    parser.add_argument('--cache-dir', help='Directory in which lagged stimuli and preprocessed BOLD data are cached, '
+                        'so that they are not loaded and preprocessed again when subjects are rerun with the same '
+                        'files and preprocessing parameters, e.g. for different encoding configurations. '
+                        'Default is no caching.')
+    parser.add_argument('--cache-max-size', help='Maximum size of the cache in GB, least recently used entries are removed '
+                        'when the cache grows larger. Default is no limit.', type=float)
+    parser.add_argument('--load-jobs', help='Number of runs of a subject whose BOLD data and stimuli are loaded '
+                        'at the same time. Higher values speed up loading but need memory for that many runs. '
+                        'Default is 1.', type=int, default=1)
+    parser.add_argument('--stim-sidecar', help='Save each stimulus tsv(.gz) file as a binary .npy file in '
+                        'stimulus_sidecars in the output directory, which is memory-mapped instead of parsing the '
+                        'tsv file in later runs as long as it is newer than the tsv file.',
+                        default=False, action='store_true')
+    parser.add_argument('--group-mask', help='Compute a group mask from the EPI masks of all subjects and use it for all subjects, '
+                        'unless masks/group_mask.nii.gz is provided. The subject masks are computed in parallel.',
+                        default=False, action='store_true')
+    parser.add_argument('--mask-jobs', help='Number of subject masks that are computed in parallel for --group-mask. Default is 1.',
+                        type=int, default=1)
+    parser.add_argument('--sparse-stimulus', help='Keep the (lagged) stimulus in a sparse matrix, which saves memory and '
+                        'time for event or one-hot annotations that are mostly zeros.',
+                        default=False, action='store_true')
+    parser.add_argument('--subject-jobs', help='Maximum number of subjects that are fit in parallel processes, -1 uses one per CPU. '
+                        'The CPUs are divided between the subjects as BLAS threads. Default is 1, which fits one subject '
+                        'at a time with all CPUs.', type=int, default=1)
+    parser.add_argument('--memory-budget', help='Memory in GB that the subjects that are fit in parallel may use together. '
+                        'Fewer subjects than --subject-jobs are fit in parallel if their BOLD data would not fit. '
+                        'Default is no limit.', type=float)
+    parser.add_argument('--save-alphas', help='Additionally save the regularization parameter chosen for each voxel and fold '
+                        'as a volume like the scores. Requires an estimator with an alpha_ attribute.',
+                        default=False, action='store_true')
+    parser.add_argument('--uncompressed-output', help='Save the scores (and alphas) as uncompressed .nii instead of .nii.gz files, '
+                        'which is much faster to write and read for high-resolution data.',
+                        default=False, action='store_true')
+    parser.add_argument('--compress-level', help='gzip compression level of .nii.gz outputs from 1 (fastest) to 9 (smallest). '
+                        'Default is 1.', type=int, default=1, choices=range(1, 10))
+    parser.add_argument('--write-jobs', help='Number of threads that compress .nii.gz outputs in parallel. Default is 1.',
+                        type=int, default=1)
+    parser.add_argument('--fold-checkpoints', help='Save the model and scores of each cross-validation fold as soon as it is '
+                        'trained, so that a subject that is interrupted and fit again only trains the remaining folds. '
+                        'Not used with --group-fit.', default=False, action='store_true')
+    parser.add_argument('--runwise-ridge', help='Use RunwiseRidgeCV as encoding model, which selects the alphas of each '
+                        'fold by leave-one-run-out cross-validation on its training runs, computed from statistics of '
+                        'each run instead of refitting. alphas, fit_intercept, and alpha_per_target are read from the '
+                        'encoding config.', default=False, action='store_true')
+    parser.add_argument('--no-resume', help='Fit all subjects again. By default, subjects whose outputs already exist '
+                        'and were computed with the same configuration are skipped, so that an interrupted analysis '
+                        'continues where it stopped.', default=False, action='store_true')
 
     args = parser.parse_args()
+    if args.group_fit and args.model_store:
+        parser.error('--group-fit cannot be combined with --model-store.')
+    if args.group_fit and args.runwise_ridge:
+        parser.error('--group-fit cannot be combined with --runwise-ridge.')
 
     if not args.skip_bids_validator:
         run('bids-validator %s'%args.bids_dir)
@@ -89,49 +234,105 @@ if __name__=='__main__':
     if args.encoding_config:
         with open(args.encoding_config, 'r') as fl:
             encoding_kwargs = json.load(fl)
+    if args.save_alphas:
+        encoding_kwargs['return_alphas'] = True
+    estimator = None
+    if args.runwise_ridge:
+        # the parameters of the default estimator in the encoding config are used for RunwiseRidgeCV
+        runwise_params = RunwiseRidgeCV().get_params()
+        estimator = RunwiseRidgeCV(**{key: value for key, value in encoding_kwargs.items() if key in runwise_params})
 
     identifier = ''
     if args.identifier:
         identifier = '_' + str(args.identifier)
 
+    # one pass over the dataset for all subjects, which is reused until the dataset changes
+    bids_index = BIDSIndex(args.bids_dir, subjects=args.participant_label,
+                           cache_file=os.path.join(args.output_dir, 'bids_index.json'))
     subjects_to_analyze = []
     # only for a subset of subjects
     if args.participant_label:
         subjects_to_analyze = args.participant_label
     # for all subjects
     else:
-        subject_dirs = glob(os.path.join(args.bids_dir, "sub-*"))
-        subjects_to_analyze = [subject_dir.split("-")[-1] for subject_dir in subject_dirs]
-    for subject_label in subjects_to_analyze:
-        mask = None
-        if not args.no_masking:
-            masks_path = os.path.join(args.output_dir, 'masks')
-            if os.path.exists(masks_path):
-                if os.path.exists(os.path.join(masks_path, 'sub-{}_mask.nii.gz'.format(subject_label))):
-                    mask = os.path.join(masks_path, 'sub-{}_mask.nii.gz'.format(subject_label))
-                elif os.path.exists(os.path.join(masks_path, 'group_mask.nii.gz')):
-                    mask = os.path.join(masks_path, 'group_mask.nii.gz')
-            else:
-                mask = 'epi'
-        bold_prep_kwargs = {'standardize': args.standardize, 'detrend': args.detrend}
-        ridges, scores, mask = run_model_for_subject(subject_label, mask=mask,
-                                               bold_prep_kwargs=bold_prep_kwargs,
-                                               encoding_kwargs=encoding_kwargs, **vars(args))
-
-        filename_output = create_output_filename_from_args(subject_label, **vars(args))
-        joblib.dump(ridges, os.path.join(args.output_dir, '{0}_{1}ridges.pkl'.format(filename_output, identifier)))
-
-        if mask:
-            scores_bold = concat_imgs([unmask(scores_fold, mask) for scores_fold in scores.T])
-
-        save(scores_bold, os.path.join(args.output_dir, '{0}_{1}scores.nii.gz'.format(filename_output, identifier)))
-        if args.log:
-            # check if we computed an epi mask
-            if mask=='epi':
-                bold_prep_kwargs['mask'] = 'epi mask'
+        subjects_to_analyze = bids_index.subjects
+    # computed masks are stored in masks_path with their provenance and reused as long as the BOLD files do not change
+    masks_path = os.path.join(args.output_dir, 'masks')
+    group_mask_file = os.path.join(masks_path, 'group_mask.nii.gz')
+    if args.no_masking:
+        masks = [None] * len(subjects_to_analyze)
+    elif args.group_mask:
+        bold_files = {subject_label: process_bids_subject(subject_label, bids_index=bids_index, **vars(args))[0][0]
+                      for subject_label in subjects_to_analyze}
+        masks = [compute_group_mask(bold_files, group_mask_file, n_jobs=args.mask_jobs)] * len(subjects_to_analyze)
+    else:
+        masks = []
+        for subject_label in subjects_to_analyze:
+            subject_mask_file = os.path.join(masks_path, 'sub-{}_mask.nii.gz'.format(subject_label))
+            if not os.path.exists(subject_mask_file) and os.path.exists(group_mask_file):
+                masks.append(group_mask_file)
             else:
-                bold_prep_kwargs['mask'] = mask
-            with open(os.path.join(args.output_dir, '{0}_{1}log_config.json'.format(filename_output, identifier)), 'w+') as fl:
-                json.dump({'bold_preprocessing': bold_prep_kwargs,
-                           'stimulus_preprocessing': preprocess_kwargs,
-                           'encoding': encoding_kwargs}, fl)
+                bold_file = process_bids_subject(subject_label, bids_index=bids_index, **vars(args))[0][0]
+                masks.append(compute_subject_mask(bold_file, subject_mask_file))
+    bold_prep_kwargs = {'standardize': args.standardize, 'detrend': args.detrend}
+    stim_read_kwargs = {'sidecar_dir': os.path.join(args.output_dir, 'stimulus_sidecars') if args.stim_sidecar else None,
+                        'sparse': args.sparse_stimulus}
+    cache = None
+    if args.cache_dir:
+        cache = ArrayCache(args.cache_dir,
+                           max_size=int(args.cache_max_size * 1e9) if args.cache_max_size else None)
+    extension = '.nii' if args.uncompressed_output else '.nii.gz'
+    write_kwargs = {'compresslevel': args.compress_level, 'n_jobs': args.write_jobs}
+    log_config = None
+    if args.log:
+        log_config = {'bold_preprocessing': bold_prep_kwargs,
+                      'stimulus_preprocessing': preprocess_kwargs,
+                      'encoding': encoding_kwargs}
+
+    # subjects whose outputs were computed with the same configuration are skipped
+    output_config = {key: value for key, value in vars(args).items() if key not in RUNTIME_ARGS}
+    output_prefixes, subject_hashes, pending = {}, {}, []
+    for subject_label, mask in zip(subjects_to_analyze, masks):
+        output_prefixes[subject_label] = os.path.join(args.output_dir, '{0}_{1}'.format(
+            create_output_filename_from_args(subject_label, **vars(args)), identifier))
+        subject_hashes[subject_label] = subject_config_hash(
+            subject_label, mask, output_config, bold_prep_kwargs, preprocess_kwargs, encoding_kwargs,
+            bids_index=bids_index, **vars(args))
+        if not args.no_resume and outputs_complete(output_prefixes[subject_label], subject_hashes[subject_label],
+                                                   model_store=args.model_store, extension=extension):
+            print('Skipping sub-{}, its outputs already exist for this configuration.'.format(subject_label))
+        else:
+            pending.append((subject_label, mask))
+    fit_kwargs = {'bold_prep_kwargs': bold_prep_kwargs, 'preprocess_kwargs': preprocess_kwargs,
+                  'stimulus_cache': cache, 'bold_cache': cache, 'load_n_jobs': args.load_jobs,
+                  'stim_read_kwargs': stim_read_kwargs, 'bids_index': bids_index, 'estimator': estimator}
+
+    if args.group_fit and pending:
+        # the stimulus is shared, so it is only decomposed once per fold for all subjects
+        pending_labels, pending_masks = [list(values) for values in zip(*pending)]
+        print('Fitting {} subjects together with {} threads.'.format(len(pending), cpu_count()))
+        with threadpool_limits(limits=cpu_count()):
+            subject_results = run_model_for_subjects(pending_labels, masks=pending_masks,
+                                                     encoding_kwargs=encoding_kwargs, **fit_kwargs, **vars(args))
+        for subject_label, (*results, mask) in zip(pending_labels, subject_results):
+            save_outputs(results, output_mask(mask, subject_label, **fit_kwargs, **vars(args)),
+                         output_prefixes[subject_label], subject_hashes[subject_label],
+                         log_config=log_config, extension=extension, write_kwargs=write_kwargs)
+    elif pending:
+        memory_estimates = [0] * len(pending)
+        if args.memory_budget:
+            memory_estimates = [estimate_subject_memory(
+                process_bids_subject(subject_label, bids_index=bids_index, **vars(args))[0], mask=mask,
+                dtype=bold_prep_kwargs.get('dtype', np.float32))
+                for subject_label, mask in pending]
+        n_workers, n_threads = plan_workers(memory_estimates, n_jobs=args.subject_jobs,
+                                            memory_budget=args.memory_budget * 1e9 if args.memory_budget else None)
+        print('Fitting {} subjects, {} at a time with {} threads each.'.format(len(pending), n_workers, n_threads))
+        start = time.time()
+        subjects_done = Parallel(n_jobs=n_workers)(
+            delayed(fit_subject)(subject_label, mask, output_prefixes[subject_label], subject_hashes[subject_label],
+                                 n_threads, encoding_kwargs, model_store_dtype='float32' if args.float32_models else 'float64',
+                                 log_config=log_config, extension=extension, write_kwargs=write_kwargs,
+                                 **fit_kwargs, **vars(args))
+            for subject_label, mask in pending)
+        print('Fit {} subjects in {:.1f}s.'.format(len(subjects_done), time.time() - start))
@@ -0,0 +1,34 @@
+from voxelwiseencoding.cache import ArrayCache
+import numpy as np
+
+
+def test_array_cache(tmp_path):
+    stim_file = tmp_path / 'stim.tsv'
+    stim_file.write_text('1\t2\n')
+    X = np.random.randn(100, 10)
+    cache = ArrayCache(str(tmp_path / 'cache'), max_size=2 * X.nbytes + 1000)
+    key = cache.key([str(stim_file)], params={'lag_time': 6.})
+    assert key == cache.key([str(stim_file)], params={'lag_time': 6.})
+    assert key != cache.key([str(stim_file)], params={'lag_time': 4.})
+    assert cache.get(key) is None
+    stored = cache.put(key, {'X': X, 'rows': np.arange(100)})
+    assert isinstance(stored['X'], np.memmap)
+    assert np.array_equal(cache.get(key)['X'], X)
+    # changing the content of the file changes the key
+    stim_file.write_text('1\t3\n')
+    assert key != cache.key([str(stim_file)], params={'lag_time': 6.})
+
+
+def test_array_cache_eviction(tmp_path):
+    X = np.random.randn(100, 10)
+    cache = ArrayCache(str(tmp_path), max_size=2 * X.nbytes + 1000)
+    keys = [cache.key(params={'run': run}) for run in range(3)]
+    cache.put(keys[0], {'X': X})
+    cache.put(keys[1], {'X': X})
+    cache.get(keys[0])
+    cache.put(keys[2], {'X': X})
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) is not None and cache.get(keys[2]) is not None
+    assert cache.size <= cache.max_size
+    cache.clear()
+    assert cache.entries() == []
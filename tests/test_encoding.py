@@ -1,5 +1,11 @@
 from voxelwiseencoding import encoding as enc
+from voxelwiseencoding.encoding import ReducedEstimator
+from voxelwiseencoding.preprocessing import LaggedDesign
+from sklearn.linear_model import RidgeCV
+from sklearn.model_selection import GroupKFold
 import numpy as np
+import os
+import pytest
 
 def create_encoding_test_data():
     '''Creates toy stimulus and fmri data to test voxelwise encoding models.'''
@@ -12,6 +18,345 @@ def create_encoding_test_data():
 
 def test_encoding():
     X, y  = create_encoding_test_data()
-    ridges, scores = enc.get_ridge_plus_scores(X, y, n_splits=2)
+    ridges, scores = enc.get_model_plus_scores(X, y, cv=2)
     assert len(ridges) == 2
-    assert scores.shape == (27, 2)
\ No newline at end of file
+    assert scores.shape == (27, 2)
+
+
+def test_svd_ridge_cv():
+    X, y = create_encoding_test_data()
+    alphas = np.logspace(-3, 3, 7)
+    ridge = enc.SVDRidgeCV(alphas=alphas).fit(X, y)
+    sk_ridge = RidgeCV(alphas=alphas, alpha_per_target=True).fit(X, y)
+    assert np.allclose(ridge.alpha_, sk_ridge.alpha_)
+    assert np.allclose(ridge.coef_, sk_ridge.coef_)
+    assert np.allclose(ridge.predict(X), sk_ridge.predict(X))
+
+
+def test_return_alphas():
+    X, y = create_encoding_test_data()
+    y[:, 0] = 0.
+    ridges, scores, alphas = enc.get_model_plus_scores(X, y, cv=2, alphas=[1., 10.],
+                                                       return_alphas=True)
+    assert alphas.shape == scores.shape
+    assert np.all(alphas[0] == 0.)
+    assert np.all(np.isin(alphas[1:], [1., 10.]))
+
+
+def test_ridge_cv_parameters():
+    X, y = create_encoding_test_data()
+    # encoding configs with RidgeCV parameters still use RidgeCV
+    with pytest.warns(UserWarning, match='gcv_mode'):
+        ridges, scores = enc.get_model_plus_scores(X, y, cv=2, alphas=[1., 10.], gcv_mode='svd')
+    assert isinstance(ridges[0], RidgeCV)
+    ridges, svd_scores = enc.get_model_plus_scores(X, y, cv=2, alphas=[1., 10.], alpha_per_target=True)
+    assert isinstance(ridges[0], enc.SVDRidgeCV)
+
+
+def test_svd_ridge_cv_kernel_solver():
+    X = np.random.randn(50, 500)
+    y = X[:, :10].dot(np.random.randn(10, 20)) + np.random.randn(50, 20)
+    alphas = np.logspace(-1, 4, 6)
+    primal = enc.SVDRidgeCV(alphas=alphas, solver='svd').fit(X, y)
+    dual = enc.SVDRidgeCV(alphas=alphas, solver='auto').fit(X, y)
+    assert np.allclose(primal.alpha_, dual.alpha_)
+    assert np.allclose(primal.coef_, dual.coef_)
+    assert np.allclose(primal.intercept_, dual.intercept_)
+
+
+def test_parallel_folds():
+    X, y = create_encoding_test_data()
+    _, scores = enc.get_model_plus_scores(X, y, cv=3)
+    _, parallel_scores = enc.get_model_plus_scores(X, y, cv=3, n_jobs=2)
+    assert np.allclose(scores, parallel_scores)
+
+
+def test_product_moment_corr():
+    x = np.random.randn(100, 30)
+    y = x + np.random.randn(100, 30)
+    y[:, 0] = 1.
+    r = enc.product_moment_corr(x, y, chunk_size=7)
+    assert r[0] == 0.
+    assert np.allclose(r[1:], [np.corrcoef(x[:, i], y[:, i])[0, 1] for i in range(1, 30)])
+    assert np.allclose(enc.product_moment_corr(x, y, dtype=np.float32), r, atol=1e-5)
+    accumulator = enc.CorrelationAccumulator()
+    for batch in np.array_split(np.arange(100), 3):
+        accumulator.merge(enc.CorrelationAccumulator().update(x[batch], y[batch]))
+    assert np.allclose(accumulator.correlation(), r)
+
+
+def test_concatenate_folds():
+    X, y = create_encoding_test_data()
+    _, scores = enc.get_model_plus_scores(X, y, cv=3, concatenate_folds=True)
+    assert scores.shape == (27, 1)
+
+
+def test_block_multi_output_on_disk(tmp_path):
+    X, y = create_encoding_test_data()
+    np.save(str(tmp_path / 'y.npy'), y)
+    in_memory = enc.BlockMultiOutput(enc.SVDRidgeCV(), n_blocks=4).fit(X, y)
+    on_disk = enc.BlockMultiOutput(enc.SVDRidgeCV(), n_blocks=4, n_jobs=2,
+                                   coef_dir=str(tmp_path / 'coef')).fit(X, str(tmp_path / 'y.npy'))
+    assert isinstance(on_disk.coef_, np.memmap)
+    assert on_disk.coef_.shape == (27, X.shape[1])
+    assert np.allclose(on_disk.predict(X), in_memory.predict(X))
+
+
+def test_block_multi_output_hdf5(tmp_path):
+    import pytest
+    h5py = pytest.importorskip('h5py')
+    X, y = create_encoding_test_data()
+    with h5py.File(str(tmp_path / 'y.h5'), 'w') as fl:
+        fl.create_dataset('bold', data=y)
+    in_memory = enc.BlockMultiOutput(enc.SVDRidgeCV(), n_blocks=4).fit(X, y)
+    on_disk = enc.BlockMultiOutput(enc.SVDRidgeCV(), n_blocks=4).fit(X, str(tmp_path / 'y.h5') + ':bold')
+    assert np.allclose(on_disk.predict(X), in_memory.predict(X))
+
+
+def test_model_store(tmp_path):
+    X, y = create_encoding_test_data()
+    y[:, 0] = 0.
+    ridges, scores, alphas = enc.get_model_plus_scores(X, y, cv=2, return_alphas=True)
+    store, store_scores, store_alphas = enc.get_model_plus_scores(
+        X, y, cv=2, return_alphas=True, model_store=str(tmp_path / 'store'))
+    assert isinstance(store.coef, np.memmap)
+    assert store.coef.shape == (2, 26, X.shape[1])
+    assert np.allclose(scores, store_scores)
+    assert np.allclose(alphas, store_alphas)
+    assert np.allclose(store.predict(X, fold=1)[:, 1:], ridges[1].predict(X))
+    assert np.all(store.predict(X)[:, 0] == 0.)
+    store = enc.save_model_store(ridges, str(tmp_path / 'store32'), voxel_mask=y.var(axis=0) > 0.,
+                                 dtype=np.float32)
+    assert store.coef.dtype == np.float32
+    assert np.allclose(enc.ModelStore(str(tmp_path / 'store32')).predict(X, fold=0)[:, 1:],
+                       ridges[0].predict(X), atol=1e-4)
+
+
+def test_fold_checkpoints(tmp_path, monkeypatch):
+    X, y = create_encoding_test_data()
+    checkpoint_dir = str(tmp_path / 'checkpoints')
+    ridges, scores, alphas = enc.get_model_plus_scores(X, y, cv=3, return_alphas=True, checkpoint_dir=checkpoint_dir)
+    assert sorted(os.listdir(checkpoint_dir)) == ['fold-0.pkl', 'fold-1.pkl', 'fold-2.pkl']
+    # only the fold without checkpoint is trained again
+    os.remove(os.path.join(checkpoint_dir, 'fold-1.pkl'))
+    trained = []
+    fit_and_score_fold = enc._fit_and_score_fold
+    def record_fold(*args):
+        trained.append(args[8])
+        return fit_and_score_fold(*args)
+    monkeypatch.setattr(enc, '_fit_and_score_fold', record_fold)
+    _, resumed_scores, resumed_alphas = enc.get_model_plus_scores(X, y, cv=3, return_alphas=True,
+                                                                  checkpoint_dir=checkpoint_dir)
+    assert trained == [1]
+    assert np.allclose(scores, resumed_scores)
+    assert np.allclose(alphas, resumed_alphas)
+    store, store_scores = enc.get_model_plus_scores(X, y, cv=3, checkpoint_dir=checkpoint_dir,
+                                                    model_store=str(tmp_path / 'store'))
+    assert trained == [1]
+    assert np.allclose(store.predict(X, fold=2), ridges[2].predict(X))
+    # checkpoints of different data are not used
+    enc.get_model_plus_scores(X, y + 1., cv=3, checkpoint_dir=checkpoint_dir)
+    assert trained == [1, 0, 1, 2]
+
+def test_permutation_test():
+    X, y = create_encoding_test_data()
+    y[:, 0] = 0.
+    ridges, scores = enc.get_model_plus_scores(X, y, cv=2)
+    null, p_values = enc.permutation_test(X, y, ridges, cv=2, n_permutations=99, block_size=5,
+                                          batch_size=20, random_state=0)
+    assert null.shape == (27, 2, 99)
+    assert p_values.shape == scores.shape
+    assert np.all(p_values[0] == 1.)
+    # the signal voxels are predicted better than in all permutations
+    assert np.allclose(p_values[1:26], 0.01)
+    # models trained on folds that leave one run out are tested on the same folds
+    groups = np.repeat(np.arange(4), 25)
+    ridges, scores = enc.get_model_plus_scores(X, y, groups=groups)
+    null, p_values = enc.permutation_test(X, y, ridges, n_permutations=99, block_size=5,
+                                          random_state=0, groups=groups)
+    assert null.shape == (27, 4, 99)
+    assert p_values.shape == scores.shape
+    # a run of 25 samples only has 5! permutations of blocks of 5 samples, some of which repeat
+    assert np.all(p_values[1:26] < 0.05)
+
+
+def test_permutation_test_voxel_mask(tmp_path):
+    rng = np.random.RandomState(0)
+    X = rng.randn(300, 10)
+    y = np.concatenate([X.dot(rng.randn(10, 5)), rng.randn(300, 20)], axis=1)
+    y[:, -1] = 0.
+    ridges, scores = enc.get_model_plus_scores(X, y, cv=3, screening={'top_k': 5})
+    store, _ = enc.get_model_plus_scores(X, y, cv=3, screening={'top_k': 5}, model_store=str(tmp_path / 'store'))
+    for models in [ridges, store]:
+        _, p_values = enc.permutation_test(X, y, models, cv=3, n_permutations=49, random_state=0)
+        assert p_values.shape == (25, 3)
+        assert np.allclose(p_values[:5], 0.02) and np.all(p_values[5:] == 1.)
+    # only the voxels in voxel_mask are tested
+    ridges, _ = enc.get_model_plus_scores(X, y[:, :10], cv=3)
+    voxel_mask = np.zeros(25, dtype=bool)
+    voxel_mask[:10] = True
+    _, p_values = enc.permutation_test(X, y, ridges, cv=3, n_permutations=49, random_state=0, voxel_mask=voxel_mask)
+    assert np.allclose(p_values[:5], 0.02) and np.all(p_values[10:] == 1.)
+
+
+def test_runwise_ridge_cv():
+    from sklearn.linear_model import Ridge
+    X, y = create_encoding_test_data()
+    groups = np.repeat(np.arange(4), 25)
+    ridge = enc.RunwiseRidgeCV(alphas=[10.]).fit(X, y, groups)
+    assert np.allclose(ridge.coef_, Ridge(alpha=10.).fit(X, y).coef_)
+    scores = ridge.cross_validate()
+    assert scores.shape == (27, 4)
+    held_out = [enc.product_moment_corr(Ridge(alpha=10.).fit(X[groups != run], y[groups != run]).predict(
+        X[groups == run]), y[groups == run]) for run in range(4)]
+    assert np.allclose(scores, np.array(held_out).T)
+    # adding runs incrementally gives the same model
+    incremental = enc.RunwiseRidgeCV(alphas=[1., 10., 100.])
+    for run in range(4):
+        incremental.add_run(X[groups == run], y[groups == run])
+    incremental.fit()
+    ridge = enc.RunwiseRidgeCV(alphas=[1., 10., 100.]).fit(X, y, groups)
+    assert np.allclose(incremental.coef_, ridge.coef_)
+    assert np.allclose(incremental.alpha_, ridge.alpha_)
+    # in get_model_plus_scores, the folds follow the runs given by groups, leaving one run out by default
+    ridges, scores, alphas = enc.get_model_plus_scores(X, y, enc.RunwiseRidgeCV(alphas=[1., 10., 100.]), cv=2,
+                                                       groups=groups, return_alphas=True)
+    assert [ridge.n_runs for ridge in ridges] == [3] * 4
+    assert alphas.shape == scores.shape == (27, 4)
+    # group-aware splitters get the groups
+    ridges, scores = enc.get_model_plus_scores(X, y, enc.RunwiseRidgeCV(alphas=[1., 10., 100.]),
+                                               cv=GroupKFold(n_splits=2), groups=groups)
+    for ridge, (train, test) in zip(ridges, GroupKFold(n_splits=2).split(X, y, groups)):
+        assert not np.intersect1d(groups[train], groups[test]).size
+        assert ridge.n_runs == 2
+        fold_ridge = enc.RunwiseRidgeCV(alphas=[1., 10., 100.]).fit(X[train], y[train], groups[train])
+        assert np.allclose(ridge.coef_, fold_ridge.coef_)
+    assert scores.shape == (27, 2)
+    with pytest.raises(ValueError, match='groups'):
+        enc.get_model_plus_scores(X, y, enc.RunwiseRidgeCV(alphas=[1., 10., 100.]), cv=2)
+
+
+def test_group_model_plus_scores():
+    X, y = create_encoding_test_data()
+    ys = [y, y[:, :10] + np.random.randn(100, 10)]
+    ys[1][:, 0] = 0.
+    results = enc.get_group_model_plus_scores(X, ys, cv=2, alphas=[1., 10.], return_alphas=True)
+    assert len(results) == 2
+    for (ridges, scores, alphas), subject_y in zip(results, ys):
+        single_ridges, single_scores, single_alphas = enc.get_model_plus_scores(
+            X, subject_y, cv=2, alphas=[1., 10.], return_alphas=True)
+        assert len(ridges) == 2
+        assert np.allclose(scores, single_scores)
+        assert np.allclose(alphas, single_alphas)
+        assert np.allclose(ridges[0].coef_, single_ridges[0].coef_)
+
+
+def test_group_model_plus_scores_groups(monkeypatch):
+    X, y = create_encoding_test_data()
+    ys = [y, y[:, :10] + np.random.randn(100, 10)]
+    groups = np.repeat(np.arange(4), 25)
+    hat_diagonals = enc.SVDRidgeCV._hat_diagonals
+    computed = []
+    def record_hat_diagonals(self, decomposition):
+        computed.append(decomposition[0].shape[0])
+        return hat_diagonals(self, decomposition)
+    monkeypatch.setattr(enc.SVDRidgeCV, '_hat_diagonals', record_hat_diagonals)
+    # parameters of get_model_plus_scores in an encoding config are ignored
+    results = enc.get_group_model_plus_scores(X, ys, alphas=[1., 10.], groups=groups, n_jobs=1, concatenate_folds=False)
+    # the folds leave one run out and their hat matrix diagonals are computed once for all subjects
+    assert computed == [75] * 4
+    for (ridges, scores), subject_y in zip(results, ys):
+        _, single_scores = enc.get_model_plus_scores(X, subject_y, alphas=[1., 10.], groups=groups)
+        assert scores.shape == (subject_y.shape[1], 4)
+        assert np.allclose(scores, single_scores)
+    results = enc.get_group_model_plus_scores(X, ys, cv=GroupKFold(n_splits=2), groups=groups)
+    assert results[0][1].shape == (27, 2)
+
+
+def test_lagged_design():
+    X, y = create_encoding_test_data()
+    design = LaggedDesign(X, 3)[2:]
+    X_lagged, y = design.toarray(), y[2:]
+    for solver in ['svd', 'eigen']:
+        ridge = enc.SVDRidgeCV(alphas=[1., 10.], solver=solver).fit(X_lagged, y)
+        lazy_ridge = enc.SVDRidgeCV(alphas=[1., 10.], solver=solver).fit(design, y)
+        assert np.allclose(ridge.alpha_, lazy_ridge.alpha_)
+        assert np.allclose(ridge.coef_, lazy_ridge.coef_)
+        assert np.allclose(ridge.predict(X_lagged), lazy_ridge.predict(design))
+    _, scores = enc.get_model_plus_scores(X_lagged, y, cv=2)
+    _, lazy_scores = enc.get_model_plus_scores(design, y, cv=2)
+    assert np.allclose(scores, lazy_scores)
+
+
+def test_reduced_estimator():
+    rng = np.random.RandomState(0)
+    latent = rng.randn(300, 10)
+    X = latent.dot(rng.randn(10, 500)) + 0.01 * rng.randn(300, 500)
+    y = latent.dot(rng.randn(10, 5))
+    for method, n_components in [('pca', 0.99), ('pca', 10), ('svd', 0.99), ('random', 100)]:
+        model = ReducedEstimator(method=method, n_components=n_components, random_state=0).fit(X[:200], y[:200])
+        if method != 'random':
+            assert model.n_components_ == 10
+            assert model.explained_variance_ratio_ > 0.99
+        assert np.allclose(model.predict(X[200:]), X[200:].dot(model.coef_.T) + model.intercept_)
+    # the projection of a LaggedDesign is the same as for its materialized array
+    lagged = LaggedDesign(rng.randn(100, 3), 4, fill_value=0.)
+    y = rng.randn(100, 2)
+    model_lazy = ReducedEstimator(n_components=0.9).fit(lagged, y)
+    model = ReducedEstimator(n_components=0.9).fit(lagged.toarray(), y)
+    assert np.allclose(model_lazy.predict(lagged), model.predict(lagged.toarray()))
+    models, scores, alphas = enc.get_model_plus_scores(X, X[:, :3], cv=3, reduction={'n_components': 0.9},
+                                                       return_alphas=True)
+    assert all(isinstance(model, ReducedEstimator) for model in models)
+    assert scores.shape == alphas.shape == (3, 3)
+    results = enc.reduction_tradeoff(X, X[:, :3], [None, 5], cv=2)
+    assert results['n_components'] == [500, 5]
+    assert results['explained_variance'][1] < 1.
+
+
+def test_voxel_screening(monkeypatch):
+    rng = np.random.RandomState(0)
+    X = rng.randn(500, 10)
+    y = np.concatenate([X.dot(rng.randn(10, 5)), rng.randn(500, 20)], axis=1)
+    keep, screening_scores = enc.screen_voxels(X, y, top_k=5)
+    assert np.all(keep[:5]) and not np.any(keep[5:])
+    assert screening_scores.shape == (25,)
+    models, scores, alphas = enc.get_model_plus_scores(X, y, cv=3, return_alphas=True,
+                                                       screening={'threshold': 0.5})
+    # voxels are selected on each training fold, the models cover all voxels
+    assert models[0].coef_.shape == (25, 10)
+    assert all(np.all(model.keep_[:5]) and not np.any(model.keep_[5:]) for model in models)
+    assert np.all(models[0].coef_[5:] == 0) and np.all(models[0].predict(X)[:, 5:] == 0)
+    assert np.all(scores[:5] > 0.5) and np.all(scores[5:] == 0) and np.all(alphas[5:] == 0)
+    screened = []
+    screen_voxels = enc.screen_voxels
+    def record_screening(X_train, y_train, **kwargs):
+        screened.append(X_train.shape[0])
+        return screen_voxels(X_train, y_train, **kwargs)
+    monkeypatch.setattr(enc, 'screen_voxels', record_screening)
+    enc.get_model_plus_scores(X, y, cv=5, screening={'top_k': 5})
+    assert screened == [400] * 5
+    monkeypatch.undo()
+    # if no voxel passes the screening, all voxels are predicted as zero and score zero
+    models, scores, alphas = enc.get_model_plus_scores(X, y, cv=3, return_alphas=True,
+                                                       screening={'threshold': 1.})
+    assert not any(model.keep_.any() for model in models)
+    assert models[0].coef_.shape == (25, 10) and np.all(models[0].coef_ == 0)
+    assert np.all(models[0].predict(X) == 0)
+    assert np.all(scores == 0) and np.all(alphas == 0)
+
+
+def test_sparse_stimulus():
+    from scipy import sparse
+    rng = np.random.RandomState(0)
+    for n_features in [20, 500]:
+        X = (rng.rand(200, n_features) > 0.9).astype(float)
+        y = X.dot(rng.randn(n_features, 4)) + rng.randn(200, 4)
+        ridge = enc.SVDRidgeCV().fit(X, y)
+        ridge_sparse = enc.SVDRidgeCV().fit(sparse.csr_matrix(X), y)
+        assert np.allclose(ridge.coef_, ridge_sparse.coef_)
+        assert np.allclose(ridge.predict(X), ridge_sparse.predict(sparse.csr_matrix(X)))
+        _, scores = enc.get_model_plus_scores(X, y, cv=3)
+        _, scores_sparse = enc.get_model_plus_scores(sparse.csr_matrix(X), y, cv=3)
+        assert np.allclose(scores, scores_sparse)
+
@@ -9,8 +9,8 @@ def create_test_data():
     X = np.reshape(np.random.randn(1000, 5), (100, -1))
     betas = np.random.randn(X.shape[-1], 27) * 2
     y = X.dot(betas).T
-    mask = np.ones((3, 3, 3), np.bool)
-    mask_img = nibabel.Nifti1Image(mask.astype(np.int), np.eye(4))
+    mask = np.ones((3, 3, 3), bool)
+    mask_img = nibabel.Nifti1Image(mask.astype(np.int32), np.eye(4))
     data_img = nibabel.Nifti1Image(np.reshape(y, (3, 3, 3, -1)), np.eye(4))
     return mask_img, data_img, X
 
@@ -58,6 +58,74 @@ def test_generate_lagged_stimulus():
     assert x_lagged[2].max() == 29
 
 
+def test_aggregate_stimulus():
+    stim_TR, TR = 0.1, 2
+    stimulus = np.random.randn(200, 3)
+    x_mean = prep.generate_lagged_stimulus(stimulus, 10, TR, stim_TR, lag_time=4, aggregate='mean')
+    assert x_mean.shape == (10, 6)
+    assert np.allclose(x_mean[1:, 3:], stimulus.reshape(10, 20, 3).mean(axis=1)[:-1])
+    x_max = prep.generate_lagged_stimulus(stimulus, 10, TR, stim_TR, lag_time=None, aggregate='max')
+    assert np.allclose(x_max, stimulus.reshape(10, 20, 3).max(axis=1))
+    # a slow signal survives resampling, a fast one is filtered out
+    time = np.arange(2000) * 0.01
+    slow = np.sin(2 * np.pi * 0.05 * time)
+    fast = np.sin(2 * np.pi * 3 * time)
+    x_resampled = prep.generate_lagged_stimulus((slow + fast)[:, None], 10, TR, 0.01,
+                                                lag_time=None, aggregate='resample')
+    centers = np.arange(10) * TR + TR / 2
+    assert np.allclose(x_resampled[2:-2, 0], np.sin(2 * np.pi * 0.05 * centers)[2:-2], atol=0.02)
+    # stimulus TRs that do not divide the fMRI TR
+    x_mean = prep.generate_lagged_stimulus(np.ones((700, 2)), 10, TR, 0.03, lag_time=None,
+                                           start_time=3, aggregate='mean')
+    assert x_mean.shape == (12, 2)
+    assert np.isnan(x_mean[:2]).all() and np.allclose(x_mean[2:], 1)
+
+
+def test_lazy_make_X_Y():
+    stim_TR, TR = 0.1, 2
+    stimuli = [np.random.randn(80, 2), np.random.randn(100, 2)]
+    fmri = [np.random.randn(4, 3), np.random.randn(5, 3)]
+    for remove_nans in [True, False]:
+        x, y = prep.make_X_Y(stimuli, fmri, TR, stim_TR, lag_time=4, offset_stim=2,
+                             start_times=[0, 0.5], remove_nans=remove_nans)
+        x_lazy, y_lazy = prep.make_X_Y(stimuli, fmri, TR, stim_TR, lag_time=4, offset_stim=2,
+                                       start_times=[0, 0.5], remove_nans=remove_nans, lazy=True)
+        assert isinstance(x_lazy, prep.LaggedDesign)
+        assert np.array_equal(x_lazy.toarray(), x, equal_nan=True)
+        assert np.array_equal(y_lazy, y)
+
+
+def test_make_X_Y_memmap(tmp_path):
+    stim_TR, TR = 0.1, 2
+    stimuli = [np.random.randn(80, 2), np.random.randn(100, 2)]
+    fmri = [np.random.randn(4, 3), np.random.randn(5, 3)]
+    x, y = prep.make_X_Y(stimuli, fmri, TR, stim_TR, lag_time=4, start_times=[0, 0.5])
+    x_32, y_32 = prep.make_X_Y(stimuli, fmri, TR, stim_TR, lag_time=4, start_times=[0, 0.5],
+                               dtype=np.float32, memmap_dir=str(tmp_path))
+    assert x_32.dtype == np.float32 and y_32.dtype == np.float32
+    assert np.allclose(x_32, x) and np.allclose(y_32, y)
+    assert np.allclose(np.load(str(tmp_path / 'X.npy')), x)
+
+
+def test_fmri_preprocessing_cache(tmp_path):
+    from voxelwiseencoding.cache import ArrayCache
+    bold_file = str(tmp_path / 'bold.nii.gz')
+    nibabel.save(nibabel.Nifti1Image(np.random.randn(3, 3, 3, 20), np.eye(4)), bold_file)
+    mask = nibabel.Nifti1Image(np.ones((3, 3, 3), dtype=np.uint8), np.eye(4))
+    cache = ArrayCache(str(tmp_path / 'cache'))
+    data = prep.preprocess_bold_fmri(bold_file, mask=mask, detrend=True, standardize=False)
+    cached = prep.preprocess_bold_fmri(bold_file, mask=mask, detrend=True, standardize=False, cache=cache)
+    assert cached.dtype == np.float32
+    assert np.allclose(cached, data, atol=1e-5)
+    assert len(cache.entries()) == 1
+    # the data is now loaded from the cache
+    assert np.array_equal(prep.preprocess_bold_fmri(bold_file, mask=mask, detrend=True,
+                                                    standardize=False, cache=cache), cached)
+    assert len(cache.entries()) == 1
+    prep.preprocess_bold_fmri(bold_file, mask=mask, detrend=False, standardize=False, cache=cache)
+    assert len(cache.entries()) == 2
+
+
 def test_fmri_preprocessing():
     mask, data, _ = create_test_data()
     bold = prep.preprocess_bold_fmri(data)
@@ -66,3 +134,24 @@ def test_fmri_preprocessing():
     assert bold.shape == (100, 27)
     bold = prep.preprocess_bold_fmri(data, mask=mask, standardize='zscore')
     bold = prep.preprocess_bold_fmri(data, mask=mask, standardize='zscore', detrend=True)
+    # the voxels of a mask can be computed once and used for several runs
+    partial_mask = nibabel.Nifti1Image((np.arange(27) % 2).reshape((3, 3, 3)).astype(np.uint8), np.eye(4))
+    voxels = prep.mask_voxels(partial_mask, data)
+    assert voxels.dtype == bool and voxels.sum() == 13
+    assert np.array_equal(prep.preprocess_bold_fmri(data, mask=voxels),
+                          prep.preprocess_bold_fmri(data, mask=partial_mask))
+
+
+def test_sparse_make_X_Y():
+    from scipy import sparse
+    stim_TR, TR = 0.1, 2
+    stimuli = [(np.random.rand(80, 2) > 0.9).astype(float), (np.random.rand(100, 2) > 0.9).astype(float)]
+    fmri = [np.random.randn(4, 3), np.random.randn(5, 3)]
+    for remove_nans in [True, False]:
+        x, y = prep.make_X_Y(stimuli, fmri, TR, stim_TR, lag_time=4, offset_stim=2,
+                             start_times=[0, 0.5], remove_nans=remove_nans)
+        x_sparse, y_sparse = prep.make_X_Y([sparse.csr_matrix(stimulus) for stimulus in stimuli], fmri, TR, stim_TR,
+                                           lag_time=4, offset_stim=2, start_times=[0, 0.5], remove_nans=remove_nans)
+        assert sparse.isspmatrix_csr(x_sparse)
+        assert np.array_equal(x_sparse.toarray(), np.nan_to_num(x))
+        assert np.array_equal(y_sparse, y)
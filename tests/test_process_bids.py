@@ -0,0 +1,230 @@
+from voxelwiseencoding.process_bids import (read_stimulus_tsv, stimulus_sidecar_filename, BIDSIndex,
+                                            process_bids_subject, compute_subject_mask, compute_group_mask,
+                                            config_hash, estimate_subject_memory, plan_workers,
+                                            save_voxel_maps, run_model_for_subject, run_model_for_subjects)
+from voxelwiseencoding import process_bids
+import numpy as np
+import gzip
+import os
+
+
+def test_read_stimulus_tsv(tmp_path):
+    stimulus = np.random.randn(100, 3)
+    tsv_fl = str(tmp_path / 'task-test_run-1_stim.tsv.gz')
+    np.savetxt(tsv_fl, stimulus, delimiter='\t')
+    for n_jobs in [1, 3]:
+        assert np.allclose(read_stimulus_tsv(tsv_fl, n_jobs=n_jobs), np.loadtxt(tsv_fl, delimiter='\t'))
+    np.savetxt(tsv_fl, stimulus[:, 0], delimiter='\t')
+    assert read_stimulus_tsv(tsv_fl, n_jobs=2).shape == (100,)
+
+
+def test_stimulus_sidecar(tmp_path):
+    stimulus = np.random.randn(100, 3)
+    (tmp_path / 'bids').mkdir()
+    tsv_fl = str(tmp_path / 'bids' / 'task-test_run-1_stim.tsv.gz')
+    sidecar_dir = str(tmp_path / 'derivatives' / 'stimulus_sidecars')
+    sidecar_fl = stimulus_sidecar_filename(tsv_fl, sidecar_dir)
+    assert sidecar_fl == os.path.join(sidecar_dir, 'task-test_run-1_stim.npy')
+    np.savetxt(tsv_fl, stimulus, delimiter='\t')
+    read_stimulus_tsv(tsv_fl)
+    assert not os.path.exists(sidecar_dir)
+    read_stimulus_tsv(tsv_fl, sidecar_dir=sidecar_dir)
+    # nothing is written into the BIDS dataset
+    assert os.listdir(str(tmp_path / 'bids')) == ['task-test_run-1_stim.tsv.gz']
+    loaded = read_stimulus_tsv(tsv_fl, sidecar_dir=sidecar_dir)
+    assert isinstance(loaded, np.memmap)
+    assert np.allclose(loaded, stimulus)
+    # a stale sidecar is ignored
+    np.savetxt(tsv_fl, stimulus[:50], delimiter='\t')
+    os.utime(sidecar_fl, ns=(0, 0))
+    assert read_stimulus_tsv(tsv_fl, sidecar_dir=sidecar_dir).shape == (50, 3)
+
+
+def test_bids_index(tmp_path):
+    import json
+    for subject in ['01', '02']:
+        func_dir = tmp_path / 'sub-{}'.format(subject) / 'func'
+        func_dir.mkdir(parents=True)
+        for run in [1, 2]:
+            (func_dir / 'sub-{}_task-test_run-{}_bold.nii.gz'.format(subject, run)).touch()
+            (func_dir / 'sub-{}_task-test_run-{}_stim.json'.format(subject, run)).write_text('{}')
+    for run in [1, 2]:
+        (tmp_path / 'task-test_run-{}_stim.tsv.gz'.format(run)).touch()
+    (tmp_path / 'task-test_bold.json').write_text(json.dumps({'RepetitionTime': 2.}))
+    cache_file = str(tmp_path / 'derivatives' / 'bids_index.json')
+    index = BIDSIndex(str(tmp_path), cache_file=cache_file)
+    assert index.subjects == ['01', '02']
+    bold_files, task_meta, stim_tsv, stim_json = process_bids_subject('02', str(tmp_path), task='test',
+                                                                      bids_index=index)
+    assert [os.path.basename(fl) for fl in bold_files] == ['sub-02_task-test_run-1_bold.nii.gz',
+                                                           'sub-02_task-test_run-2_bold.nii.gz']
+    assert task_meta == {'RepetitionTime': 2.}
+    assert len(stim_tsv) == len(stim_json) == 2
+    assert process_bids_subject('02', str(tmp_path), task='test')[0] == bold_files
+    bold_row = [row for row in index.table if row['path'] == bold_files[0]][0]
+    assert bold_row['sub'] == '02' and bold_row['run'] == '1' and bold_row['suffix'] == 'bold'
+    # the stored index is reused until a directory changes
+    assert BIDSIndex(str(tmp_path), cache_file=cache_file).files == index.files
+    (tmp_path / 'sub-01' / 'func' / 'sub-01_task-test_run-3_bold.nii.gz').touch()
+    assert BIDSIndex(str(tmp_path), cache_file=cache_file).exists(
+        str(tmp_path / 'sub-01' / 'func' / 'sub-01_task-test_run-3_bold.nii.gz'))
+
+
+def create_bids_dataset(bids_dir, subjects=('01', '02'), n_runs=2, n_volumes=40):
+    '''Creates a BIDS dataset of random BOLD data and a one-hot stimulus at 10 Hz shared by all subjects'''
+    import json
+    import nibabel
+    for run in range(1, n_runs + 1):
+        stimulus = np.eye(3)[np.random.randint(3, size=n_volumes * 20)]
+        np.savetxt(str(bids_dir / 'task-test_run-{}_stim.tsv.gz'.format(run)), stimulus, delimiter='\t')
+    (bids_dir / 'task-test_bold.json').write_text(json.dumps({'RepetitionTime': 2.}))
+    for subject in subjects:
+        func_dir = bids_dir / 'sub-{}'.format(subject) / 'func'
+        func_dir.mkdir(parents=True)
+        for run in range(1, n_runs + 1):
+            nibabel.save(nibabel.Nifti1Image(np.random.randn(3, 3, 3, n_volumes).astype('float32'), np.eye(4)),
+                         str(func_dir / 'sub-{}_task-test_run-{}_bold.nii.gz'.format(subject, run)))
+            (func_dir / 'sub-{}_task-test_run-{}_stim.json'.format(subject, run)).write_text(
+                json.dumps({'SamplingFrequency': 10., 'StartTime': 0.}))
+
+
+def test_group_stimulus_loaded_once(tmp_path, monkeypatch):
+    create_bids_dataset(tmp_path)
+    load_stimulus = process_bids._load_stimulus
+    loaded = []
+    def record_stimulus(tsv_fl, json_fl, **kwargs):
+        loaded.append(json_fl)
+        return load_stimulus(tsv_fl, json_fl, **kwargs)
+    monkeypatch.setattr(process_bids, '_load_stimulus', record_stimulus)
+    preprocess_kwargs = {'lazy': True}
+    results = run_model_for_subjects(['01', '02'], str(tmp_path), task='test', preprocess_kwargs=preprocess_kwargs,
+                                     encoding_kwargs={'cv': 2})
+    # the stimulus of the second subject is only compared by its files
+    assert len(loaded) == 2
+    for subject, (_, scores, _) in zip(['01', '02'], results):
+        _, subject_scores, _ = run_model_for_subject(subject, str(tmp_path), task='test',
+                                                     preprocess_kwargs=preprocess_kwargs, encoding_kwargs={'cv': 2})
+        assert np.allclose(scores, subject_scores)
+    # copies of the stimulus files in the directory of a subject are the same stimulus
+    import shutil
+    import pytest
+    for run in [1, 2]:
+        shutil.copy(str(tmp_path / 'task-test_run-{}_stim.tsv.gz'.format(run)),
+                    str(tmp_path / 'sub-02' / 'func' / 'sub-02_task-test_run-{}_stim.tsv.gz'.format(run)))
+    run_model_for_subjects(['01', '02'], str(tmp_path), task='test', encoding_kwargs={'cv': 2})
+    np.savetxt(str(tmp_path / 'sub-02' / 'func' / 'sub-02_task-test_run-2_stim.tsv.gz'),
+               np.eye(3)[np.random.randint(3, size=800)], delimiter='\t')
+    with pytest.raises(ValueError, match='differs from the shared stimulus'):
+        run_model_for_subjects(['01', '02'], str(tmp_path), task='test', encoding_kwargs={'cv': 2})
+
+
+def test_runwise_ridge_cv_subject(tmp_path):
+    from voxelwiseencoding.encoding import RunwiseRidgeCV
+    create_bids_dataset(tmp_path, subjects=('01',), n_runs=4)
+    ridges, scores, _ = run_model_for_subject('01', str(tmp_path), task='test',
+                                              estimator=RunwiseRidgeCV(alphas=[1., 10.]), encoding_kwargs={'cv': 2})
+    # one run is left out in each fold and the alphas are selected on the three training runs
+    assert [ridge.n_runs for ridge in ridges] == [3] * 4
+    assert scores.shape == (27, 4)
+
+
+def test_mask_loaded_once(tmp_path, monkeypatch):
+    import nibabel
+    from voxelwiseencoding import preprocessing
+    create_bids_dataset(tmp_path, subjects=('01',), n_runs=3)
+    mask_file = str(tmp_path / 'mask.nii.gz')
+    nibabel.save(nibabel.Nifti1Image(np.ones((3, 3, 3), dtype=np.uint8), np.eye(4)), mask_file)
+    load = preprocessing.load
+    loaded = []
+    def record_load(filename, **kwargs):
+        loaded.append(filename)
+        return load(filename, **kwargs)
+    monkeypatch.setattr(preprocessing, 'load', record_load)
+    _, scores, _ = run_model_for_subject('01', str(tmp_path), task='test', mask=mask_file)
+    # only the BOLD files are loaded for each run, the mask only once to compute its voxels
+    assert loaded.count(mask_file) == 1 and len(loaded) == 4
+    assert scores.shape == (27, 3)
+
+
+def test_group_sparse_stimulus(tmp_path):
+    create_bids_dataset(tmp_path)
+    sparse_results = run_model_for_subjects(['01', '02'], str(tmp_path), task='test', encoding_kwargs={'cv': 2},
+                                            stim_read_kwargs={'sparse': True}, preprocess_kwargs={'fill_value': 0.})
+    dense_results = run_model_for_subjects(['01', '02'], str(tmp_path), task='test', encoding_kwargs={'cv': 2},
+                                           preprocess_kwargs={'fill_value': 0.})
+    assert len(sparse_results) == 2
+    for (_, sparse_scores, _), (_, dense_scores, _) in zip(sparse_results, dense_results):
+        assert np.allclose(sparse_scores, dense_scores)
+
+
+def test_compute_masks(tmp_path):
+    import nibabel
+    bold_files = {}
+    for subject, shift in [('01', 0), ('02', 1)]:
+        bold = 100 + np.random.randn(10, 10, 10, 20)
+        bold[2+shift:8, 2:8, 2:8] += 1000
+        bold_files[subject] = str(tmp_path / 'sub-{}_bold.nii.gz'.format(subject))
+        nibabel.save(nibabel.Nifti1Image(bold.astype('float32'), np.eye(4)), bold_files[subject])
+    mask_file = str(tmp_path / 'masks' / 'sub-01_mask.nii.gz')
+    assert compute_subject_mask(bold_files['01'], mask_file) == mask_file
+    assert os.path.exists(mask_file.replace('.nii.gz', '.json'))
+    # the mask is reused as long as the BOLD file does not change
+    mtime = os.stat(mask_file).st_mtime_ns
+    compute_subject_mask(bold_files['01'], mask_file)
+    assert os.stat(mask_file).st_mtime_ns == mtime
+    os.utime(bold_files['01'], ns=(mtime + 10**9, mtime + 10**9))
+    compute_subject_mask(bold_files['01'], mask_file)
+    assert os.stat(mask_file.replace('.nii.gz', '.json')).st_mtime_ns > mtime
+
+    group_mask_file = str(tmp_path / 'masks' / 'group_mask.nii.gz')
+    compute_group_mask(bold_files, group_mask_file, n_jobs=2)
+    masks = {subject: nibabel.load(str(tmp_path / 'masks' / 'sub-{}_mask.nii.gz'.format(subject))).get_fdata()
+             for subject in bold_files}
+    group_mask = nibabel.load(group_mask_file).get_fdata()
+    assert group_mask.sum() > 0
+    assert np.array_equal(group_mask, np.logical_and(masks['01'], masks['02']))
+    union_mask = nibabel.load(compute_group_mask(bold_files, group_mask_file, threshold=0.)).get_fdata()
+    assert np.array_equal(union_mask, np.logical_or(masks['01'], masks['02']))
+
+
+def test_plan_workers(tmp_path):
+    import nibabel
+    from joblib import cpu_count
+    bold_file = str(tmp_path / 'sub-01_bold.nii.gz')
+    nibabel.save(nibabel.Nifti1Image(np.zeros((4, 5, 6, 10), dtype='float32'), np.eye(4)), bold_file)
+    mask = np.zeros((4, 5, 6), dtype='uint8')
+    mask[:2] = 1
+    mask_file = str(tmp_path / 'mask.nii.gz')
+    nibabel.save(nibabel.Nifti1Image(mask, np.eye(4)), mask_file)
+    assert estimate_subject_memory([bold_file] * 2) == 3 * 120 * 20 * 4
+    assert estimate_subject_memory([bold_file], mask=mask_file, copies=1) == 60 * 10 * 4
+    assert estimate_subject_memory([bold_file], mask=mask_file, copies=1, dtype=np.float64) == 60 * 10 * 8
+
+    assert plan_workers([100] * 4, n_jobs=1) == (1, cpu_count())
+    assert plan_workers([100] * 4, n_jobs=-1)[0] == min(4, cpu_count())
+    assert plan_workers([100] * 4, n_jobs=3, memory_budget=250)[0] == 2
+    assert plan_workers([100, 500], n_jobs=2, memory_budget=250) == (1, cpu_count())
+
+    assert config_hash({'alphas': [1, 10], 'n_splits': 5}) == config_hash({'n_splits': 5, 'alphas': [1, 10]})
+    assert config_hash({'alphas': [1, 10]}) != config_hash({'alphas': [1, 100]})
+
+
+def test_save_voxel_maps(tmp_path):
+    import nibabel
+    from nilearn.masking import unmask
+    mask = nibabel.Nifti1Image((np.random.rand(6, 7, 8) > 0.5).astype('uint8'), np.diag([2., 2., 2., 1.]))
+    maps = np.random.randn(int(np.asarray(mask.dataobj).sum()), 3)
+    expected = unmask(maps.T, mask).get_fdata()
+    for filename, kwargs in [('maps.nii', {}), ('maps.nii.gz', {}),
+                             ('maps_threads.nii.gz', {'n_jobs': 2, 'compresslevel': 6, 'chunk_size': 1000})]:
+        img = nibabel.load(save_voxel_maps(maps, mask, str(tmp_path / filename), **kwargs))
+        assert img.get_data_dtype() == np.float32
+        assert np.allclose(img.affine, mask.affine)
+        assert np.allclose(img.get_fdata(), expected, atol=1e-6)
+    # compressed files hold the same bytes as the uncompressed file
+    with open(str(tmp_path / 'maps.nii'), 'rb') as fl:
+        uncompressed = fl.read()
+    for filename in ['maps.nii.gz', 'maps_threads.nii.gz']:
+        with gzip.open(str(tmp_path / filename), 'rb') as fl:
+            assert fl.read() == uncompressed
+
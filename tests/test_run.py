@@ -0,0 +1,55 @@
+from tests.test_process_bids import create_bids_dataset
+import run
+import numpy as np
+import nibabel
+import os
+import subprocess
+import sys
+
+
+def test_outputs_complete(tmp_path):
+    mask = nibabel.Nifti1Image(np.ones((2, 2, 2), dtype=np.uint8), np.eye(4))
+    output_prefix = str(tmp_path / 'sub-01_task-test_')
+    assert not run.outputs_complete(output_prefix, 'hash')
+    run.save_outputs(([], np.random.randn(8, 2)), mask, output_prefix, 'hash')
+    assert run.outputs_complete(output_prefix, 'hash')
+    assert not run.outputs_complete(output_prefix, 'other hash')
+    assert not run.outputs_complete(output_prefix, 'hash', extension='.nii')
+    assert not run.outputs_complete(output_prefix, 'hash', model_store=True)
+    # outputs of an interrupted subject are not marked as complete
+    os.remove(output_prefix + 'scores.json')
+    assert not run.outputs_complete(output_prefix, 'hash')
+
+
+def test_subject_config_hash(tmp_path):
+    create_bids_dataset(tmp_path)
+    subject_hash = run.subject_config_hash('01', None, {'cv': 2}, bids_dir=str(tmp_path), task='test')
+    assert subject_hash == run.subject_config_hash('01', None, {'cv': 2}, bids_dir=str(tmp_path), task='test')
+    assert subject_hash != run.subject_config_hash('01', None, {'cv': 3}, bids_dir=str(tmp_path), task='test')
+    assert subject_hash != run.subject_config_hash('02', None, {'cv': 2}, bids_dir=str(tmp_path), task='test')
+    # changed BOLD or stimulus files are fit again
+    bold_file = str(tmp_path / 'sub-01' / 'func' / 'sub-01_task-test_run-1_bold.nii.gz')
+    os.utime(bold_file, ns=(0, 0))
+    bold_hash = run.subject_config_hash('01', None, {'cv': 2}, bids_dir=str(tmp_path), task='test')
+    assert bold_hash != subject_hash
+    os.utime(str(tmp_path / 'task-test_run-2_stim.tsv.gz'), ns=(0, 0))
+    assert bold_hash != run.subject_config_hash('01', None, {'cv': 2}, bids_dir=str(tmp_path), task='test')
+
+
+def test_resume(tmp_path):
+    bids_dir, output_dir = tmp_path / 'bids', tmp_path / 'output'
+    bids_dir.mkdir()
+    create_bids_dataset(bids_dir)
+    command = [sys.executable, os.path.join(os.path.dirname(run.__file__), 'run.py'), str(bids_dir), str(output_dir),
+               '-t', 'test', '--skip_bids_validator', '--no-masking']
+    subprocess.run(command, check=True)
+    scores_file = str(output_dir / 'sub-01_task-test_scores.nii.gz')
+    mtime = os.stat(scores_file).st_mtime_ns
+    output = subprocess.run(command, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    assert 'Skipping sub-01' in output and 'Skipping sub-02' in output
+    assert os.stat(scores_file).st_mtime_ns == mtime
+    # a subject whose data changed is fit again, the other one is skipped
+    os.utime(str(bids_dir / 'sub-02' / 'func' / 'sub-02_task-test_run-1_bold.nii.gz'))
+    output = subprocess.run(command, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    assert 'Skipping sub-01' in output and 'Skipping sub-02' not in output
+    assert os.stat(scores_file).st_mtime_ns == mtime
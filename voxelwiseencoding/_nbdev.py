@@ -2,24 +2,52 @@
 
 __all__ = ["index", "modules", "custom_doc_links", "git_url"]
 
-index = {"product_moment_corr": "encoding.ipynb",
+index = {"ArrayCache": "cache.ipynb",
+         "file_hash": "cache.ipynb",
+         "product_moment_corr": "encoding.ipynb",
+         "CorrelationAccumulator": "encoding.ipynb",
          "get_model_plus_scores": "encoding.ipynb",
+         "screen_voxels": "encoding.ipynb",
+         "ScreenedEstimator": "encoding.ipynb",
+         "SVDRidgeCV": "encoding.ipynb",
+         "get_group_model_plus_scores": "encoding.ipynb",
+         "ModelStore": "encoding.ipynb",
+         "save_model_store": "encoding.ipynb",
+         "RunwiseRidgeCV": "encoding.ipynb",
+         "permutation_test": "encoding.ipynb",
+         "ReducedEstimator": "encoding.ipynb",
+         "reduction_tradeoff": "encoding.ipynb",
          "BlockMultiOutput": "encoding.ipynb",
          "preprocess_bold_fmri": "preprocessing.ipynb",
+         "mask_voxels": "preprocessing.ipynb",
          "get_remove_idx": "preprocessing.ipynb",
          "make_lagged_stimulus": "preprocessing.ipynb",
+         "LaggedDesign": "preprocessing.ipynb",
          "generate_lagged_stimulus": "preprocessing.ipynb",
          "make_X_Y": "preprocessing.ipynb",
+         "align_fmri": "preprocessing.ipynb",
          "create_stim_filename_from_args": "process_bids.ipynb",
          "create_output_filename_from_args": "process_bids.ipynb",
          "create_metadata_filename_from_args": "process_bids.ipynb",
          "create_bold_glob_from_args": "process_bids.ipynb",
          "run": "process_bids.ipynb",
+         "BIDSIndex": "process_bids.ipynb",
          "get_func_bold_directory": "process_bids.ipynb",
          "process_bids_subject": "process_bids.ipynb",
-         "run_model_for_subject": "process_bids.ipynb"}
+         "stimulus_sidecar_filename": "process_bids.ipynb",
+         "read_stimulus_tsv": "process_bids.ipynb",
+         "load_subject_data": "process_bids.ipynb",
+         "compute_subject_mask": "process_bids.ipynb",
+         "compute_group_mask": "process_bids.ipynb",
+         "run_model_for_subject": "process_bids.ipynb",
+         "run_model_for_subjects": "process_bids.ipynb",
+         "config_hash": "process_bids.ipynb",
+         "estimate_subject_memory": "process_bids.ipynb",
+         "plan_workers": "process_bids.ipynb",
+         "save_voxel_maps": "process_bids.ipynb"}
 
-modules = ["encoding.py",
+modules = ["cache.py",
+           "encoding.py",
            "preprocessing.py",
            "process_bids.py"]
 
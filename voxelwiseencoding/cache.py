@@ -0,0 +1,132 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: cache.ipynb (unless otherwise specified).
+
+__all__ = ['ArrayCache', 'file_hash']
+
+# Cell
+#export
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+# Cell
+
+class ArrayCache(object):
+    '''Content-addressed on-disk cache of numpy arrays with a size limit
+
+    Every entry is a directory named by its key that contains one memory-mappable .npy file per array.
+    If the cache grows larger than max_size, the least recently used entries are removed.
+
+    Parameters
+
+        cache_dir : str, directory of the cache, is created if it does not exist
+        max_size : None or int, optional, default None
+                   maximum size of the cache in bytes, None does not limit the size
+    '''
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(files=(), params=None, hash_files=True):
+        '''Returns a key for the content of files and a dict of parameters params that can be serialized to json
+
+        Arrays and images in params are identified by the hash of their content.
+        If hash_files is False, files are identified by their path, size, and modification time
+        instead of their content, which avoids reading large files.
+        The key does not depend on the cache, so it can also be computed as ArrayCache.key(files, params).'''
+        key = hashlib.sha256()
+        for fl in files:
+            if hash_files:
+                key.update(file_hash(fl).encode())
+            else:
+                stat = os.stat(fl)
+                key.update('{}:{}:{}'.format(os.path.abspath(fl), stat.st_size, stat.st_mtime_ns).encode())
+        key.update(json.dumps(params, sort_keys=True, default=_json_default).encode())
+        return key.hexdigest()
+
+    def get(self, key, mmap_mode='r'):
+        '''Returns a dict of the arrays stored under key, memory-mapped with mmap_mode, or None if key is not in the cache'''
+        entry = os.path.join(self.cache_dir, key)
+        try:
+            arrays = {fl[:-len('.npy')]: np.load(os.path.join(entry, fl), mmap_mode=mmap_mode)
+                      for fl in os.listdir(entry) if fl.endswith('.npy')}
+            # mark the entry as recently used
+            os.utime(entry)
+        except FileNotFoundError:
+            # the entry does not exist or was evicted while loading it
+            return None
+        return arrays
+
+    def put(self, key, arrays):
+        '''Stores the dict of arrays under key, removes the least recently used entries if the cache is too large,
+        and returns the stored arrays memory-mapped'''
+        # write to a temporary directory first, so that entries are never incomplete
+        tmp_entry = tempfile.mkdtemp(prefix='.tmp-', dir=self.cache_dir)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_entry, name + '.npy'), array)
+        try:
+            os.rename(tmp_entry, os.path.join(self.cache_dir, key))
+        except OSError:
+            # the entry has been stored by another process in the meantime
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        self.evict(keep=key)
+        return self.get(key)
+
+    def entries(self):
+        '''Returns a list of (key, size in bytes, time of last use) of all entries'''
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, key)
+            if key.startswith('.') or not os.path.isdir(entry):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, fl)) for fl in os.listdir(entry))
+                entries.append((key, size, os.path.getmtime(entry)))
+            except FileNotFoundError:
+                continue
+        return entries
+
+    @property
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, keep=None):
+        '''Removes the least recently used entries except keep until the cache is not larger than max_size'''
+        if self.max_size is None:
+            return
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        size = sum(entry_size for _, entry_size, _ in entries)
+        for key, entry_size, _ in entries:
+            if size <= self.max_size:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+            size -= entry_size
+
+    def clear(self):
+        '''Removes all entries'''
+        for key, _, _ in self.entries():
+            shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+
+def _json_default(obj):
+    '''Serializes arrays and images in cache keys by the hash of their content and everything else by str'''
+    if hasattr(obj, 'dataobj') and hasattr(obj, 'affine'):
+        return [_json_default(np.asarray(obj.dataobj)), _json_default(np.asarray(obj.affine))]
+    if isinstance(obj, np.ndarray):
+        content_hash = hashlib.sha256(np.ascontiguousarray(obj).tobytes())
+        content_hash.update('{}{}'.format(obj.shape, obj.dtype).encode())
+        return content_hash.hexdigest()
+    return str(obj)
+
+def file_hash(filename, chunk_size=2**20):
+    '''Returns the sha256 hash of the content of filename'''
+    content_hash = hashlib.sha256()
+    with open(filename, 'rb') as fl:
+        for chunk in iter(lambda: fl.read(chunk_size), b''):
+            content_hash.update(chunk)
+    return content_hash.hexdigest()
\ No newline at end of file
@@ -1,46 +1,123 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: encoding.ipynb (unless otherwise specified).
 
-__all__ = ['product_moment_corr', 'get_model_plus_scores', 'BlockMultiOutput']
+__all__ = ['product_moment_corr', 'CorrelationAccumulator', 'get_model_plus_scores', 'screen_voxels',
+           'ScreenedEstimator', 'SVDRidgeCV', 'get_group_model_plus_scores', 'ModelStore', 'save_model_store',
+           'RunwiseRidgeCV', 'permutation_test', 'ReducedEstimator', 'reduction_tradeoff', 'BlockMultiOutput']
 
 # Cell
 #export
 import numpy as np
 from sklearn.metrics import r2_score
-from sklearn.model_selection import KFold
+from sklearn.model_selection import KFold, LeaveOneGroupOut
 from sklearn.linear_model import RidgeCV
+import os
 import warnings
 import copy
-from joblib import Parallel, delayed
+import time
+from scipy import sparse
+import joblib
+from joblib import Parallel, delayed, cpu_count, effective_n_jobs
+from threadpoolctl import threadpool_limits
 from sklearn.multioutput import MultiOutputRegressor, _fit_estimator
-from sklearn.utils import check_X_y, check_array
-from sklearn.utils.validation import check_is_fitted
-from sklearn.base import RegressorMixin
-
-def product_moment_corr(x,y):
-    '''Product-moment correlation for two ndarrays x, y'''
-    from sklearn.preprocessing import StandardScaler
-    x = StandardScaler().fit_transform(x)
-    y = StandardScaler().fit_transform(y)
-    n = x.shape[0]
-    r = (1/(n-1))*(x*y).sum(axis=0)
-    return r
+from sklearn.utils import check_X_y, check_array, check_consistent_length
+from sklearn.utils.validation import check_is_fitted, has_fit_parameter
+from sklearn.base import RegressorMixin, BaseEstimator
+from .preprocessing import LaggedDesign
+
+def product_moment_corr(x, y, dtype=np.float64, chunk_size=10000):
+    '''Product-moment correlation for two ndarrays x, y
+
+    The correlation is computed column-wise in one pass over chunks of chunk_size columns
+    in the precision given by dtype. Columns with zero variance have a correlation of zero.'''
+    return CorrelationAccumulator(dtype=dtype, chunk_size=chunk_size).update(x, y).correlation()
+
+class CorrelationAccumulator(object):
+    '''Accumulates the sufficient statistics of the column-wise product-moment correlation
+    over batches of samples, e.g. the predictions for the test sets of several folds
+
+    Parameters
+
+        dtype : numpy dtype, optional, default np.float64
+                precision in which each batch is processed, statistics are accumulated in float64
+        chunk_size : int, optional, default 10000
+                     number of columns processed at once
+    '''
+    def __init__(self, dtype=np.float64, chunk_size=10000):
+        self.dtype = dtype
+        self.chunk_size = chunk_size
+        self.n = 0
+
+    def update(self, x, y):
+        '''Adds the samples (rows) of the ndarrays x, y of shape (samples, columns) and returns self'''
+        if x.shape != y.shape:
+            raise ValueError('x and y need to have the same shape, but have shapes {} and {}.'.format(
+                x.shape, y.shape))
+        n_columns = x.shape[1]
+        stats = np.zeros((5, n_columns))
+        for start in range(0, n_columns, self.chunk_size):
+            chunk = slice(start, start + self.chunk_size)
+            x_chunk = np.asarray(x[:, chunk], dtype=self.dtype)
+            y_chunk = np.asarray(y[:, chunk], dtype=self.dtype)
+            stats[0, chunk] = x_chunk.mean(axis=0)
+            stats[1, chunk] = y_chunk.mean(axis=0)
+            x_chunk = x_chunk - stats[0, chunk].astype(self.dtype)
+            y_chunk = y_chunk - stats[1, chunk].astype(self.dtype)
+            stats[2, chunk] = np.einsum('ij,ij->j', x_chunk, x_chunk)
+            stats[3, chunk] = np.einsum('ij,ij->j', y_chunk, y_chunk)
+            stats[4, chunk] = np.einsum('ij,ij->j', x_chunk, y_chunk)
+        return self._combine(x.shape[0], stats)
+
+    def merge(self, other):
+        '''Adds the statistics accumulated by another CorrelationAccumulator and returns self'''
+        if other.n == 0:
+            return self
+        return self._combine(other.n, np.vstack([other.mean_x, other.mean_y,
+                                                 other.ss_x, other.ss_y, other.ss_xy]))
+
+    def _combine(self, n, stats):
+        '''Combines the centered statistics of n new samples with the accumulated ones'''
+        if self.n == 0:
+            self.n = n
+            self.mean_x, self.mean_y, self.ss_x, self.ss_y, self.ss_xy = stats
+            return self
+        n_total = self.n + n
+        delta_x, delta_y = stats[0] - self.mean_x, stats[1] - self.mean_y
+        weight = self.n * n / n_total
+        self.ss_x = self.ss_x + stats[2] + delta_x**2 * weight
+        self.ss_y = self.ss_y + stats[3] + delta_y**2 * weight
+        self.ss_xy = self.ss_xy + stats[4] + delta_x * delta_y * weight
+        self.mean_x = self.mean_x + delta_x * n / n_total
+        self.mean_y = self.mean_y + delta_y * n / n_total
+        self.n = n_total
+        return self
+
+    def correlation(self):
+        '''Returns the product-moment correlation of all accumulated samples per column'''
+        denominator = np.sqrt(self.ss_x * self.ss_y)
+        r = np.zeros_like(denominator)
+        np.divide(self.ss_xy, denominator, out=r, where=denominator > 0)
+        return r
 
 # Cell
 
 def get_model_plus_scores(X, y, estimator=None, cv=None, scorer=None,
-                          voxel_selection=True, validate=True, **kwargs):
+                          voxel_selection=True, validate=True, return_alphas=False,
+                          n_jobs=1, backend=None, concatenate_folds=False,
+                          model_store=None, model_store_dtype=np.float64, reduction=None, screening=None,
+                          checkpoint_dir=None, groups=None, **kwargs):
     '''Returns multiple estimator trained in a cross-validation on n_splits of the data and scores on the left-out folds
 
     Parameters
 
-        X : ndarray of shape (samples, features)
+        X : ndarray or LaggedDesign of shape (samples, features)
         y : ndarray of shape (samples, targets)
         estimator : None or estimator object that implements fit and predict
-                    if None, uses RidgeCV per default
+                    if None, uses SVDRidgeCV per default
         cv : int, None, or a cross-validation object that implements a split method, default is None, optional.
              int specifies the number of cross-validation splits of a KFold cross validation
              None defaults to a scikit-learn KFold cross-validation with default settings
-             a scikit-learn-like cross-validation object needs to implement a split method for X and y
+             if groups is given with at least two runs, None and int use LeaveOneGroupOut, so that the folds follow the runs
+             a scikit-learn-like cross-validation object needs to implement a split method for X, y, and groups
         scorer : None or any sci-kit learn compatible scoring function, optional
                  default uses product moment correlation
         voxel_selection : bool, optional, default True
@@ -50,40 +127,1236 @@ def get_model_plus_scores(X, y, estimator=None, cv=None, scorer=None,
                      Whether to validate the model via cross-validation
                      or to just train the estimator
                      if False, scores will be computed on the training set
-        kwargs : additional parameters that will be used to initialize RidgeCV if estimator is None
+        return_alphas : bool, optional, default False
+                        Whether to additionally return the regularization parameter
+                        chosen for each voxel, requires an estimator with an alpha_ attribute
+        n_jobs : int, optional, default 1
+                 The number of cross-validation folds to fit in parallel, -1 uses all cores.
+                 X and y are memory-mapped once and shared by all workers
+                 and the available BLAS threads are divided between the workers.
+        backend : None or str, optional, default None
+                  The joblib backend used to run the folds in parallel, None uses joblib's default backend
+        concatenate_folds : bool, optional, default False
+                            Whether to compute one product moment correlation for the concatenated
+                            out-of-fold predictions instead of one score per fold.
+                            Scores are then of shape (targets, 1), requires the default scorer
+        model_store : None or str, optional, default None
+                      Directory of a ModelStore to which the coefficients, intercepts, and alphas of each
+                      fold are written as soon as the fold is trained, instead of keeping all estimators in memory.
+                      Requires an estimator with coef_ and intercept_ attributes.
+        model_store_dtype : numpy dtype, optional, default np.float64
+                            dtype of the arrays in the model store, e.g. np.float32 to halve its size
+        reduction : None or dict, optional, default None
+                    parameters of a ReducedEstimator (method, n_components, random_state) that wraps the estimator,
+                    so that it is trained on a lower-dimensional projection that is learned on each training fold
+        screening : None or dict, optional, default None
+                    parameters of a ScreenedEstimator (threshold or top_k, alpha, test_size) that wraps the estimator,
+                    so that it is only trained for the voxels that a cheap model predicts well on each training fold.
+                    The other voxels are predicted as zero, so their scores (and alphas) are zero.
+        checkpoint_dir : None or str, optional, default None
+                         Directory to which the model and scores of each cross-validation fold are written
+                         as soon as the fold is trained. When called again with the same X, y, estimator, scorer,
+                         and folds, which is verified by a hash of them, these folds are loaded instead of trained.
+        groups : None or ndarray of shape (samples,), optional, default None
+                 run of every sample, which is passed to the split method of cv and, for the training samples,
+                 to the fit method of estimators that accept groups, e.g. RunwiseRidgeCV to select alphas
+                 by leave-one-run-out cross-validation
+        kwargs : additional parameters that will be used to initialize SVDRidgeCV if estimator is None.
+                 If they contain parameters that only sklearn's RidgeCV accepts (e.g. gcv_mode or scoring),
+                 RidgeCV is initialized instead, as in earlier versions.
     Returns
         tuple of n_splits estimators trained on training folds or single estimator if validation is False
-        and scores for all concatenated out-of-fold predictions'''
+        (or the ModelStore containing them if model_store is given)
+        and scores for each fold or for all concatenated out-of-fold predictions if concatenate_folds is True
+        if return_alphas is True, the chosen alphas are appended in the same shape as the scores'''
     from sklearn.utils.estimator_checks import check_regressor_multioutput
+    if concatenate_folds and scorer is not None:
+        raise ValueError('concatenate_folds is only supported for the default scorer.')
     if scorer is None:
         scorer = product_moment_corr
-    if cv is None:
-        cv = KFold()
-    if isinstance(cv, int):
-        cv = KFold(n_splits=cv)
+    if groups is not None:
+        groups = np.asarray(groups)
+    cv = _check_cv(cv, groups)
     models = []
     score_list = []
+    alpha_list = []
     if estimator is None:
-        estimator = RidgeCV(**kwargs)
+        estimator = _default_estimator(**kwargs)
+    if reduction is not None:
+        estimator = ReducedEstimator(estimator, **reduction)
+    if screening is not None:
+        # voxels are screened on the training data of each fold, never on its test data
+        estimator = ScreenedEstimator(estimator, **screening)
 
     if voxel_selection:
         voxel_var = np.var(y, axis=0)
         y = y[:, voxel_var > 0.]
+    if model_store is not None:
+        ModelStore.create(model_store, cv.get_n_splits(X, y, groups) if validate else 1, X.shape[1],
+                          voxel_var > 0. if voxel_selection else np.ones(y.shape[1], dtype=bool),
+                          dtype=model_store_dtype)
     if validate:
-        for train, test in cv.split(X, y):
-            models.append(copy.deepcopy(estimator).fit(X[train], y[train]))
-            if voxel_selection:
-                scores = np.zeros_like(voxel_var)
-                scores[voxel_var > 0.] =  scorer(y[test], models[-1].predict(X[test]))
+        n_workers = effective_n_jobs(n_jobs)
+        n_threads = max(1, cpu_count() // n_workers) if n_workers > 1 else None
+        fold_scorer = _correlation_statistics if concatenate_folds else scorer
+        splits = list(cv.split(X, y, groups))
+        fold_hashes = [None] * len(splits)
+        checkpoints = {}
+        if checkpoint_dir is not None:
+            os.makedirs(checkpoint_dir, exist_ok=True)
+            input_hash = joblib.hash((X, y, estimator, fold_scorer, groups))
+            fold_hashes = [joblib.hash((input_hash, train, test)) for train, test in splits]
+            for fold, fold_hash in enumerate(fold_hashes):
+                checkpoint = _load_checkpoint(checkpoint_dir, fold, fold_hash)
+                if checkpoint is not None:
+                    checkpoints[fold] = checkpoint
+        trained = iter(Parallel(n_jobs=n_jobs, backend=backend, mmap_mode='r')(
+            delayed(_fit_and_score_fold)(estimator, X, y, train, test, fold_scorer, n_threads,
+                                         model_store, fold, checkpoint_dir, fold_hashes[fold], groups)
+            for fold, (train, test) in enumerate(splits) if fold not in checkpoints))
+        folds = [checkpoints[fold] if fold in checkpoints else next(trained) for fold in range(len(splits))]
+        if model_store is not None and checkpoints:
+            # the store was created anew, so the models of loaded folds are written to it again
+            store = ModelStore(model_store, mmap_mode='r+')
+            for fold in checkpoints:
+                store.write_fold(fold, folds[fold][0])
+            store.flush()
+        models = [model for model, _ in folds]
+        if concatenate_folds:
+            statistics = CorrelationAccumulator()
+            for _, fold_statistics in folds:
+                statistics.merge(fold_statistics)
+            fold_scores = [statistics.correlation()]
+        else:
+            fold_scores = [scores for _, scores in folds]
+        for scores in fold_scores:
+            score_list.append(_fill_selected(scores, voxel_var if voxel_selection else None)[:, None])
+        if model_store is not None:
+            models = ModelStore(model_store)
+        if return_alphas:
+            if model_store is not None:
+                # alphas are read from the store since the models are not kept in memory
+                alpha_list = [_fill_selected(alphas, voxel_var if voxel_selection else None)[:, None]
+                              for alphas in models.alpha]
             else:
-                scores = scorer(y[test], models[-1].predict(X[test]))
-            score_list.append(scores[:, None])
+                alpha_list = [_get_alphas(model, y.shape[1], voxel_var if voxel_selection else None)[:, None]
+                              for model in models]
         score_list = np.concatenate(score_list, axis=-1)
     else:
-        models = estimator.fit(X, y)
+        models = estimator.fit(X, y, **_groups_fit_params(estimator, groups))
         score_list = scorer(y, estimator.predict(X))
+        if return_alphas:
+            alpha_list = _get_alphas(models, y.shape[1], voxel_var if voxel_selection else None)
+        if model_store is not None:
+            store = ModelStore(model_store, mmap_mode='r+')
+            store.write_fold(0, models)
+            store.flush()
+            models = ModelStore(model_store)
+    if return_alphas:
+        if validate:
+            alpha_list = np.concatenate(alpha_list, axis=-1)
+        return models, score_list, alpha_list
     return models, score_list
 
+def screen_voxels(X, y, threshold=None, top_k=None, alpha=1., test_size=0.2):
+    '''Selects voxels that a ridge regression with a single alpha predicts well on a held-out part of the data
+
+    This is much cheaper than the cross-validation with an alpha per voxel in get_model_plus_scores
+    and can be used to only train those models for voxels that respond to the stimulus.
+
+    Parameters
+
+        X : ndarray or LaggedDesign of shape (samples, features)
+        y : ndarray of shape (samples, targets)
+        threshold : None or float, optional, default None
+                    minimum product moment correlation of a selected voxel
+        top_k : None or int, optional, default None
+                number of voxels with the highest correlation that are selected
+        alpha : float, optional, default 1.
+                regularization parameter of the ridge regression
+        test_size : float, optional, default 0.2
+                    fraction of samples at the end of the data that is held out to compute the correlation
+
+    Returns
+        boolean ndarray of shape (targets,) indicating the selected voxels,
+        ndarray of shape (targets,) of the correlations on the held-out samples
+    '''
+    if (threshold is None) == (top_k is None):
+        raise ValueError('Either threshold or top_k needs to be specified.')
+    # the held-out samples are at the end, since neighboring samples are correlated
+    n_train = int(np.round(X.shape[0] * (1. - test_size)))
+    model = SVDRidgeCV(alphas=[alpha]).fit(X[:n_train], y[:n_train])
+    scores = np.nan_to_num(product_moment_corr(y[n_train:], model.predict(X[n_train:])))
+    if threshold is not None:
+        keep = scores > threshold
+    else:
+        keep = np.zeros(y.shape[1], dtype=bool)
+        keep[np.argsort(scores)[::-1][:top_k]] = True
+    return keep, scores
+
+class ScreenedEstimator(RegressorMixin, BaseEstimator):
+    """Estimator trained only for the voxels that screen_voxels selects on the training data
+    Used within get_model_plus_scores, the voxels are selected on each training fold,
+    so that the test fold does not influence which voxels are modeled.
+    Voxels that are not selected are predicted as zero and have coefficients, intercepts, and alphas of zero,
+    so the model covers all voxels like the estimator. If no voxel is selected, the estimator is not fitted
+    and all voxels are predicted as zero.
+
+    Parameters
+
+        estimator : None or estimator object that implements fit and predict, optional, default=None
+            Estimator fitted on the selected voxels, None uses SVDRidgeCV.
+        threshold : None or float, optional, default=None
+            Minimum held-out correlation of a selected voxel, see screen_voxels.
+        top_k : None or int, optional, default=None
+            Number of voxels with the highest held-out correlation that are selected, see screen_voxels.
+        alpha : float, optional, default=1.
+            Regularization parameter of the screening model.
+        test_size : float, optional, default=0.2
+            Fraction of samples at the end of the training data that is held out for screening.
+    """
+
+    def __init__(self, estimator=None, threshold=None, top_k=None, alpha=1., test_size=0.2):
+        self.estimator = estimator
+        self.threshold = threshold
+        self.top_k = top_k
+        self.alpha = alpha
+        self.test_size = test_size
+
+    def fit(self, X, y):
+        """Select the voxels and fit the estimator on them.
+
+        Parameters
+
+            X : array-like or LaggedDesign, shape (n_samples, n_features)
+                Data.
+            y : array-like, shape (n_samples, n_targets)
+                Targets.
+
+        Returns
+
+            self : object
+                Returns self
+        """
+        X, y = _check_X_y(X, y)
+        self.keep_, self.screening_scores_ = screen_voxels(X, y, threshold=self.threshold, top_k=self.top_k,
+                                                           alpha=self.alpha, test_size=self.test_size)
+        self.n_features_in_ = X.shape[1]
+        estimator = SVDRidgeCV() if self.estimator is None else self.estimator
+        self.estimator_ = copy.deepcopy(estimator).fit(X, y[:, self.keep_]) if self.keep_.any() else None
+        return self
+
+    def predict(self, X):
+        """Predict the selected voxels using the estimator and all other voxels as zero.
+
+        Parameters
+
+            X : array-like or LaggedDesign, shape (n_samples, n_features)
+                Data.
+
+        Returns
+
+            y : ndarray, shape (n_samples, n_targets)
+                Predicted targets.
+        """
+        check_is_fitted(self, 'estimator_')
+        if self.estimator_ is None:
+            return np.zeros((X.shape[0], self.keep_.shape[0]))
+        prediction = self.estimator_.predict(X)
+        return self._fill_kept(prediction.reshape((prediction.shape[0], -1)).T).T
+
+    @property
+    def coef_(self):
+        """Coefficients of the estimator, zero for voxels that were not selected."""
+        if self.estimator_ is None:
+            return np.zeros((self.keep_.shape[0], self.n_features_in_))
+        coef = np.asarray(self.estimator_.coef_)
+        return self._fill_kept(coef.reshape((-1, coef.shape[-1])))
+
+    @property
+    def intercept_(self):
+        """Intercept of the estimator, zero for voxels that were not selected."""
+        if self.estimator_ is None:
+            return np.zeros(self.keep_.shape[0])
+        return self._fill_kept(np.broadcast_to(self.estimator_.intercept_, (int(self.keep_.sum()),)))
+
+    @property
+    def alpha_(self):
+        """Regularization parameter chosen by the estimator, zero for voxels that were not selected."""
+        if self.estimator_ is None:
+            return np.zeros(self.keep_.shape[0])
+        return self._fill_kept(np.broadcast_to(self.estimator_.alpha_, (int(self.keep_.sum()),)))
+
+    def _fill_kept(self, values):
+        """Returns values of the selected voxels (along the first axis) for all voxels, zero for the others"""
+        all_values = np.zeros((self.keep_.shape[0],) + values.shape[1:], dtype=np.result_type(values, np.float64))
+        all_values[self.keep_] = values
+        return all_values
+
+def _default_estimator(**kwargs):
+    '''Returns SVDRidgeCV initialized with kwargs, or RidgeCV if kwargs contain parameters only RidgeCV accepts'''
+    ridge_cv_parameters = sorted(set(kwargs) - set(SVDRidgeCV().get_params()))
+    if ridge_cv_parameters:
+        warnings.warn('{} are only supported by RidgeCV, which is used instead of SVDRidgeCV.'.format(
+            ', '.join(ridge_cv_parameters)))
+        return RidgeCV(**kwargs)
+    return SVDRidgeCV(**kwargs)
+
+def _fit_and_score_fold(estimator, X, y, train, test, scorer, n_threads=None,
+                        model_store=None, fold=None, checkpoint_dir=None, fold_hash=None, groups=None):
+    '''Fits a copy of estimator on the training fold and scores it on the test fold, using at most n_threads BLAS threads
+
+    If checkpoint_dir is given, the model and scores are saved there with fold_hash.
+    If model_store is given, the model is written to the store as fold and None is returned instead of the model'''
+    with threadpool_limits(limits=n_threads, user_api='blas'):
+        model = copy.deepcopy(estimator).fit(
+            X[train], y[train], **_groups_fit_params(estimator, groups[train] if groups is not None else None))
+        scores = scorer(y[test], model.predict(X[test]))
+    if checkpoint_dir is not None:
+        _save_checkpoint(checkpoint_dir, fold, fold_hash, model, scores)
+    if model_store is not None:
+        store = ModelStore(model_store, mmap_mode='r+')
+        store.write_fold(fold, model)
+        store.flush()
+        model = None
+    return model, scores
+
+def _check_cv(cv, groups=None):
+    '''Returns the cross-validation object for cv, which leaves one group out if cv is None or an int
+    and groups contain at least two groups, and is a KFold otherwise'''
+    if (cv is None or isinstance(cv, int)) and groups is not None and np.unique(groups).shape[0] > 1:
+        # no run is part of both the training and the test data of a fold
+        return LeaveOneGroupOut()
+    if cv is None:
+        return KFold()
+    if isinstance(cv, int):
+        return KFold(n_splits=cv)
+    return cv
+
+def _groups_fit_params(estimator, groups):
+    '''Returns the groups as fit parameters if they are given and estimator accepts them'''
+    if groups is None or not has_fit_parameter(estimator, 'groups'):
+        return {}
+    return {'groups': groups}
+
+def _checkpoint_file(checkpoint_dir, fold):
+    '''Returns the path of the checkpoint of fold in checkpoint_dir'''
+    return os.path.join(checkpoint_dir, 'fold-{}.pkl'.format(fold))
+
+def _save_checkpoint(checkpoint_dir, fold, fold_hash, model, scores):
+    '''Saves the model and scores of fold together with fold_hash, the file is replaced atomically'''
+    checkpoint_file = _checkpoint_file(checkpoint_dir, fold)
+    joblib.dump({'hash': fold_hash, 'model': model, 'scores': scores}, checkpoint_file + '.tmp')
+    os.replace(checkpoint_file + '.tmp', checkpoint_file)
+
+def _load_checkpoint(checkpoint_dir, fold, fold_hash):
+    '''Returns the model and scores of fold if they were saved with fold_hash, None otherwise'''
+    checkpoint_file = _checkpoint_file(checkpoint_dir, fold)
+    if not os.path.exists(checkpoint_file):
+        return None
+    checkpoint = joblib.load(checkpoint_file)
+    if checkpoint['hash'] != fold_hash:
+        return None
+    return checkpoint['model'], checkpoint['scores']
+
+def _correlation_statistics(y_true, y_pred):
+    '''Returns a CorrelationAccumulator for y_true and y_pred'''
+    return CorrelationAccumulator().update(y_true, y_pred)
+
+def _get_alphas(model, n_targets, voxel_var=None):
+    '''Returns the regularization parameter of model per target, zero for voxels removed by voxel selection'''
+    if not hasattr(model, 'alpha_'):
+        raise ValueError('return_alphas requires an estimator with an alpha_ attribute.')
+    return _fill_selected(np.broadcast_to(model.alpha_, (n_targets,)), voxel_var)
+
+def _fill_selected(values, voxel_var=None):
+    '''Returns values for all voxels, zero for voxels removed by voxel selection'''
+    if voxel_var is None:
+        return np.array(values, dtype=float)
+    all_values = np.zeros_like(voxel_var)
+    all_values[voxel_var > 0.] = values
+    return all_values
+
+# Cell
+
+class SVDRidgeCV(RegressorMixin, BaseEstimator):
+    """Ridge regression with efficient leave-one-out selection of the regularization parameter per target
+    The training data is decomposed once with a singular value decomposition,
+    the leave-one-out error of every value in `alphas` is then computed for all targets
+    using only matrix products with the decomposition.
+    If there are more features than samples, the eigendecomposition of the
+    (n_samples, n_samples) Gram matrix is used instead (kernel ridge regression).
+
+    Parameters
+
+        alphas : array-like of shape (n_alphas,), optional, default=(0.1, 1.0, 10.0)
+            Values of the regularization parameter to try.
+        fit_intercept : bool, optional, default=True
+            Whether to fit an (unpenalized) intercept.
+        alpha_per_target : bool, optional, default=True
+            Whether to select the best alpha for each target independently
+            or a single alpha for all targets.
+        solver : {'auto', 'svd', 'eigen'}, optional, default='auto'
+            'svd' uses the singular value decomposition of X,
+            'eigen' uses the eigendecomposition of the Gram matrix X X^T,
+            'auto' uses 'eigen' if there are more features than samples and 'svd' otherwise.
+    """
+
+    def __init__(self, alphas=(0.1, 1.0, 10.0), fit_intercept=True, alpha_per_target=True,
+                 solver='auto'):
+        self.alphas = alphas
+        self.fit_intercept = fit_intercept
+        self.alpha_per_target = alpha_per_target
+        self.solver = solver
+
+    def fit(self, X, y):
+        """Fit the ridge regressions and select the regularization parameter for each target.
+
+        Parameters
+
+            X : array-like or LaggedDesign, shape (n_samples, n_features)
+                Data, a LaggedDesign is decomposed without materializing it.
+            y : array-like, shape (n_samples, n_targets)
+                Targets.
+
+        Returns
+
+            self : object
+                Returns self
+        """
+        X, y = _check_X_y(X, y)
+        # one decomposition for all alphas and targets
+        decomposition, X_offset = _center_and_decompose(X, self.fit_intercept, self.solver)
+        return self._fit_decomposition(decomposition, X_offset, y)
+
+    def _hat_diagonals(self, decomposition):
+        """Returns the diagonals of the hat matrices of all alphas of shape (n_alphas, n_samples),
+        which only depend on the decomposition and can be shared by several calls of _fit_decomposition"""
+        alphas = np.atleast_1d(np.asarray(self.alphas, dtype=float))
+        if np.any(alphas <= 0):
+            raise ValueError('alphas need to be strictly positive.')
+        U, s_sq, _ = decomposition
+        hat_diags = (U**2).dot((s_sq / (s_sq + alphas[:, None])).T).T
+        if self.fit_intercept:
+            hat_diags += 1. / U.shape[0]
+        return hat_diags
+
+    def _fit_decomposition(self, decomposition, X_offset, y, hat_diags=None):
+        """Fits the ridge regressions for the targets y given the decomposition of the centered training data
+
+        decomposition is the output of _decompose and can be shared by several calls with different targets,
+        as can hat_diags, the output of _hat_diagonals, which is computed if it is None."""
+        if hat_diags is None:
+            hat_diags = self._hat_diagonals(decomposition)
+        alphas = np.atleast_1d(np.asarray(self.alphas, dtype=float))
+        single_target = y.ndim == 1
+        if single_target:
+            y = y[:, None]
+        U, s_sq, XTU = decomposition
+        if self.fit_intercept:
+            y_offset = y.mean(axis=0)
+            y = y - y_offset
+        else:
+            y_offset = np.zeros(y.shape[1])
+
+        UTy = U.T.dot(y)
+
+        loo_errors = np.empty((alphas.shape[0], y.shape[1]))
+        for i, alpha in enumerate(alphas):
+            shrinkage = s_sq / (s_sq + alpha)
+            residuals = (y - U.dot(shrinkage[:, None] * UTy)) / (1. - hat_diags[i])[:, None]
+            loo_errors[i] = (residuals**2).mean(axis=0)
+
+        if self.alpha_per_target:
+            best = np.argmin(loo_errors, axis=0)
+        else:
+            best = np.full(y.shape[1], np.argmin(loo_errors.mean(axis=1)))
+        self.alpha_ = alphas[best]
+        self.best_score_ = -loo_errors[best, np.arange(y.shape[1])]
+
+        # coefficients with the selected alpha of every target
+        coef = XTU.dot(UTy / (s_sq[:, None] + self.alpha_[None])).T
+        intercept = y_offset - coef.dot(X_offset)
+        if single_target:
+            coef, intercept = coef[0], intercept[0]
+            self.alpha_, self.best_score_ = self.alpha_[0], self.best_score_[0]
+        elif not self.alpha_per_target:
+            self.alpha_ = self.alpha_[0]
+        self.coef_, self.intercept_ = coef, intercept
+        return self
+
+    def predict(self, X):
+        """Predict using the fitted ridge regressions.
+
+        Parameters
+
+            X : array-like, shape (n_samples, n_features)
+                Data.
+
+        Returns
+
+            y : ndarray, shape (n_samples, n_targets)
+                Predicted targets.
+        """
+        check_is_fitted(self, 'coef_')
+        X = _check_X(X)
+        return X.dot(self.coef_.T) + self.intercept_
+
+def _decompose(X, solver='auto'):
+    '''Returns U, squared singular values, and X^T U of the centered X using the primal or kernel form'''
+    if solver not in ('auto', 'svd', 'eigen'):
+        raise ValueError("solver needs to be either 'auto', 'svd', or 'eigen'.")
+    if solver == 'eigen' or (solver == 'auto' and X.shape[1] > X.shape[0]):
+        s_sq, U = np.linalg.eigh(X.dot(X.T))
+        # clip small negative eigenvalues due to numerical errors
+        s_sq = np.maximum(s_sq, 0.)
+        return U, s_sq, X.T.dot(U)
+    U, s, Vt = np.linalg.svd(X, full_matrices=False)
+    return U, s**2, Vt.T * s
+
+def _decompose_design(X, X_offset, solver='auto'):
+    '''Returns the decomposition of _decompose for the LaggedDesign or sparse X centered by X_offset using only products with X'''
+    if solver not in ('auto', 'svd', 'eigen'):
+        raise ValueError("solver needs to be either 'auto', 'svd', or 'eigen'.")
+    n_samples = X.shape[0]
+    if solver == 'eigen' or (solver == 'auto' and X.shape[1] > n_samples):
+        X_mean = X.dot(X_offset)
+        kernel = _kernel(X) - X_mean[:, None] - X_mean[None] + X_offset.dot(X_offset)
+        s_sq, U = np.linalg.eigh(kernel.astype(np.float64))
+        s_sq = np.maximum(s_sq, 0.)
+        return U, s_sq, _tdot(X, U) - np.outer(X_offset, U.sum(axis=0))
+    # the singular value decomposition from the eigendecomposition of X^T X
+    gram = _gram(X).astype(np.float64) - n_samples * np.outer(X_offset, X_offset)
+    s_sq, V = np.linalg.eigh(gram)
+    # components without variance do not contribute to the ridge solution
+    keep = s_sq > s_sq.max() * gram.shape[0] * np.finfo(gram.dtype).eps
+    s_sq, V = s_sq[keep], V[:, keep]
+    s = np.sqrt(s_sq)
+    return (X.dot(V) - X_offset.dot(V)) / s, s_sq, V * s
+
+def _center_and_decompose(X, fit_intercept=True, solver='auto'):
+    '''Returns the decomposition of the centered X (see _decompose) and the offset of X'''
+    if isinstance(X, LaggedDesign) or sparse.issparse(X):
+        # centering would materialize X, so it is only centered implicitly
+        X_mean = np.asarray(X.mean(axis=0)).ravel()
+        if not np.all(np.isfinite(X_mean)):
+            raise ValueError('Input contains NaN or infinity.')
+        X_offset = X_mean if fit_intercept else np.zeros(X.shape[1])
+        return _decompose_design(X, X_offset, solver), X_offset
+    if fit_intercept:
+        X_offset = X.mean(axis=0)
+        X = X - X_offset
+    else:
+        X_offset = np.zeros(X.shape[1])
+    return _decompose(X, solver), X_offset
+
+def _check_X_y(X, y):
+    '''Validates X and y like check_X_y, but keeps a LaggedDesign X as it is and accepts a sparse X'''
+    if isinstance(X, LaggedDesign):
+        y = check_array(y, ensure_2d=False)
+        check_consistent_length(X, y)
+        return X, y
+    return check_X_y(X, y, accept_sparse=['csr', 'csc'], multi_output=True, y_numeric=True)
+
+def _check_X(X):
+    '''Validates X like check_array, but keeps a LaggedDesign X as it is and accepts a sparse X'''
+    return X if isinstance(X, LaggedDesign) else check_array(X, accept_sparse=['csr', 'csc'])
+
+def _gram(X):
+    '''Returns X^T X of a LaggedDesign or sparse X as ndarray'''
+    return X.gram() if isinstance(X, LaggedDesign) else X.T.dot(X).toarray()
+
+def _kernel(X):
+    '''Returns X X^T of a LaggedDesign or sparse X as ndarray'''
+    return X.kernel() if isinstance(X, LaggedDesign) else X.dot(X.T).toarray()
+
+def _tdot(X, y):
+    '''Returns X^T y of a LaggedDesign or sparse X as ndarray'''
+    return X.tdot(y) if isinstance(X, LaggedDesign) else X.T.dot(y)
+
+# Cell
+
+def get_group_model_plus_scores(X, ys, cv=None, scorer=None, voxel_selection=True, validate=True,
+                                return_alphas=False, groups=None, **kwargs):
+    '''Trains SVDRidgeCV models for several subjects that share the same stimulus X and returns models and scores per subject
+
+    X is decomposed only once per fold and the decomposition and the hat matrix diagonals of the alphas
+    are used to fit the voxels of all subjects, so that fitting N subjects costs one decomposition plus N cheap solves.
+
+    Parameters
+
+        X : ndarray or LaggedDesign of shape (samples, features), the stimulus shared by all subjects
+        ys : list of ndarrays of shape (samples, targets), the fMRI data of each subject aligned with X,
+             the number of targets can differ between subjects
+        cv : int, None, or a cross-validation object that implements a split method, default is None, optional.
+             int specifies the number of cross-validation splits of a KFold cross validation
+             None defaults to a scikit-learn KFold cross-validation with default settings
+             if groups is given with at least two runs, None and int use LeaveOneGroupOut, so that the folds follow the runs
+        scorer : None or any sci-kit learn compatible scoring function, optional
+                 default uses product moment correlation
+        voxel_selection : bool, optional, default True
+                          Whether to only use voxels with variance larger than zero.
+                          This will set scores for these voxels to zero.
+        validate : bool, optional, default True
+                     Whether to validate the model via cross-validation
+                     or to just train the estimator
+                     if False, scores will be computed on the training set
+        return_alphas : bool, optional, default False
+                        Whether to additionally return the regularization parameter chosen for each voxel
+        groups : None or ndarray of shape (samples,), optional, default None
+                 run of every sample, which is passed to the split method of cv
+        kwargs : additional parameters that will be used to initialize SVDRidgeCV,
+                 other parameters, e.g. those of get_model_plus_scores in an encoding config, are ignored
+    Returns
+        list with the output of get_model_plus_scores for each subject, i.e. tuples of
+        the n_splits SVDRidgeCV models (or single model if validation is False), the scores,
+        and the alphas if return_alphas is True'''
+    if scorer is None:
+        scorer = product_moment_corr
+    if groups is not None:
+        groups = np.asarray(groups)
+    cv = _check_cv(cv, groups)
+    X = _check_X(X)
+    for y in ys:
+        if y.shape[0] != X.shape[0]:
+            raise ValueError('All subjects need to have as many samples as X ({}), but got {}.'.format(
+                X.shape[0], y.shape[0]))
+    svd_ridge_params = SVDRidgeCV().get_params()
+    estimator = SVDRidgeCV(**{key: value for key, value in kwargs.items() if key in svd_ridge_params})
+    voxel_vars = [np.var(y, axis=0) if voxel_selection else None for y in ys]
+    if voxel_selection:
+        ys = [y[:, voxel_var > 0.] for y, voxel_var in zip(ys, voxel_vars)]
+
+    splits = list(cv.split(X, groups=groups)) if validate else [(np.arange(X.shape[0]), None)]
+    models = [[] for _ in ys]
+    scores = [[] for _ in ys]
+    for train, test in splits:
+        # one decomposition of the stimulus for all subjects
+        decomposition, X_offset = _center_and_decompose(X[train], estimator.fit_intercept, estimator.solver)
+        hat_diags = estimator._hat_diagonals(decomposition)
+        # without validation, the models are scored on the training set
+        test = train if test is None else test
+        for i, y in enumerate(ys):
+            model = copy.deepcopy(estimator)._fit_decomposition(
+                decomposition, X_offset, np.asarray(y[train], dtype=float), hat_diags)
+            models[i].append(model)
+            scores[i].append(_fill_selected(scorer(y[test], model.predict(X[test])), voxel_vars[i]))
+
+    results = []
+    for subject_models, subject_scores, voxel_var in zip(models, scores, voxel_vars):
+        if validate:
+            result = (subject_models, np.stack(subject_scores, axis=-1))
+        else:
+            result = (subject_models[0], subject_scores[0])
+        if return_alphas:
+            alphas = [_get_alphas(model, model.coef_.shape[0], voxel_var) for model in subject_models]
+            result += (np.stack(alphas, axis=-1) if validate else alphas[0],)
+        results.append(result)
+    return results
+
+# Cell
+
+class ModelStore(object):
+    """Compact, memory-mapped store of the linear models trained in all cross-validation folds
+    The store is a directory containing the arrays
+
+        coef.npy : coefficients of shape (n_folds, n_voxels, n_features)
+        intercept.npy : intercepts of shape (n_folds, n_voxels)
+        alpha.npy : regularization parameters of shape (n_folds, n_voxels), nan if the estimator has no alpha_
+        voxel_mask.npy : boolean mask of shape (n_all_voxels,) of the voxels kept by the voxel selection
+
+    where n_voxels is the number of voxels in voxel_mask.
+    All arrays are memory-mapped when the store is loaded.
+
+    Parameters
+
+        path : str
+            The directory of the store.
+        mmap_mode : {'r', 'r+', 'c'}, optional, default='r'
+            Mode used to memory-map the arrays.
+    """
+
+    def __init__(self, path, mmap_mode='r'):
+        self.path = path
+        self.coef = np.load(os.path.join(path, 'coef.npy'), mmap_mode=mmap_mode)
+        self.intercept = np.load(os.path.join(path, 'intercept.npy'), mmap_mode=mmap_mode)
+        self.alpha = np.load(os.path.join(path, 'alpha.npy'), mmap_mode=mmap_mode)
+        self.voxel_mask = np.load(os.path.join(path, 'voxel_mask.npy'))
+
+    @classmethod
+    def create(cls, path, n_folds, n_features, voxel_mask, dtype=np.float64):
+        """Creates an empty store for n_folds models of the voxels in voxel_mask and returns it opened for writing"""
+        os.makedirs(path, exist_ok=True)
+        n_voxels = int(np.sum(voxel_mask))
+        for name, shape in [('coef', (n_folds, n_voxels, n_features)),
+                            ('intercept', (n_folds, n_voxels)),
+                            ('alpha', (n_folds, n_voxels))]:
+            array = np.lib.format.open_memmap(os.path.join(path, name + '.npy'), mode='w+',
+                                              dtype=dtype, shape=shape)
+            if name == 'alpha':
+                array[:] = np.nan
+            array.flush()
+        np.save(os.path.join(path, 'voxel_mask.npy'), np.asarray(voxel_mask, dtype=bool))
+        return cls(path, mmap_mode='r+')
+
+    @property
+    def n_folds(self):
+        return self.coef.shape[0]
+
+    def write_fold(self, fold, model):
+        """Writes the coefficients, intercepts, and alphas of the fitted model to fold"""
+        if not (hasattr(model, 'coef_') and hasattr(model, 'intercept_')):
+            raise ValueError('A ModelStore requires an estimator with coef_ and intercept_ attributes.')
+        n_voxels = self.coef.shape[1]
+        self.coef[fold] = np.reshape(model.coef_, (n_voxels, -1))
+        self.intercept[fold] = np.broadcast_to(model.intercept_, (n_voxels,))
+        if hasattr(model, 'alpha_'):
+            self.alpha[fold] = np.broadcast_to(model.alpha_, (n_voxels,))
+
+    def flush(self):
+        """Flushes all changes to disk"""
+        for array in (self.coef, self.intercept, self.alpha):
+            if isinstance(array, np.memmap):
+                array.flush()
+
+    def predict(self, X, fold=None):
+        """Predicts the voxels in voxel_mask using the model of fold or the average prediction of all folds if fold is None
+
+        Parameters
+
+            X : array-like, shape (n_samples, n_features)
+                Data.
+            fold : None or int, optional, default=None
+                The fold whose model is used for prediction.
+
+        Returns
+
+            y : ndarray, shape (n_samples, n_all_voxels)
+                Predicted voxels, voxels not in voxel_mask are predicted as zero.
+        """
+        X = check_array(X, accept_sparse=['csr', 'csc'])
+        folds = range(self.n_folds) if fold is None else [fold]
+        prediction = np.zeros((X.shape[0], self.coef.shape[1]), dtype=np.result_type(X, self.coef))
+        for i in folds:
+            prediction += X.dot(self.coef[i].T) + self.intercept[i]
+        prediction /= len(folds)
+        all_voxels = np.zeros((X.shape[0], self.voxel_mask.shape[0]), dtype=prediction.dtype)
+        all_voxels[:, self.voxel_mask] = prediction
+        return all_voxels
+
+def save_model_store(models, path, voxel_mask=None, dtype=np.float64):
+    """Saves a list of fitted linear models (one per fold) as a ModelStore in path and returns the loaded store
+
+    Parameters
+
+        models : list of estimators with coef_ and intercept_ attributes, e.g. as returned by get_model_plus_scores
+        path : str, directory of the store
+        voxel_mask : None or boolean ndarray, optional
+                     mask of the voxels used for training, None assumes all voxels were used
+        dtype : numpy dtype, optional, default np.float64
+                dtype of the stored arrays
+    Returns
+        ModelStore
+    """
+    n_voxels, n_features = np.reshape(models[0].coef_, (-1, np.shape(models[0].coef_)[-1])).shape
+    if voxel_mask is None:
+        voxel_mask = np.ones(n_voxels, dtype=bool)
+    store = ModelStore.create(path, len(models), n_features, voxel_mask, dtype=dtype)
+    for fold, model in enumerate(models):
+        store.write_fold(fold, model)
+    store.flush()
+    return ModelStore(path)
+
+# Cell
+
+class RunwiseRidgeCV(RegressorMixin, BaseEstimator):
+    """Ridge regression computed from per-run sufficient statistics with leave-one-run-out cross-validation
+    For every run, only X^T X, X^T y, and the sums of X, y, and y**2 are kept, together with their totals over all runs.
+    Models trained on all but some runs are computed by subtracting the statistics of the left-out runs from the totals,
+    and they are validated on the left-out runs using their statistics only,
+    so adding a new run only requires to update the statistics instead of refitting on all data.
+    The regularization parameter is selected by leave-one-run-out cross-validation on the training runs.
+    In get_model_plus_scores, the runs of the training data of each fold are given by its groups parameter.
+
+    Parameters
+
+        alphas : array-like of shape (n_alphas,), optional, default=(0.1, 1.0, 10.0)
+            Values of the regularization parameter to try.
+        fit_intercept : bool, optional, default=True
+            Whether to fit an (unpenalized) intercept.
+        alpha_per_target : bool, optional, default=True
+            Whether to select the best alpha for each target independently
+            or a single alpha for all targets.
+    """
+
+    def __init__(self, alphas=(0.1, 1.0, 10.0), fit_intercept=True, alpha_per_target=True):
+        self.alphas = alphas
+        self.fit_intercept = fit_intercept
+        self.alpha_per_target = alpha_per_target
+
+    def add_run(self, X, y):
+        """Adds the statistics of a run with stimulus X of shape (n_samples, n_features)
+        and fMRI y of shape (n_samples, n_targets) and returns self.
+        Call fit() or cross_validate() without data to update the model afterwards."""
+        X, y = _check_X_y(X, y)
+        if y.ndim == 1:
+            y = y[:, None]
+        if isinstance(X, LaggedDesign) or sparse.issparse(X):
+            XTX, XTy = _gram(X), _tdot(X, y)
+        else:
+            XTX, XTy = X.T.dot(X), X.T.dot(y)
+        run_statistics = [np.array(X.shape[0], dtype=float), np.asarray(X.sum(axis=0)).ravel(), y.sum(axis=0),
+                          XTX, XTy, (y**2).sum(axis=0)]
+        if not hasattr(self, 'run_statistics_'):
+            self.run_statistics_ = [[] for _ in run_statistics]
+            self.total_statistics_ = [np.zeros_like(run_statistic) for run_statistic in run_statistics]
+        for statistics, run_statistic in zip(self.run_statistics_, run_statistics):
+            statistics.append(run_statistic)
+        self.total_statistics_ = [total + run_statistic
+                                  for total, run_statistic in zip(self.total_statistics_, run_statistics)]
+        return self
+
+    @property
+    def n_runs(self):
+        return len(self.run_statistics_[0]) if hasattr(self, 'run_statistics_') else 0
+
+    def fit(self, X=None, y=None, groups=None):
+        """Fits the model on all runs, selecting alpha by leave-one-run-out cross-validation.
+
+        Parameters
+
+            X : None or array-like, shape (n_samples, n_features)
+                Data, if None, the model is fitted on the statistics of the runs added so far.
+            y : None or array-like, shape (n_samples, n_targets)
+                Targets.
+            groups : None or array-like, shape (n_samples,)
+                Run label of every sample, if None, X and y are treated as one run.
+
+        Returns
+
+            self : object
+                Returns self
+        """
+        if X is not None:
+            self._add_runs(X, y, groups)
+        self.coef_, self.intercept_, self.alpha_ = self._fit_runs(np.arange(self.n_runs))
+        return self
+
+    def cross_validate(self, X=None, y=None, groups=None):
+        """Returns the product moment correlation of leave-one-run-out cross-validation
+        of shape (n_targets, n_runs) and stores the alphas of each fold in cv_alphas_.
+        Parameters are the same as for fit."""
+        if X is not None:
+            self._add_runs(X, y, groups)
+        if self.n_runs < 2:
+            raise ValueError('Leave-one-run-out cross-validation requires at least two runs.')
+        scores, alphas = [], []
+        for run in range(self.n_runs):
+            training = np.setdiff1d(np.arange(self.n_runs), [run])
+            coef, _, alpha = self._fit_runs(training)
+            # correlation of predictions and fMRI in the left-out run
+            _, _, _, C_xx, C_xy, C_yy = self._centered_statistics([run])
+            covariance = np.einsum('ij,ij->i', coef, C_xy.T)
+            prediction_var = np.einsum('ij,ij->i', coef.dot(C_xx), coef)
+            denominator = np.sqrt(prediction_var * C_yy)
+            r = np.zeros_like(covariance)
+            np.divide(covariance, denominator, out=r, where=denominator > 0)
+            scores.append(r[:, None])
+            alphas.append(np.broadcast_to(alpha, r.shape)[:, None])
+        self.cv_alphas_ = np.concatenate(alphas, axis=-1)
+        return np.concatenate(scores, axis=-1)
+
+    def predict(self, X):
+        """Predict using the fitted ridge regressions.
+
+        Parameters
+
+            X : array-like, shape (n_samples, n_features)
+                Data.
+
+        Returns
+
+            y : ndarray, shape (n_samples, n_targets)
+                Predicted targets.
+        """
+        check_is_fitted(self, 'coef_')
+        X = _check_X(X)
+        return X.dot(self.coef_.T) + self.intercept_
+
+    def _add_runs(self, X, y, groups):
+        """Resets the statistics and adds the runs in X, y given by groups"""
+        if hasattr(self, 'run_statistics_'):
+            del self.run_statistics_, self.total_statistics_
+        if groups is None:
+            groups = np.zeros(X.shape[0])
+        groups = np.asarray(groups)
+        for group in np.unique(groups):
+            self.add_run(X[groups == group], y[groups == group])
+
+    def _summed_statistics(self, runs):
+        """Returns the statistics summed over the runs, computed as the totals minus the left-out runs
+        if fewer runs are left out than summed, e.g. for the training runs of leave-one-run-out folds"""
+        left_out = np.setdiff1d(np.arange(self.n_runs), runs)
+        if left_out.shape[0] < len(runs):
+            return [total - np.sum([statistics[run] for run in left_out], axis=0)
+                    for total, statistics in zip(self.total_statistics_, self.run_statistics_)]
+        return [np.sum([statistics[run] for run in runs], axis=0) for statistics in self.run_statistics_]
+
+    def _centered_statistics(self, runs):
+        """Returns the number of samples, means, and centered (co)variances of the runs"""
+        n, sum_x, sum_y, xx, xy, yy = self._summed_statistics(runs)
+        if not self.fit_intercept:
+            return n, np.zeros_like(sum_x), np.zeros_like(sum_y), xx, xy, yy
+        mean_x, mean_y = sum_x / n, sum_y / n
+        return (n, mean_x, mean_y, xx - n * np.outer(mean_x, mean_x),
+                xy - n * np.outer(mean_x, mean_y), yy - n * mean_y**2)
+
+    def _fit_runs(self, runs):
+        """Returns coefficients, intercepts, and alphas of a model trained on runs,
+        alphas are selected by leave-one-run-out cross-validation within runs"""
+        alphas = np.atleast_1d(np.asarray(self.alphas, dtype=float))
+        if alphas.shape[0] > 1:
+            if len(runs) < 2:
+                raise ValueError('Selecting alpha requires at least two training runs, '
+                                 'pass the run of every sample as groups.')
+            errors = 0.
+            for run in runs:
+                errors = errors + self._validation_errors(np.setdiff1d(runs, [run]), run, alphas)
+            if self.alpha_per_target:
+                alpha = alphas[np.argmin(errors, axis=0)]
+            else:
+                alpha = np.full(errors.shape[1], alphas[np.argmin(errors.sum(axis=1))])
+        else:
+            alpha = np.full(self.run_statistics_[2][0].shape[0], alphas[0])
+        n, mean_x, mean_y, C_xx, C_xy, _ = self._centered_statistics(runs)
+        eigenvalues, V = np.linalg.eigh(C_xx)
+        coef = V.dot(V.T.dot(C_xy) / (eigenvalues[:, None] + alpha[None])).T
+        intercept = mean_y - coef.dot(mean_x)
+        if not self.alpha_per_target:
+            alpha = alpha[0]
+        return coef, intercept, alpha
+
+    def _validation_errors(self, training, validation, alphas):
+        """Returns the sum of squared errors in the validation run of shape (n_alphas, n_targets)
+        of models trained on the training runs"""
+        _, mean_x, mean_y, C_xx, C_xy, _ = self._centered_statistics(training)
+        n_val, mean_x_val, mean_y_val, C_xx_val, C_xy_val, C_yy_val = self._centered_statistics([validation])
+        eigenvalues, V = np.linalg.eigh(C_xx)
+        VTC_xy = V.T.dot(C_xy)
+        errors = np.empty((alphas.shape[0], C_xy.shape[1]))
+        for i, alpha in enumerate(alphas):
+            W = V.dot(VTC_xy / (eigenvalues[:, None] + alpha))
+            # error due to the different means of training and validation run
+            offset = (mean_y_val - mean_y) - (mean_x_val - mean_x).dot(W)
+            errors[i] = (C_yy_val - 2 * np.einsum('ij,ij->j', W, C_xy_val)
+                         + np.einsum('ij,ij->j', C_xx_val.dot(W), W) + n_val * offset**2)
+        return errors
+
+# Cell
+
+def permutation_test(X, y, models, cv=None, n_permutations=1000, block_size=1, voxel_selection=True,
+                     batch_size=50, chunk_size=1000, random_state=None, voxel_mask=None, groups=None):
+    '''Returns the null distribution and p-values of the product moment correlation of already trained encoding models
+
+    The predictions of each fold's model for its held-out set are computed once and correlated with
+    n_permutations permutations of the held-out fMRI data, computed in batches as array operations.
+    To account for the autocorrelation of fMRI data, blocks of block_size consecutive samples can be permuted.
+    Since models of different folds share training data, their scores are not independent
+    and p-values are computed for each fold separately.
+
+    Parameters
+
+        X : ndarray of shape (samples, features)
+        y : ndarray of shape (samples, targets)
+        models : list of estimators or ModelStore, as returned by get_model_plus_scores
+        cv : int, None, or a cross-validation object that implements a split method, default is None, optional.
+             needs to produce the same splits that were used to train models with get_model_plus_scores
+        n_permutations : int, optional, default 1000
+                         number of permutations per fold
+        block_size : int, optional, default 1
+                     number of consecutive samples that are permuted together
+        voxel_selection : bool, optional, default True
+                          Whether models were trained with voxel selection.
+                          Voxels with zero variance get a p-value of one.
+                          Not used if voxel_mask is given or models is a ModelStore.
+        batch_size : int, optional, default 50
+                     number of permutations computed at once
+        chunk_size : int, optional, default 1000
+                     number of voxels computed at once, memory scales with batch_size * chunk_size * test samples
+        random_state : None, int, or np.random.RandomState, optional
+        voxel_mask : None or boolean ndarray of shape (targets,), optional, default None
+                     the voxels the models were trained on, all other voxels get a p-value of one.
+                     None uses the voxel_mask of a ModelStore, or else the voxels selected by voxel_selection.
+        groups : None or ndarray of shape (samples,), optional, default None
+                 run of every sample, passed to the split method of cv and used to choose the default cv
+                 as in get_model_plus_scores, so that the folds are the ones the models were trained on
+    Returns
+        tuple of the null distribution of the correlation of shape (targets, n_splits, n_permutations)
+        and the p-values of the observed correlations of shape (targets, n_splits)'''
+    from sklearn.utils import check_random_state
+    if groups is not None:
+        groups = np.asarray(groups)
+    cv = _check_cv(cv, groups)
+    rng = check_random_state(random_state)
+    if voxel_mask is None and isinstance(models, ModelStore):
+        voxel_mask = models.voxel_mask
+    if voxel_mask is None and voxel_selection:
+        voxel_mask = np.var(y, axis=0) > 0.
+    if voxel_mask is not None:
+        voxel_mask = np.asarray(voxel_mask, dtype=bool)
+        y = y[:, voxel_mask]
+    null_list = []
+    p_list = []
+    for fold, (train, test) in enumerate(cv.split(X, y, groups)):
+        prediction = _zscore(_predict_fold(models, fold, X[test]))
+        y_test = _zscore(y[test])
+        n_test = len(test)
+        observed = np.einsum('ij,ij->j', prediction, y_test) / n_test
+        null_distribution = np.zeros((y.shape[1], n_permutations))
+        for start in range(0, n_permutations, batch_size):
+            permutations = _block_permutations(n_test, block_size,
+                                               min(batch_size, n_permutations - start), rng)
+            for voxels in range(0, y.shape[1], chunk_size):
+                chunk = slice(voxels, voxels + chunk_size)
+                null_distribution[chunk, start:start + permutations.shape[0]] = np.einsum(
+                    'ij,bij->jb', prediction[:, chunk], y_test[permutations, chunk]) / n_test
+        p_values = (1. + (null_distribution >= observed[:, None]).sum(axis=1)) / (1. + n_permutations)
+        if voxel_mask is not None:
+            all_null = np.zeros((voxel_mask.shape[0], n_permutations))
+            all_null[voxel_mask] = null_distribution
+            null_distribution = all_null
+            all_p_values = np.ones(voxel_mask.shape[0])
+            all_p_values[voxel_mask] = p_values
+            p_values = all_p_values
+        null_list.append(null_distribution[:, None])
+        p_list.append(p_values[:, None])
+    return np.concatenate(null_list, axis=1), np.concatenate(p_list, axis=1)
+
+def _predict_fold(models, fold, X):
+    '''Returns the predictions of the model of fold for the trained voxels'''
+    if isinstance(models, ModelStore):
+        return X.dot(models.coef[fold].T) + models.intercept[fold]
+    return models[fold].predict(X)
+
+def _zscore(x):
+    '''Column-wise z-scores of x, columns with zero variance are set to zero'''
+    x = x - x.mean(axis=0)
+    std = x.std(axis=0)
+    return np.divide(x, std, out=np.zeros_like(x), where=std > 0)
+
+def _block_permutations(n_samples, block_size, n_permutations, rng):
+    '''Returns n_permutations permutations of n_samples indices that keep blocks of block_size samples intact'''
+    blocks = np.array_split(np.arange(n_samples), np.arange(block_size, n_samples, block_size))
+    return np.array([np.concatenate([blocks[i] for i in rng.permutation(len(blocks))])
+                     for _ in range(n_permutations)])
+
+# Cell
+
+class ReducedEstimator(RegressorMixin, BaseEstimator):
+    """Estimator trained on a lower-dimensional projection of the data that is learned from the training data only
+    Used within get_model_plus_scores, the projection is fitted on the training fold and applied to the test fold,
+    so that the test fold does not leak into the model.
+    The coefficients are projected back into the feature space, so the model can be used like the estimator.
+
+    Parameters
+
+        estimator : None or estimator object that implements fit and predict, optional, default=None
+            Estimator fitted on the projected data, None uses SVDRidgeCV.
+        method : {'pca', 'svd', 'random'}, optional, default='pca'
+            'pca' uses the exact principal components of the training data, also for a LaggedDesign,
+            'svd' uses a randomized singular value decomposition of the centered training data,
+            'random' uses a sparse random projection, which is the cheapest but needs more components.
+        n_components : int, float, or None, optional, default=0.99
+            Number of components, or for 'pca' and 'svd' a float between 0 and 1 that specifies the
+            fraction of the training variance to keep. None keeps all components for 'pca' and 'svd'
+            and uses the Johnson-Lindenstrauss bound for 'random'.
+        random_state : None, int, or RandomState, optional, default=None
+            Random state of the 'svd' and 'random' methods.
+    """
+
+    def __init__(self, estimator=None, method='pca', n_components=0.99, random_state=None):
+        self.estimator = estimator
+        self.method = method
+        self.n_components = n_components
+        self.random_state = random_state
+
+    def fit(self, X, y):
+        """Fit the projection and the estimator on the projected data.
+
+        Parameters
+
+            X : array-like or LaggedDesign, shape (n_samples, n_features)
+                Data.
+            y : array-like, shape (n_samples, n_targets)
+                Targets.
+
+        Returns
+
+            self : object
+                Returns self
+        """
+        start = time.time()
+        X, y = _check_X_y(X, y)
+        if self.method not in ('pca', 'svd', 'random'):
+            raise ValueError("method needs to be either 'pca', 'svd', or 'random'.")
+        if isinstance(self.n_components, float) and not 0. < self.n_components <= 1.:
+            raise ValueError('A fraction of variance in n_components needs to be between 0 and 1.')
+        if self.method == 'random':
+            from sklearn.random_projection import SparseRandomProjection
+            if isinstance(self.n_components, float):
+                raise ValueError("The 'random' method requires an int or None as n_components.")
+            if isinstance(X, LaggedDesign):
+                X = X.toarray()
+            projection = SparseRandomProjection(
+                n_components='auto' if self.n_components is None else self.n_components,
+                random_state=self.random_state).fit(X)
+            self.mean_ = np.zeros(X.shape[1])
+            self.components_ = projection.components_
+            self.explained_variance_ratio_ = None
+        else:
+            self.mean_, self.components_, self.explained_variance_ratio_ = _principal_components(
+                X, self.n_components, self.method, self.random_state)
+        self.n_components_ = self.components_.shape[0]
+        self.offset_ = self.components_.dot(self.mean_)
+        estimator = SVDRidgeCV() if self.estimator is None else self.estimator
+        self.estimator_ = copy.deepcopy(estimator).fit(self.transform(X), y)
+        self.fit_time_ = time.time() - start
+        return self
+
+    def transform(self, X):
+        """Project X onto the components learned from the training data.
+
+        Parameters
+
+            X : array-like or LaggedDesign, shape (n_samples, n_features)
+                Data.
+
+        Returns
+
+            X_reduced : ndarray, shape (n_samples, n_components)
+                Projected data.
+        """
+        check_is_fitted(self, 'components_')
+        X = _check_X(X)
+        if isinstance(X, LaggedDesign) and sparse.issparse(self.components_):
+            X = X.toarray()
+        X_reduced = self.components_.dot(X.T).T if sparse.issparse(self.components_) else X.dot(self.components_.T)
+        if sparse.issparse(X_reduced):
+            X_reduced = X_reduced.toarray()
+        return np.asarray(X_reduced) - self.offset_
+
+    def predict(self, X):
+        """Predict using the estimator on the projected data.
+
+        Parameters
+
+            X : array-like or LaggedDesign, shape (n_samples, n_features)
+                Data.
+
+        Returns
+
+            y : ndarray, shape (n_samples, n_targets)
+                Predicted targets.
+        """
+        check_is_fitted(self, 'estimator_')
+        return self.estimator_.predict(self.transform(X))
+
+    @property
+    def coef_(self):
+        """Coefficients of the estimator in the original feature space."""
+        coef = self.estimator_.coef_
+        return np.asarray(self.components_.T.dot(coef.T)).T
+
+    @property
+    def intercept_(self):
+        """Intercept of the estimator for the uncentered data."""
+        return self.estimator_.intercept_ - self.coef_.dot(self.mean_)
+
+    @property
+    def alpha_(self):
+        """Regularization parameter chosen by the estimator."""
+        return self.estimator_.alpha_
+
+def _principal_components(X, n_components=None, method='pca', random_state=None):
+    '''Returns the mean, the principal axes, and their explained variance ratio of X, see ReducedEstimator'''
+    if method == 'pca':
+        # the decomposition of the ridge regressions, also without materializing a LaggedDesign
+        (_, s_sq, XTU), X_mean = _center_and_decompose(X, True, 'auto')
+        order = np.argsort(s_sq)[::-1]
+        s_sq, XTU = s_sq[order], XTU[:, order]
+        keep = s_sq > s_sq[0] * max(X.shape) * np.finfo(np.float64).eps
+        s_sq, components = s_sq[keep], (XTU[:, keep] / np.sqrt(s_sq[keep])).T
+        total_variance = s_sq.sum()
+    else:
+        from sklearn.utils.extmath import randomized_svd
+        X = X.toarray() if sparse.issparse(X) else np.asarray(X)
+        X_mean = X.mean(axis=0)
+        X = X - X_mean
+        total_variance = np.sum(X**2)
+        max_components = min(X.shape)
+        n_target = n_components if isinstance(n_components, (int, np.integer)) else max_components
+        if isinstance(n_components, float):
+            # increase the number of components until enough variance is explained
+            n_target = min(max_components, 64)
+            while True:
+                _, s, components = randomized_svd(X, n_target, random_state=random_state)
+                if n_target == max_components or np.sum(s**2) >= n_components * total_variance:
+                    break
+                n_target = min(max_components, 2 * n_target)
+        else:
+            _, s, components = randomized_svd(X, min(n_target, max_components), random_state=random_state)
+        s_sq = s**2
+    ratio = s_sq / total_variance
+    if isinstance(n_components, float):
+        n_keep = np.searchsorted(np.cumsum(ratio), n_components - 1e-12) + 1
+    else:
+        n_keep = s_sq.shape[0] if n_components is None else n_components
+    n_keep = min(n_keep, s_sq.shape[0])
+    return X_mean, components[:n_keep], ratio[:n_keep].sum()
+
+def reduction_tradeoff(X, y, n_components, method='pca', estimator=None, cv=None, **kwargs):
+    '''Trains encoding models on projections of X with different numbers of components and reports their cost and accuracy
+
+    Parameters
+
+        X : ndarray or LaggedDesign of shape (samples, features)
+        y : ndarray of shape (samples, targets)
+        n_components : list of int, float, or None, values of n_components of ReducedEstimator to compare,
+                       None trains the estimator on X without projecting it
+        method : {'pca', 'svd', 'random'}, optional, default 'pca', method of ReducedEstimator
+        estimator : None or estimator object that implements fit and predict, optional,
+                    estimator trained on the projected data, None uses SVDRidgeCV
+        cv : cross-validation of get_model_plus_scores
+        kwargs : additional parameters of get_model_plus_scores
+
+    Returns
+        dict with one entry per value in n_components of
+        'n_components': the number of components used, averaged over folds (number of features for None),
+        'explained_variance': the fraction of training variance kept, averaged over folds (None for 'random'),
+        'fit_time': the time in seconds to train and score all folds,
+        'mean_score': the score averaged over folds and targets,
+        'scores': the scores returned by get_model_plus_scores
+    '''
+    results = {'n_components': [], 'explained_variance': [], 'fit_time': [], 'mean_score': [], 'scores': []}
+    for components in n_components:
+        fold_estimator = SVDRidgeCV() if estimator is None else estimator
+        if components is not None:
+            fold_estimator = ReducedEstimator(fold_estimator, method=method, n_components=components)
+        start = time.time()
+        models, scores = get_model_plus_scores(X, y, estimator=fold_estimator, cv=cv, **kwargs)
+        results['fit_time'].append(time.time() - start)
+        models = models if isinstance(models, list) else [models]
+        if components is None:
+            results['n_components'].append(X.shape[1])
+            results['explained_variance'].append(1.)
+        else:
+            results['n_components'].append(float(np.mean([model.n_components_ for model in models])))
+            results['explained_variance'].append(
+                None if method == 'random' else float(np.mean([model.explained_variance_ratio_ for model in models])))
+        results['mean_score'].append(float(np.mean(scores)))
+        results['scores'].append(scores)
+    return results
+
 # Cell
 
 class BlockMultiOutput(MultiOutputRegressor, RegressorMixin):
@@ -104,12 +1377,18 @@ class BlockMultiOutput(MultiOutputRegressor, RegressorMixin):
             When individual estimators are fast to train or predict
             using `n_jobs>1` can result in slower performance due
             to the overhead of spawning processes.
+        coef_dir : None or str, optional, default=None
+            Directory in which the coefficients and intercepts of all blocks are stored
+            as memory-mapped coef.npy and intercept.npy files, which requires an estimator with
+            `coef_` and `intercept_` attributes. Each block is written to disk as soon as it is fitted,
+            so the coefficients of all targets never have to be held in memory.
     """
 
-    def __init__(self, estimator, n_blocks=10, n_jobs=1):
+    def __init__(self, estimator, n_blocks=10, n_jobs=1, coef_dir=None):
         self.estimator = estimator
         self.n_blocks = n_blocks
         self.n_jobs = n_jobs
+        self.coef_dir = coef_dir
 
     def fit(self, X, y, sample_weight=None):
         """ Fit the model to data.
@@ -119,9 +1398,12 @@ class BlockMultiOutput(MultiOutputRegressor, RegressorMixin):
 
             X : (sparse) array-like, shape (n_samples, n_features)
                 Data.
-            y : (sparse) array-like, shape (n_samples, n_outputs)
+            y : (sparse) array-like, shape (n_samples, n_outputs), or str
                 Multi-output targets. An indicator matrix turns on multilabel
                 estimation.
+                Can also be a (memmapped) array on disk, given by the path to a .npy file
+                or by 'path.h5:dataset' for a dataset in a HDF5 file (requires h5py).
+                Only the targets of one block are read into memory by each worker.
             sample_weight : array-like, shape = (n_samples) or None
                 Sample weights. If None, then samples are equally weighted.
                 Only supported if the underlying regressor supports sample
@@ -135,7 +1417,8 @@ class BlockMultiOutput(MultiOutputRegressor, RegressorMixin):
         if not hasattr(self.estimator, "fit"):
             raise ValueError("The base estimator should implement a fit method")
 
-        if y.ndim == 1:
+        y_shape = _targets_shape(y)
+        if len(y_shape) == 1:
             raise ValueError("y must have at least two dimensions for "
                              "multi-output regression but has only one.")
 
@@ -143,12 +1426,26 @@ class BlockMultiOutput(MultiOutputRegressor, RegressorMixin):
                 not has_fit_parameter(self.estimator, 'sample_weight')):
             raise ValueError("Underlying estimator does not support"
                              " sample weights.")
-        kfold = KFold(n_splits=self.n_blocks)
-        smpl_X, smpl_y = np.zeros((y.shape[1],1)), np.zeros((y.shape[1],1))
-        self.estimators_ = Parallel(n_jobs=self.n_jobs)(
-            delayed(_fit_estimator)(
-                self.estimator, X, y[:, block], sample_weight)
-            for _, block in kfold.split(smpl_X, smpl_y))
+        blocks = _target_blocks(y_shape[1], self.n_blocks)
+        if self.coef_dir is not None:
+            os.makedirs(self.coef_dir, exist_ok=True)
+            n_features = X.shape[1]
+            np.lib.format.open_memmap(os.path.join(self.coef_dir, 'coef.npy'), mode='w+',
+                                      shape=(y_shape[1], n_features)).flush()
+            np.lib.format.open_memmap(os.path.join(self.coef_dir, 'intercept.npy'), mode='w+',
+                                      shape=(y_shape[1],)).flush()
+        fitted = Parallel(n_jobs=self.n_jobs)(
+            delayed(_fit_block)(
+                self.estimator, X, y, block, sample_weight, self.coef_dir)
+            for block in blocks)
+        self.estimators_ = [estimator for estimator, _ in fitted]
+        if self.coef_dir is not None:
+            # replace the coefficients by read-only views of the files
+            self.coef_ = np.load(os.path.join(self.coef_dir, 'coef.npy'), mmap_mode='r')
+            self.intercept_ = np.load(os.path.join(self.coef_dir, 'intercept.npy'), mmap_mode='r')
+            for (estimator, shapes), block in zip(fitted, blocks):
+                estimator.coef_ = self.coef_[block].reshape(shapes[0])
+                estimator.intercept_ = self.intercept_[block].reshape(shapes[1])
         return self
 
     def partial_predict(self, X):
@@ -217,15 +1514,62 @@ class BlockMultiOutput(MultiOutputRegressor, RegressorMixin):
             score : float
                 Correlation of self.predict(X) wrt. y.
         """
-        from sklearn.preprocessing import StandardScaler
-        from itertools import izip
-        kfold = KFold(n_splits=self.n_blocks)
-        smpl_X, smpl_y = np.zeros((y.shape[1],1)), np.zeros((y.shape[1],1))
         scores = []
-        for prediction, (_, block) in izip(self.partial_predict(X), kfold.split(smpl_X, smpl_y)):
-            mx = StandardScaler().fit_transform(prediction).astype('float32')
-            my = StandardScaler().fit_transform(y[:, block]).astype('float32')
-            n = mx.shape[0]
-            r = (1/(n-1))*(mx*my).sum(axis=0)
-            scores.append(r)
+        for prediction, block in zip(self.partial_predict(X), _target_blocks(y.shape[1], self.n_blocks)):
+            scores.append(product_moment_corr(prediction, y[:, block], dtype=np.float32))
         return np.concatenate(scores)
+
+def _target_blocks(n_targets, n_blocks):
+    '''Returns n_blocks contiguous slices of the targets, split like a KFold along targets'''
+    bounds = np.cumsum([0] + [len(block) for block in np.array_split(np.arange(n_targets), n_blocks)])
+    return [slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+def _split_hdf5_path(y):
+    '''Returns the path and dataset name of a HDF5 target specification or None if y is no HDF5 path'''
+    path, _, dataset = y.rpartition(':')
+    if path.endswith(('.h5', '.hdf5')):
+        return path, dataset
+    return None
+
+def _targets_shape(y):
+    '''Returns the shape of the targets y, which can be an array or a path to an array on disk'''
+    if not isinstance(y, str):
+        return y.shape
+    hdf5_path = _split_hdf5_path(y)
+    if hdf5_path:
+        import h5py
+        with h5py.File(hdf5_path[0], 'r') as fl:
+            return fl[hdf5_path[1]].shape
+    return np.load(y, mmap_mode='r').shape
+
+def _read_targets(y, block):
+    '''Reads the block of targets from y, which can be an array or a path to an array on disk'''
+    if not isinstance(y, str):
+        return np.asarray(y[:, block])
+    hdf5_path = _split_hdf5_path(y)
+    if hdf5_path:
+        import h5py
+        with h5py.File(hdf5_path[0], 'r') as fl:
+            return fl[hdf5_path[1]][:, block]
+    return np.asarray(np.load(y, mmap_mode='r')[:, block])
+
+def _fit_block(estimator, X, y, block, sample_weight=None, coef_dir=None):
+    '''Fits estimator on one block of targets and writes its coefficients to coef_dir if it is not None
+
+    Returns the fitted estimator and the shapes of its coefficients and intercept'''
+    estimator = _fit_estimator(estimator, X, _read_targets(y, block), sample_weight)
+    if coef_dir is None:
+        return estimator, None
+    if not (hasattr(estimator, 'coef_') and hasattr(estimator, 'intercept_')):
+        raise ValueError('coef_dir requires an estimator with coef_ and intercept_ attributes.')
+    n_targets = block.stop - block.start
+    shapes = (np.shape(estimator.coef_), np.shape(estimator.intercept_))
+    coef = np.load(os.path.join(coef_dir, 'coef.npy'), mmap_mode='r+')
+    coef[block] = np.reshape(estimator.coef_, (n_targets, -1))
+    coef.flush()
+    intercept = np.load(os.path.join(coef_dir, 'intercept.npy'), mmap_mode='r+')
+    intercept[block] = np.broadcast_to(estimator.intercept_, (n_targets,))
+    intercept.flush()
+    # the coefficients are read from disk after fitting
+    estimator.coef_, estimator.intercept_ = None, None
+    return estimator, shapes
@@ -1,53 +1,147 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: preprocessing.ipynb (unless otherwise specified).
 
-__all__ = ['preprocess_bold_fmri', 'get_remove_idx', 'make_lagged_stimulus', 'generate_lagged_stimulus', 'make_X_Y']
+__all__ = ['preprocess_bold_fmri', 'mask_voxels', 'get_remove_idx', 'make_lagged_stimulus', 'LaggedDesign',
+           'generate_lagged_stimulus', 'make_X_Y', 'align_fmri']
 
 # Cell
 #export
 import os
 import warnings
+from fractions import Fraction
 import numpy as np
-import joblib
-from nilearn.masking import unmask, apply_mask
-from nibabel import save, load, Nifti1Image
+from scipy import sparse
+from scipy.signal import resample_poly
+from nibabel import load
 from nilearn.signal import clean
 
 # Cell
-def preprocess_bold_fmri(bold, mask=None, detrend=True, standardize='zscore', **kwargs):
+def preprocess_bold_fmri(bold, mask=None, detrend=True, standardize='zscore', cache=None,
+                         dtype=np.float32, chunk_size=10000, memmap_file=None, **kwargs):
     '''Preprocesses BOLD data and returns ndarray of preprocessed data
 
+    The BOLD data is read in slabs of volumes, of which only the voxels in mask are kept,
+    and then cleaned in chunks of voxels, so that memory scales with the (masked) output
+    instead of the full 4D image.
+
     Parameters
 
         bold : path to bold nifti file or loaded bold nifti
-        mask : path to mask nifti file or loaded mask nifti, optional
+        mask : path to mask nifti file, loaded mask nifti, or boolean ndarray of the voxels in the mask, optional
+               the latter can be computed once with mask_voxels and used for all runs of a subject
         detrend : bool, whether to linearly detrend the data, optional
         standardize : {‘zscore’, ‘psc’, False}, default is ‘zscore’
+        cache : None or cache.ArrayCache, optional
+                cache in which the preprocessed data of a bold file is stored in single precision,
+                identified by the path, size, and modification time of the bold and mask files,
+                the mask, and the preprocessing parameters
+        dtype : numpy dtype, optional, default np.float32
+                dtype in which the data is read, cleaned, and returned
+        chunk_size : int, optional, default 10000
+                     number of voxels that are cleaned at once
+        memmap_file : None or str, optional, default None
+                      path of a .npy file in which the output is created memory-mapped instead of in memory
         kwargs : further arguments for nilearn's clean function
 
     Returns
-        ndarray of the preprocessed bold data in (samples, voxels)
+        ndarray of the preprocessed bold data in (samples, voxels),
+        memory-mapped float32 array if cache is given and bold is a path
     '''
-    if mask:
-        data = apply_mask(bold, mask)
+    if cache is not None and isinstance(bold, str):
+        mask_files = [mask] if isinstance(mask, str) else []
+        key = cache.key([bold] + mask_files, hash_files=False,
+                        params={'mask': None if mask_files else mask, 'detrend': detrend,
+                                'standardize': standardize, 'clean_kwargs': kwargs})
+        cached = cache.get(key)
+        if cached is None:
+            data = preprocess_bold_fmri(bold, mask=mask, detrend=detrend, standardize=standardize,
+                                        chunk_size=chunk_size, **kwargs)
+            cached = cache.put(key, {'data': np.asarray(data, dtype=np.float32)})
+        return cached['data']
+    if not hasattr(bold, 'dataobj'):
+        # keep gzipped files open, so that consecutive slabs do not decompress the file from the start
+        bold = load(bold, keep_file_open=True)
+    voxels = mask_voxels(mask, bold) if mask is not None else None
+    data = _masked_timeseries(bold, voxels, dtype=dtype, memmap_file=memmap_file)
+    cleaned = None
+    for start in range(0, data.shape[1], chunk_size):
+        chunk = slice(start, start + chunk_size)
+        cleaned_chunk = _clean(data[:, chunk], detrend=detrend, standardize=standardize, **kwargs)
+        if cleaned is None:
+            # clean can remove samples, e.g. with sample_mask, otherwise the data is cleaned in place
+            cleaned = data if cleaned_chunk.shape[0] == data.shape[0] else _allocate(
+                (cleaned_chunk.shape[0], data.shape[1]), dtype)
+        cleaned[:, chunk] = cleaned_chunk
+    return data if cleaned is None else cleaned
+
+def mask_voxels(mask, bold=None):
+    '''Returns the boolean array of the voxels in mask, which needs to be aligned with the image bold if it is given
+
+    mask can be a path, a loaded nifti, or a boolean array of voxels returned before, which is only checked'''
+    if isinstance(mask, np.ndarray):
+        voxels = mask.astype(bool, copy=False)
+        if bold is not None and voxels.shape != tuple(bold.shape[:3]):
+            raise ValueError('Mask and BOLD data need to have the same shape, but have shapes {} and {}.'.format(
+                voxels.shape, bold.shape[:3]))
     else:
-        if not isinstance(bold, Nifti1Image):
-            data = load(bold).get_data()
-        else:
-            data = bold.get_data()
-        data = np.reshape(data, (-1, data.shape[-1])).T
-    return clean(data, detrend=detrend, standardize=standardize, **kwargs)
+        if not hasattr(mask, 'dataobj'):
+            mask = load(mask)
+        if bold is not None and (mask.shape[:3] != bold.shape[:3] or not np.allclose(mask.affine, bold.affine)):
+            raise ValueError('Mask and BOLD data need to have the same shape and affine, '
+                             'but have shapes {} and {}.'.format(mask.shape[:3], bold.shape[:3]))
+        voxels = np.asarray(mask.dataobj) != 0
+        if voxels.ndim > 3:
+            voxels = voxels.reshape(voxels.shape[:3])
+    if not voxels.any():
+        raise ValueError('The mask is invalid as it is empty: it masks all data.')
+    return voxels
+
+def _masked_timeseries(img, voxels=None, dtype=np.float32, memmap_file=None, n_volumes=16):
+    '''Returns the (samples, voxels) data of the voxels of the 4D image img, read in slabs of n_volumes volumes'''
+    n_samples = img.shape[3]
+    n_voxels = int(voxels.sum()) if voxels is not None else int(np.prod(img.shape[:3]))
+    data = _allocate((n_samples, n_voxels), dtype, memmap_file)
+    for start in range(0, n_samples, n_volumes):
+        slab = np.asarray(img.dataobj[..., start:start + n_volumes])
+        slab = slab[voxels] if voxels is not None else slab.reshape((-1, slab.shape[-1]))
+        data[start:start + slab.shape[-1]] = slab.T
+    return data
+
+def _clean(signals, detrend=True, standardize='zscore', **kwargs):
+    '''Cleans signals with nilearn's clean, z-scoring with the population standard deviation for standardize='zscore' or True'''
+    if standardize not in ('zscore', True):
+        return clean(signals, detrend=detrend, standardize=standardize, **kwargs)
+    # z-scoring is the last step of clean and is done here, since newer versions of nilearn
+    # only z-score with the sample standard deviation
+    signals = clean(signals, detrend=detrend, standardize=False, **kwargs)
+    signals = signals - signals.mean(axis=0)
+    std = signals.std(axis=0)
+    std[std < np.finfo(np.float64).eps] = 1.
+    return signals / std
+
+def _allocate(shape, dtype, filename=None):
+    '''Returns an empty array, memory-mapped to the .npy file filename if filename is given'''
+    if filename is None:
+        return np.empty(shape, dtype=dtype)
+    if os.path.dirname(filename):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+    return np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=shape)
 
 # Cell
 def get_remove_idx(lagged_stimulus, remove_nan=True):
     '''Returns indices of rows in lagged_stimulus to remove'''
+    if hasattr(lagged_stimulus, 'nan_fraction'):
+        # LaggedDesign
+        nan_fraction = lagged_stimulus.nan_fraction()
+    else:
+        nan_fraction = np.isnan(lagged_stimulus).mean(axis=1)
     if remove_nan is True:
-        return np.where(np.any(np.isnan(lagged_stimulus), axis=1))[0]
+        return np.where(nan_fraction > 0)[0]
     elif remove_nan is False:
         # This will raise an error if it is supplied to np.delete
         # which is what we want
         return None
     elif remove_nan <= 1. and remove_nan >= 0.:
-        return np.where(np.isnan(lagged_stimulus).mean(axis=1) > remove_nan)[0]
+        return np.where(nan_fraction > remove_nan)[0]
     else:
         raise ValueError('remove_nan needs to be either True, False, or a float between 0 and 1.')
 
@@ -59,10 +153,133 @@ def make_lagged_stimulus(stimulus, n_lags, fill_value=np.nan):
                                  for lag_i in range(1, n_lags)]
     return np.hstack([stimulus]+lagged_reps)
 
+# Cell
+
+class LaggedDesign(object):
+    '''Lagged stimulus representation that is computed on demand instead of being materialized
+
+    Behaves like the output of make_lagged_stimulus, i.e. a matrix of shape (samples, n_lags * features)
+    whose column block i contains the stimulus shifted by i samples, but only stores the stimulus itself.
+    Products with the lagged matrix are computed one lag at a time, so that memory grows with the
+    stimulus instead of the lagged matrix.
+
+    Parameters
+
+        stimulus : ndarray of shape (samples, features), stimulus representation
+        n_lags : int, number of lags including the unlagged stimulus
+        fill_value : int, float, or any valid numpy array element, optional, default np.nan
+                     value of the lagged samples before the start of the stimulus
+    '''
+    def __init__(self, stimulus, n_lags, fill_value=np.nan):
+        stimulus = np.asarray(stimulus)
+        # keep the precision of floating point stimuli
+        if not np.issubdtype(stimulus.dtype, np.floating):
+            stimulus = stimulus.astype(np.float64)
+        self.n_lags = n_lags
+        self.fill_value = fill_value
+        # prepend the fill values of the largest lag once instead of once per lag
+        self.stimulus = np.vstack([np.full((n_lags - 1, stimulus.shape[1]), fill_value, dtype=stimulus.dtype),
+                                   stimulus])
+        # row of the unlagged stimulus for each sample
+        self.rows = np.arange(n_lags - 1, self.stimulus.shape[0])
+
+    @classmethod
+    def _from_rows(cls, stimulus, rows, n_lags, fill_value):
+        design = cls.__new__(cls)
+        design.stimulus, design.rows = stimulus, rows
+        design.n_lags, design.fill_value = n_lags, fill_value
+        return design
+
+    @classmethod
+    def concatenate(cls, designs):
+        '''Returns a LaggedDesign of the samples of all designs, e.g. of several runs'''
+        n_lags = designs[0].n_lags
+        if any(design.n_lags != n_lags or design.n_features != designs[0].n_features for design in designs):
+            raise ValueError('All designs need to have the same number of lags and features.')
+        offsets = np.cumsum([0] + [design.stimulus.shape[0] for design in designs[:-1]])
+        return cls._from_rows(np.vstack([design.stimulus for design in designs]),
+                              np.concatenate([design.rows + offset for design, offset in zip(designs, offsets)]),
+                              n_lags, designs[0].fill_value)
+
+    @property
+    def n_features(self):
+        return self.stimulus.shape[1]
+
+    @property
+    def shape(self):
+        return (self.rows.shape[0], self.n_lags * self.n_features)
+
+    @property
+    def dtype(self):
+        return self.stimulus.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, idx):
+        '''Selects rows by an integer, slice, boolean mask, or index array and returns a LaggedDesign'''
+        if isinstance(idx, tuple):
+            raise IndexError('LaggedDesign only supports selecting rows.')
+        return self._from_rows(self.stimulus, np.atleast_1d(self.rows[idx]), self.n_lags, self.fill_value)
+
+    def lag(self, i):
+        '''Returns the stimulus shifted by i samples of shape (samples, features)'''
+        return self.stimulus[self.rows - i]
+
+    def toarray(self):
+        '''Returns the materialized lagged stimulus, identical to the output of make_lagged_stimulus'''
+        return np.hstack([self.lag(i) for i in range(self.n_lags)])
+
+    def __array__(self, dtype=None, copy=None):
+        array = self.toarray()
+        return array if dtype is None else array.astype(dtype)
+
+    def dot(self, W):
+        '''Returns the product X @ W of the lagged stimulus X and W of shape (n_lags * features, ...)'''
+        W = np.asarray(W)
+        n_features = self.n_features
+        return sum(self.lag(i).dot(W[i*n_features:(i+1)*n_features]) for i in range(self.n_lags))
+
+    __matmul__ = dot
+
+    def tdot(self, Y):
+        '''Returns the product X^T @ Y of the lagged stimulus X and Y of shape (samples, ...)'''
+        return np.concatenate([self.lag(i).T.dot(Y) for i in range(self.n_lags)], axis=0)
+
+    def gram(self):
+        '''Returns X^T @ X of shape (n_lags * features, n_lags * features)'''
+        n_features = self.n_features
+        gram = np.empty((self.shape[1], self.shape[1]), dtype=self.dtype)
+        for i in range(self.n_lags):
+            lag_i = self.lag(i)
+            for j in range(i, self.n_lags):
+                block = lag_i.T.dot(self.lag(j))
+                gram[i*n_features:(i+1)*n_features, j*n_features:(j+1)*n_features] = block
+                gram[j*n_features:(j+1)*n_features, i*n_features:(i+1)*n_features] = block.T
+        return gram
+
+    def kernel(self):
+        '''Returns X @ X^T of shape (samples, samples)'''
+        return sum(self.lag(i).dot(self.lag(i).T) for i in range(self.n_lags))
+
+    def sum(self, axis=0):
+        '''Returns the sum of each lagged feature'''
+        if axis != 0:
+            raise ValueError('LaggedDesign only supports sums over samples.')
+        return np.concatenate([self.lag(i).sum(axis=0) for i in range(self.n_lags)])
+
+    def mean(self, axis=0):
+        '''Returns the mean of each lagged feature'''
+        return self.sum(axis=axis) / self.shape[0]
+
+    def nan_fraction(self):
+        '''Returns the proportion of nans in each row of the lagged stimulus'''
+        return sum(np.isnan(self.lag(i)).sum(axis=1) for i in range(self.n_lags)) / self.shape[1]
+
 # Cell
 def generate_lagged_stimulus(stimulus, fmri_samples, TR, stim_TR,
                              lag_time=None, start_time=0., offset_stim=0.,
-                             fill_value=np.nan):
+                             fill_value=np.nan, lazy=False, aggregate=None):
     '''Generates a lagged stimulus representation temporally aligned with the fMRI data
 
     Parameters
@@ -85,21 +302,32 @@ def generate_lagged_stimulus(stimulus, fmri_samples, TR, stim_TR,
         fill_value : int, float, or any valid numpy array element, optional, default np.nan
                  appends fill_value to stimulus array to account for starting_time
                  use np.nan here with remove_nans=True to remove fmri/stimulus samples where no stimulus was presented
+        lazy : bool, optional, default False
+               Whether to return a LaggedDesign that computes the lagged stimulus on demand
+               instead of materializing it
+        aggregate : None, 'mean', 'max', or 'resample', optional, default None
+                    How the stimulus samples within each TR are combined. None keeps all of them as
+                    separate features, 'mean' and 'max' pool them per feature, and 'resample' uses
+                    an anti-aliasing polyphase filter to resample the stimulus to the center of each TR.
+                    Aggregating divides the number of features by the stimulus samples per TR and
+                    supports stimulus TRs that do not divide the fMRI TR.
 
     Returns:
-        ndarray of the lagged stimulus of shape (samples, lagged features)
+        ndarray (or LaggedDesign if lazy is True) of the lagged stimulus of shape (samples, lagged features)
     '''
+    if aggregate not in (None, 'mean', 'max', 'resample'):
+        raise ValueError("aggregate should be None, 'mean', 'max', or 'resample', "
+                         "but is {}.".format(aggregate))
     # find out temporal alignment
     stim_samples_per_TR = TR / stim_TR
     if stim_samples_per_TR < 1:
         raise ValueError('Stimulus TR is larger than fMRI TR')
     # check if result is close to an integer
-    if not np.isclose(stim_samples_per_TR, np.round(stim_samples_per_TR)):
+    if aggregate is None and not np.isclose(stim_samples_per_TR, np.round(stim_samples_per_TR)):
         warnings.warn('Stimulus timing and fMRI timing do not align. '
         'Stimulus samples per fMRI samples: {0} for stimulus TR {1} and fMRI TR {2}. '
         'Proceeds by rounding stimulus samples '
         'per TR.'.format(stim_samples_per_TR, stim_TR, TR), RuntimeWarning)
-    stim_samples_per_TR = int(np.round(stim_samples_per_TR))
     if lag_time is None:
         lag_time = TR
     if np.isclose(lag_time, 0.):
@@ -124,21 +352,28 @@ def generate_lagged_stimulus(stimulus, fmri_samples, TR, stim_TR,
     n_prepend = int(np.round(start_time / stim_TR))
     stimulus = np.vstack([np.full((n_prepend, n_features), fill_value), stimulus])
 
-    # make reshapeable by appending filler
-    if stimulus.shape[0] % stim_samples_per_TR > 0:
-        # either remove part of the stimulus (if it is longer than fmri) or append filler
-        if stimulus.shape[0] / stim_samples_per_TR > fmri_samples:
-            stimulus = stimulus[:-(stimulus.shape[0] % stim_samples_per_TR)]
-        else:
-            n_append = stim_samples_per_TR - ((stimulus.shape[0]) % stim_samples_per_TR)
-            stimulus = np.vstack([np.full((n_append, n_features), fill_value), stimulus])
+    if aggregate is None:
+        stim_samples_per_TR = int(np.round(stim_samples_per_TR))
+        # make reshapeable by appending filler
+        if stimulus.shape[0] % stim_samples_per_TR > 0:
+            # either remove part of the stimulus (if it is longer than fmri) or append filler
+            if stimulus.shape[0] / stim_samples_per_TR > fmri_samples:
+                stimulus = stimulus[:-(stimulus.shape[0] % stim_samples_per_TR)]
+            else:
+                n_append = stim_samples_per_TR - ((stimulus.shape[0]) % stim_samples_per_TR)
+                stimulus = np.vstack([np.full((n_append, n_features), fill_value), stimulus])
 
-    # now reshape and lag
-    stimulus = np.reshape(stimulus, (-1, stim_samples_per_TR * n_features))
+        # now reshape and lag
+        stimulus = np.reshape(stimulus, (-1, stim_samples_per_TR * n_features))
+    else:
+        stimulus = _aggregate_per_TR(stimulus, stim_samples_per_TR, fmri_samples, aggregate, fill_value)
 
     # offset by appending filler values
     if offset_stim > 0:
-        stimulus = np.vstack([np.full((offset_TR, stim_samples_per_TR * n_features), fill_value), stimulus])
+        stimulus = np.vstack([np.full((offset_TR, stimulus.shape[1]), fill_value), stimulus])
+
+    if lazy:
+        return LaggedDesign(stimulus, lag_TR, fill_value=fill_value)
 
     # check if lagging should be done
     if lag_time != TR:
@@ -146,13 +381,43 @@ def generate_lagged_stimulus(stimulus, fmri_samples, TR, stim_TR,
 
     return stimulus
 
+def _aggregate_per_TR(stimulus, stim_samples_per_TR, fmri_samples, aggregate, fill_value=np.nan):
+    '''Combines the stimulus samples within each TR into one sample, see generate_lagged_stimulus'''
+    n_TR = stimulus.shape[0] / stim_samples_per_TR
+    # a partial last TR is removed if the stimulus is longer than fmri, otherwise it is filled up
+    n_TR = int(np.floor(n_TR + 1e-8)) if n_TR > fmri_samples else int(np.ceil(n_TR - 1e-8))
+    # TR boundaries in stimulus samples on the exact time grid, so that non-integer ratios do not drift
+    edges = np.round(np.arange(n_TR + 1) * stim_samples_per_TR).astype(int)
+    if edges[-1] > stimulus.shape[0]:
+        stimulus = np.vstack([stimulus, np.full((edges[-1] - stimulus.shape[0], stimulus.shape[1]), fill_value)])
+    stimulus = stimulus[:edges[-1]]
+    if aggregate == 'mean':
+        return np.add.reduceat(stimulus, edges[:-1], axis=0) / np.diff(edges)[:, None]
+    if aggregate == 'max':
+        return np.maximum.reduceat(stimulus, edges[:-1], axis=0)
+    # TRs that contain fill values are filled instead of spreading them with the filter
+    invalid = np.logical_or.reduceat(np.isnan(stimulus), edges[:-1], axis=0)
+    ratio = Fraction(stim_samples_per_TR).limit_denominator(1000)
+    # start half a TR later, so that each output sample lies at the center of its TR
+    center = int(np.round(stim_samples_per_TR / 2))
+    resampled = resample_poly(np.nan_to_num(stimulus[center:]), ratio.denominator, ratio.numerator, axis=0)
+    aggregated = np.full((n_TR, stimulus.shape[1]), fill_value, dtype=np.result_type(resampled, fill_value))
+    aggregated[:resampled.shape[0]] = resampled[:n_TR]
+    aggregated[invalid] = fill_value
+    return aggregated
+
 # Cell
-def make_X_Y(stimuli, fmri, TR, stim_TR, lag_time=6.0, start_times=None, offset_stim=0., fill_value=np.nan, remove_nans=True):
+def make_X_Y(stimuli, fmri, TR, stim_TR, lag_time=6.0, start_times=None, offset_stim=0., fill_value=np.nan, remove_nans=True,
+             lazy=False, dtype=None, memmap_dir=None, return_rows=False, aggregate=None):
     '''Creates (lagged) features and fMRI matrices concatenated along runs
 
     Parameters
 
-        stimuli : list, list of stimulus representations
+        stimuli : list, list of stimulus representations, either ndarrays or scipy.sparse matrices.
+                  Sparse stimuli are lagged without densifying them and the lagged stimuli are returned
+                  as a sparse CSR matrix, in which stimulus samples that are filled with fill_value are zero.
+                  Which samples are filled is tracked separately, so remove_nans removes the same samples
+                  as for dense stimuli if fill_value is np.nan. Other fill values than np.nan and 0 are not supported.
         fmri : list, list of fMRI ndarrays
         TR : int, float, repetition time of the fMRI data in seconds
         stim_TR : int, float, repetition time of the stimulus in seconds
@@ -176,11 +441,26 @@ def make_X_Y(stimuli, fmri, TR, stim_TR, lag_time=6.0, start_times=None, offset_
                       a proportion keeps all samples in the lagged stimulus that have
                       lower number of nans than this proportion.
                       Replace nans with zeros in this case.
+        lazy : bool, optional, default False
+               Whether to return the lagged stimuli as a LaggedDesign, which only stores the unlagged stimuli
+               and can be used directly by the estimators in encoding
+        dtype : None or numpy dtype, optional, default None
+                dtype of the returned arrays, e.g. np.float32 to halve their size,
+                None uses float64 for the stimuli and the dtype of fmri for the fMRI data
+        memmap_dir : None or str, optional, default None
+                     directory in which the returned arrays are created as memory-mapped
+                     X.npy and y.npy files instead of in memory, sparse stimuli are kept in memory
+        return_rows : bool, optional, default False
+                      Whether to additionally return the indices of the fMRI samples that are kept in each run,
+                      which align fMRI data of the same runs with the stimuli by using align_fmri
+        aggregate : None, 'mean', 'max', or 'resample', optional, default None
+                    How the stimulus samples within each TR are combined, see generate_lagged_stimulus
 
     Returns:
     tuple of two ndarrays,
-    the first element are the (lagged) stimuli,
-    the second element is the aligned fMRI data
+    the first element are the (lagged) stimuli (a LaggedDesign if lazy is True),
+    the second element is the aligned fMRI data,
+    and the list of the indices of the kept fMRI samples of each run if return_rows is True
     '''
     if len(stimuli) != len(fmri):
         raise ValueError('Stimulus and fMRI need to have the same number of runs. '
@@ -188,33 +468,105 @@ def make_X_Y(stimuli, fmri, TR, stim_TR, lag_time=6.0, start_times=None, offset_
     n_features = stimuli[0].shape[1]
     if not np.all(np.array([stim.shape[1] for stim in stimuli]) == n_features):
         raise ValueError('Stimulus has different number of features per run.')
+    is_sparse = sparse.issparse(stimuli[0])
+    if is_sparse:
+        if lazy or aggregate is not None:
+            raise ValueError('Sparse stimuli do not support lazy or aggregate.')
+        if not (np.isnan(fill_value) or fill_value == 0):
+            raise ValueError('Sparse stimuli only support np.nan or 0 as fill_value.')
 
+    # first find the samples of each run that are kept, without copying stimulus or fMRI
     lagged_stimuli = []
-    aligned_fmri = []
+    fmri_rows = []
     for i, (stimulus, fmri_run) in enumerate(zip(stimuli, fmri)):
+        if is_sparse:
+            # lag the indices of the stimulus samples instead of the samples, fill values mark the filled samples
+            stimulus = np.arange(stimulus.shape[0], dtype=np.float64)[:, None]
         stimulus = generate_lagged_stimulus(
             stimulus, fmri_run.shape[0], TR, stim_TR, lag_time=lag_time,
             start_time=start_times[i] if start_times else 0.,
-            offset_stim=offset_stim, fill_value=fill_value)
+            offset_stim=offset_stim, fill_value=np.nan if is_sparse else fill_value,
+            lazy=True, aggregate=aggregate)
+        rows = np.arange(fmri_run.shape[0])
         # remove nans in stim/fmri here
-        if remove_nans:
+        if remove_nans and not (is_sparse and fill_value == 0):
             remove_idx = get_remove_idx(stimulus, remove_nans)
-            stimulus = np.delete(stimulus, remove_idx, axis=0)
-            fmri_run = np.delete(fmri_run, remove_idx, axis=0)
+            stimulus = stimulus[np.setdiff1d(np.arange(stimulus.shape[0]), remove_idx)]
+            rows = np.delete(rows, remove_idx)
 
         # remove fmri samples recorded after stimulus has ended
-        if fmri_run.shape[0] != stimulus.shape[0]:
+        if rows.shape[0] != stimulus.shape[0]:
             # check if the difference is due to offsetting and warn if it is not
-            if np.round(offset_stim/TR) < abs(fmri_run.shape[0] - stimulus.shape[0]):
+            if np.round(offset_stim/TR) < abs(rows.shape[0] - stimulus.shape[0]):
                 warnings.warn('fMRI data and stimulus samples differ.'
                 ' Removing additional fMRI/stimulus samples. This could mean that you recorded '
                 'after stimulus ended, stopped recording early, or that something went wrong in the '
                 'preprocessing. fMRI: {}s stimulus: {}s'.format(
-                    TR*fmri_run.shape[0], TR*stimulus.shape[0]), RuntimeWarning)
-            if fmri_run.shape[0] > stimulus.shape[0]:
-                fmri_run = fmri_run[:-(fmri_run.shape[0]-stimulus.shape[0])]
+                    TR*rows.shape[0], TR*stimulus.shape[0]), RuntimeWarning)
+            if rows.shape[0] > stimulus.shape[0]:
+                rows = rows[:stimulus.shape[0]]
             else:
-                stimulus = stimulus[:-(stimulus.shape[0]-fmri_run.shape[0])]
+                stimulus = stimulus[:rows.shape[0]]
         lagged_stimuli.append(stimulus)
-        aligned_fmri.append(fmri_run)
-    return np.vstack(lagged_stimuli), np.vstack(aligned_fmri)
\ No newline at end of file
+        fmri_rows.append(rows)
+
+    # then fill the concatenated arrays in a single pass
+    aligned_fmri = align_fmri(fmri, fmri_rows, dtype=dtype, memmap_dir=memmap_dir)
+    if lazy:
+        lagged_stimulus = LaggedDesign.concatenate(lagged_stimuli)
+    elif is_sparse:
+        lagged_stimulus = sparse.vstack([_gather_samples(stimulus, sample_indices)
+                                         for stimulus, sample_indices in zip(stimuli, lagged_stimuli)],
+                                        format='csr', dtype=np.float64 if dtype is None else dtype)
+    else:
+        lagged_stimulus = _allocate((aligned_fmri.shape[0], lagged_stimuli[0].shape[1]),
+                                    np.float64 if dtype is None else dtype,
+                                    os.path.join(memmap_dir, 'X.npy') if memmap_dir else None)
+        start = 0
+        for stimulus in lagged_stimuli:
+            stop = start + stimulus.shape[0]
+            for lag in range(stimulus.n_lags):
+                lagged_stimulus[start:stop, lag*stimulus.n_features:(lag+1)*stimulus.n_features] = stimulus.lag(lag)
+            start = stop
+    if return_rows:
+        return lagged_stimulus, aligned_fmri, fmri_rows
+    return lagged_stimulus, aligned_fmri
+
+def _gather_samples(stimulus, sample_indices):
+    '''Returns the lagged sparse stimulus given by the LaggedDesign sample_indices of its sample indices
+
+    Every column of the lagged sample indices is one block of features, filled samples (nan) are zero.'''
+    stimulus = sparse.csr_matrix(stimulus)
+    blocks = []
+    for lag in range(sample_indices.n_lags):
+        indices = sample_indices.lag(lag)
+        for column in indices.T:
+            rows = np.flatnonzero(~np.isnan(column))
+            selection = sparse.csr_matrix((np.ones(rows.shape[0]), (rows, column[rows].astype(int))),
+                                          shape=(column.shape[0], stimulus.shape[0]))
+            blocks.append(selection.dot(stimulus))
+    return sparse.hstack(blocks, format='csr')
+
+def align_fmri(fmri, rows, dtype=None, memmap_dir=None):
+    '''Concatenates the samples rows of each run of fmri, as returned by make_X_Y with return_rows=True
+
+    Parameters
+
+        fmri : list, list of fMRI ndarrays
+        rows : list, list of the indices of the samples to keep in each run
+        dtype : None or numpy dtype, optional, default None
+                dtype of the returned array, None uses the dtype of fmri
+        memmap_dir : None or str, optional, default None
+                     directory in which the returned array is created as memory-mapped y.npy file instead of in memory
+
+    Returns:
+        ndarray of the aligned fMRI data
+    '''
+    aligned_fmri = _allocate((sum(run_rows.shape[0] for run_rows in rows), fmri[0].shape[1]),
+                             np.result_type(*fmri) if dtype is None else dtype,
+                             os.path.join(memmap_dir, 'y.npy') if memmap_dir else None)
+    start = 0
+    for fmri_run, run_rows in zip(fmri, rows):
+        aligned_fmri[start:start + run_rows.shape[0]] = fmri_run[run_rows]
+        start += run_rows.shape[0]
+    return aligned_fmri
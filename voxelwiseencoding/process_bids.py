@@ -1,26 +1,31 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: process_bids.ipynb (unless otherwise specified).
 
 __all__ = ['create_stim_filename_from_args', 'create_output_filename_from_args', 'create_metadata_filename_from_args',
-           'create_bold_glob_from_args', 'run', 'get_func_bold_directory', 'process_bids_subject',
-           'run_model_for_subject']
+           'create_bold_glob_from_args', 'run', 'BIDSIndex', 'get_func_bold_directory', 'process_bids_subject',
+           'stimulus_sidecar_filename', 'read_stimulus_tsv', 'load_subject_data', 'compute_subject_mask',
+           'compute_group_mask', 'run_model_for_subject', 'run_model_for_subjects', 'config_hash',
+           'estimate_subject_memory', 'plan_workers', 'save_voxel_maps']
 
 # Cell
 #export
-import argparse
+import gzip
+import hashlib
+import io
 import os
+import time
+import warnings
 import subprocess
+from fnmatch import fnmatchcase
 import nibabel
-import numpy
-from glob import glob
-from .preprocessing import preprocess_bold_fmri, make_X_Y
-from .encoding import get_model_plus_scores
-from sklearn.linear_model import RidgeCV
+from .preprocessing import preprocess_bold_fmri, mask_voxels, make_X_Y, align_fmri
+from .encoding import get_model_plus_scores, get_group_model_plus_scores
+from .cache import ArrayCache
 import json
-import joblib
+from joblib import Parallel, delayed, effective_n_jobs, cpu_count
 import numpy as np
-from nilearn.masking import unmask
-from nilearn.image import new_img_like, concat_imgs
-from nilearn.masking import compute_epi_mask
+import pandas
+from scipy.sparse import csr_matrix, issparse
+from nilearn.masking import compute_epi_mask, intersect_masks
 from nibabel import save
 
 # Cell
@@ -88,13 +93,135 @@ def run(command, env={}):
 
 # Cell
 
-def get_func_bold_directory(subject_label, bids_dir, **kwargs):
+class BIDSIndex(object):
+    '''Index of the files of a BIDS dataset that is built in a single pass over its directories
+
+    Lookups of files are answered from the index instead of by globbing the file system,
+    and the BIDS entities of all files are available as a table.
+    Only the files in the root directory and in the sub-<label> directories are indexed.
+
+    Parameters
+
+        bids_dir : the path to the BIDS directory
+        subjects : None or list of subject labels, optional, only the directories of these subjects are indexed
+        cache_file : None or str, optional, JSON file in which the index is stored, it is reused
+                     as long as no indexed directory was modified since and rebuilt otherwise
+    '''
+    def __init__(self, bids_dir, subjects=None, cache_file=None):
+        self.bids_dir = os.path.abspath(bids_dir)
+        self.subjects_filter = None if subjects is None else sorted(subjects)
+        self.cache_file = cache_file
+        self._json = {}
+        if cache_file is None or not self._load():
+            self._build()
+            if cache_file is not None:
+                self._save()
+
+    def _build(self):
+        '''Lists all indexed directories and stores their files, subdirectories, and modification times'''
+        self.files, self.directories, self.mtimes = {}, {}, {}
+        pending = ['']
+        while pending:
+            directory = pending.pop()
+            path = os.path.join(self.bids_dir, directory)
+            files, directories = [], []
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    # like glob, files are all entries that are not directories, e.g. also broken symlinks
+                    (directories if entry.is_dir() else files).append(entry.name)
+            self.files[directory], self.directories[directory] = sorted(files), sorted(directories)
+            self.mtimes[directory] = os.stat(path).st_mtime_ns
+            for name in directories:
+                if directory == '' and not (name.startswith('sub-') and
+                                            (self.subjects_filter is None or name[4:] in self.subjects_filter)):
+                    continue
+                pending.append(os.path.join(directory, name))
+
+    def _load(self):
+        '''Loads the index from cache_file and returns whether it is up to date'''
+        try:
+            with open(self.cache_file, 'r') as fl:
+                cached = json.load(fl)
+            if cached['bids_dir'] != self.bids_dir or cached['subjects'] != self.subjects_filter:
+                return False
+            for directory, mtime in cached['mtimes'].items():
+                if os.stat(os.path.join(self.bids_dir, directory)).st_mtime_ns != mtime:
+                    return False
+        except (OSError, ValueError, KeyError):
+            return False
+        self.files, self.directories, self.mtimes = cached['files'], cached['directories'], cached['mtimes']
+        return True
+
+    def _save(self):
+        '''Writes the index to cache_file'''
+        tmp_fl = '{}.{}.tmp'.format(self.cache_file, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.cache_file)), exist_ok=True)
+            with open(tmp_fl, 'w') as fl:
+                json.dump({'bids_dir': self.bids_dir, 'subjects': self.subjects_filter, 'files': self.files,
+                           'directories': self.directories, 'mtimes': self.mtimes}, fl)
+            os.replace(tmp_fl, self.cache_file)
+        except OSError as error:
+            warnings.warn('Could not write BIDS index {}: {}'.format(self.cache_file, error))
+
+    def _relative(self, path):
+        '''Returns path relative to bids_dir, '' for bids_dir itself'''
+        path = os.path.relpath(os.path.abspath(path), self.bids_dir)
+        return '' if path == '.' else path
+
+    @property
+    def subjects(self):
+        '''Labels of the indexed subjects'''
+        return [name[4:] for name in self.directories[''] if name.startswith('sub-')
+                and (self.subjects_filter is None or name[4:] in self.subjects_filter)]
+
+    def exists(self, path):
+        '''Returns whether the file or directory path exists in the index'''
+        path = self._relative(path)
+        if path in self.files:
+            return True
+        directory, name = os.path.split(path)
+        return name in self.files.get(directory, ())
+
+    def glob(self, pattern):
+        '''Returns the sorted paths of the indexed files that match pattern, whose directory cannot contain wildcards'''
+        directory, name = os.path.split(pattern)
+        return [os.path.join(directory, fl) for fl in self.files.get(self._relative(directory), ())
+                if not fl.startswith('.') and fnmatchcase(fl, name)]
+
+    def read_json(self, path):
+        '''Returns the content of the JSON file path, which is read only once'''
+        path = os.path.abspath(path)
+        if path not in self._json:
+            with open(path, 'r') as fl:
+                self._json[path] = fl.read()
+        return json.loads(self._json[path])
+
+    @property
+    def table(self):
+        '''List of one dict per indexed file with its path, directory, BIDS entities, suffix, and extension'''
+        rows = []
+        for directory, files in self.files.items():
+            for fl in files:
+                stem, _, extension = fl.partition('.')
+                parts = stem.split('_')
+                row = dict(part.split('-', 1) for part in parts if '-' in part)
+                row.update({'path': os.path.join(self.bids_dir, directory, fl), 'directory': directory,
+                            'suffix': parts[-1] if '-' not in parts[-1] else None,
+                            'extension': '.' + extension if extension else ''})
+                rows.append(row)
+        return rows
+
+# Cell
+
+def get_func_bold_directory(subject_label, bids_dir, bids_index=None, **kwargs):
     '''Returns a path to the directory in which the bold files of the given subject reside
 
     Parameters
 
         subject_label : the BIDS subject label
         bids_dir : the path to the BIDS directory
+        bids_index : None or BIDSIndex of bids_dir, optional, which is used instead of the file system
         ses : session indicator, optional
         kwargs : additional arguments
 
@@ -111,14 +238,15 @@ def get_func_bold_directory(subject_label, bids_dir, **kwargs):
         raise ValueError('bids_dir argument is required.')
     bold_folder_name = os.path.join(*[term for term in bold_folder if term])
     # check if path exists, since func can be missing for derivatives
-    if not os.path.exists(bold_folder_name):
+    exists = os.path.exists if bids_index is None else bids_index.exists
+    if not exists(bold_folder_name):
         bold_folder_name = os.path.join(*[term for term in bold_folder[:-1] if term])
     return bold_folder_name
 
 # Cell
 
 def process_bids_subject(subject_label, bids_dir, ses=None, task=None, desc=None,
-                         recording=None, **kwargs):
+                         recording=None, bids_index=None, **kwargs):
     '''Localizes BOLD files and stimulus files for subject_label in BIDS folder structure
 
     Parameters
@@ -129,51 +257,52 @@ def process_bids_subject(subject_label, bids_dir, ses=None, task=None, desc=None
         task : task indicator, optional
         desc : description indicatr, optional
         recording : recording indicator, optional
+        bids_index : None or BIDSIndex of bids_dir, optional, which answers all file lookups
+                     and should be shared by all subjects of a dataset.
+                     If None, the root directory and the directory of the subject are indexed.
         kwargs : additional arguments
 
     Returns
         tuple of (list of bold files, path to task meta data,
         list of stimulus tsv files, list of stimulus json files)
     '''
-    bold_folder = get_func_bold_directory(subject_label, bids_dir,
+    if bids_index is None:
+        bids_index = BIDSIndex(bids_dir, subjects=[subject_label])
+    bold_folder = get_func_bold_directory(subject_label, bids_dir, bids_index=bids_index,
                                           ses=ses, task=task, desc=desc,
                                           recording=recording, **kwargs)
     bold_glob = create_bold_glob_from_args(subject_label,
                                            ses=ses, task=task, desc=desc,
                                            recording=recording, **kwargs)
-    bold_files = sorted(glob(os.path.join(bold_folder, bold_glob)))
+    bold_files = sorted(bids_index.glob(os.path.join(bold_folder, bold_glob)))
     stim_glob = create_stim_filename_from_args(subject_label,
                                                ses=ses, task=task, desc=desc,
                                                recording=recording, **kwargs)
 
     # subject specific metadata takes precedence over other metadata
-    try:
-        with open(os.path.join(bold_folder,
-                               create_metadata_filename_from_args(subject_label, task=task,
-                                                                  **kwargs)), 'r') as fl:
-            task_meta = json.load(fl)
-    except FileNotFoundError:
-        with open(os.path.join(bids_dir, 'task-{}_bold.json'.format(task)), 'r') as fl:
-            task_meta = json.load(fl)
+    task_meta_fl = os.path.join(bold_folder, create_metadata_filename_from_args(subject_label, task=task, **kwargs))
+    if not bids_index.exists(task_meta_fl):
+        task_meta_fl = os.path.join(bids_dir, 'task-{}_bold.json'.format(task))
+    task_meta = bids_index.read_json(task_meta_fl)
 
     # first check if subject specific stimulus files exist
-    stim_tsv = glob(os.path.join(bold_folder, '.'.join([stim_glob, 'tsv.gz'])))
+    stim_tsv = bids_index.glob(os.path.join(bold_folder, '.'.join([stim_glob, 'tsv.gz'])))
     if not stim_tsv:
         # try to get uncompressed tsv
-        stim_tsv = glob(os.path.join(bold_folder, '.'.join([stim_glob, 'tsv'])))
+        stim_tsv = bids_index.glob(os.path.join(bold_folder, '.'.join([stim_glob, 'tsv'])))
         if not stim_tsv:
             # try to get tsvs in root directory without subject specifier
             root_glob = '_'.join(stim_glob.split('_')[1:])
-            stim_tsv = glob(os.path.join(bids_dir,
-                                            '.'.join([root_glob, 'tsv.gz'])))
+            stim_tsv = bids_index.glob(os.path.join(bids_dir,
+                                                    '.'.join([root_glob, 'tsv.gz'])))
             if not stim_tsv:
                 # and check again in root for tsv
-                stim_tsv = glob(os.path.join(bids_dir,
-                                                '.'.join([root_glob, 'tsv'])))
+                stim_tsv = bids_index.glob(os.path.join(bids_dir,
+                                                        '.'.join([root_glob, 'tsv'])))
                 if not stim_tsv:
                     raise ValueError('No stimulus files found! [Mention naming scheme and location here]')
     stim_tsv = sorted(stim_tsv)
-    stim_json = sorted(glob(os.path.join(bold_folder, '.'.join([stim_glob, 'json']))))
+    stim_json = sorted(bids_index.glob(os.path.join(bold_folder, '.'.join([stim_glob, 'json']))))
     if not stim_json:
         raise ValueError('No stimulus json files found!'
                          'These should be in the same folder as the functional data.')
@@ -186,6 +315,307 @@ def process_bids_subject(subject_label, bids_dir, ses=None, task=None, desc=None
 
 # Cell
 
+def stimulus_sidecar_filename(tsv_fl, sidecar_dir):
+    '''Returns the filename of the binary sidecar of the stimulus file tsv_fl in sidecar_dir
+
+    Sidecars are kept outside of the BIDS dataset, where they would be reported by the bids-validator,
+    and are named after tsv_fl, whose BIDS entities identify it within the dataset.'''
+    for ext in ['.tsv.gz', '.tsv']:
+        if tsv_fl.endswith(ext):
+            return os.path.join(sidecar_dir, os.path.basename(tsv_fl)[:-len(ext)] + '.npy')
+    raise ValueError('Stimulus file {} is not a tsv or tsv.gz file.'.format(tsv_fl))
+
+def read_stimulus_tsv(tsv_fl, n_jobs=1, sidecar_dir=None, sparse=False):
+    '''Reads a stimulus from a tab-separated file without header, using its binary sidecar if it is up to date
+
+    Parameters
+
+        tsv_fl : path to the stimulus tsv or tsv.gz file
+        n_jobs : int, optional, default 1
+                 number of threads used to parse the file
+        sidecar_dir : None or path, optional, default None
+                      directory outside of the BIDS dataset, e.g. in derivatives, in which the stimulus is saved
+                      as a .npy file if there is no up to date one. A sidecar that is newer than tsv_fl
+                      is memory-mapped instead of parsing tsv_fl, so the conversion only has to be done once.
+        sparse : bool, optional, default False
+                 whether to return the stimulus as a scipy.sparse CSR matrix of shape (samples, features),
+                 e.g. for event or one-hot annotations that are mostly zeros
+
+    Returns
+        stimulus as an ndarray, with the same shape np.loadtxt would return, or a CSR matrix if sparse is True
+    '''
+    sidecar_fl = stimulus_sidecar_filename(tsv_fl, sidecar_dir) if sidecar_dir is not None else None
+    if (sidecar_fl is not None and os.path.exists(sidecar_fl)
+            and os.stat(sidecar_fl).st_mtime_ns >= os.stat(tsv_fl).st_mtime_ns):
+        stimulus = np.load(sidecar_fl, mmap_mode='r')
+        return csr_matrix(np.reshape(stimulus, (stimulus.shape[0], -1))) if sparse else stimulus
+    opener = gzip.open if tsv_fl.endswith('.gz') else open
+    with opener(tsv_fl, 'rb') as fl:
+        data = fl.read()
+    # split the file into chunks of whole lines that are parsed in parallel
+    n_chunks = effective_n_jobs(n_jobs)
+    bounds = [0]
+    for i in range(1, n_chunks):
+        split = data.find(b'\n', max(len(data) * i // n_chunks, bounds[-1]))
+        bounds.append(len(data) if split == -1 else split + 1)
+    bounds.append(len(data))
+    chunks = [data[start:stop] for start, stop in zip(bounds[:-1], bounds[1:]) if data[start:stop].strip()]
+    stimulus = Parallel(n_jobs=n_jobs, backend='threading')(
+        delayed(_parse_tsv)(chunk) for chunk in chunks)
+    stimulus = np.squeeze(np.concatenate(stimulus))
+    if sidecar_fl is not None:
+        # write to a temporary file first, so that a partially written sidecar is never read
+        tmp_fl = '{}.{}.tmp'.format(sidecar_fl, os.getpid())
+        try:
+            os.makedirs(sidecar_dir, exist_ok=True)
+            with open(tmp_fl, 'wb') as fl:
+                np.save(fl, stimulus)
+            os.replace(tmp_fl, sidecar_fl)
+        except OSError as error:
+            warnings.warn('Could not write stimulus sidecar {}: {}'.format(sidecar_fl, error))
+            if os.path.exists(tmp_fl):
+                os.remove(tmp_fl)
+    if sparse:
+        return csr_matrix(np.reshape(stimulus, (stimulus.shape[0], -1)))
+    return stimulus
+
+def _parse_tsv(data):
+    '''Parses the bytes of a tab-separated file without header into a 2D float array'''
+    return pandas.read_csv(io.BytesIO(data), sep='\t', header=None, comment='#',
+                           dtype=np.float64).to_numpy()
+
+# Cell
+
+def load_subject_data(subject_label, bids_dir, mask=None, bold_prep_kwargs=None,
+                      preprocess_kwargs=None, stimulus_cache=None, bold_cache=None,
+                      load_n_jobs=1, load_backend='threading', stim_read_kwargs=None,
+                      shared_stimulus=None, return_shared=False, return_rows=False, **kwargs):
+    '''Loads and preprocesses the BOLD files and stimuli of a single subject and temporally aligns them
+
+    Parameters
+
+        subject_label : the BIDS subject label
+        bids_dir : the path to the BIDS directory
+        mask : path to mask file or 'epi' if an epi mask should be computed from the first BOLD run
+        bold_prep_kwargs : None or dict containing the parameters for preprocessing the BOLD files
+                           everything that is accepted by nilearn's clean function is an acceptable parameter
+        preprocess_kwargs : None or dict containing the parameters for lagging and aligning fMRI and stimulus
+                            acceptable parameters are ones used by preprocessing.make_X_Y
+        stimulus_cache : None, str, or cache.ArrayCache, optional
+                         cache (or its directory) of lagged stimuli, which are reused for all subjects and runs
+                         with the same stimulus files, fMRI run lengths, and preprocess_kwargs
+                         instead of being loaded and lagged again
+        bold_cache : None, str, or cache.ArrayCache, optional
+                     cache (or its directory) of preprocessed BOLD data and epi masks,
+                     see preprocessing.preprocess_bold_fmri, which can be the same as stimulus_cache
+        load_n_jobs : int, optional, default 1
+                      number of runs that are loaded and preprocessed at the same time,
+                      which bounds the memory used for loading
+        load_backend : str, optional, default 'threading'
+                       joblib backend used to load runs in parallel, e.g. 'loky' for processes
+        stim_read_kwargs : None or dict containing the parameters for reading the stimulus files
+                           acceptable parameters are ones used by read_stimulus_tsv
+        shared_stimulus : None or tuple, optional, default None
+                          the shared stimulus returned for another subject with return_shared=True,
+                          which is used instead of loading and lagging the stimulus again.
+                          Raises a ValueError if the stimulus files of this subject have a different content,
+                          or the TR, fMRI run lengths, or preprocess_kwargs differ.
+        return_shared : bool, optional, default False
+                        Whether to additionally return the shared stimulus for other subjects
+        return_rows : bool, optional, default False
+                      Whether to additionally return the indices of the fMRI samples that are kept in each run,
+                      see preprocessing.make_X_Y
+        kwargs : additional BIDS specific arguments such as task, ses, desc, and recording
+
+    Returns
+        lagged stimulus, preprocessed fMRI data, mask, (shared stimulus if return_shared is True),
+        (list of the kept samples of each run if return_rows is True)
+    '''
+    if bold_prep_kwargs is None:
+        bold_prep_kwargs = {}
+    if preprocess_kwargs is None:
+        preprocess_kwargs = {}
+    if stim_read_kwargs is None:
+        stim_read_kwargs = {}
+
+    bold_files, task_meta, stim_tsv, stim_json = process_bids_subject(subject_label, bids_dir, **kwargs)
+
+    if bold_cache is not None and not isinstance(bold_cache, ArrayCache):
+        bold_cache = ArrayCache(bold_cache)
+
+    # compute epi mask if required
+    if mask == 'epi':
+        mask = _compute_epi_mask(bold_files[0], cache=bold_cache)
+    # the mask is loaded once and its voxels are used for all runs
+    voxels = mask_voxels(mask, nibabel.load(bold_files[0])) if mask is not None else None
+
+    # do BOLD preprocessing, runs are returned in order and at most load_n_jobs runs are loaded at once
+    load_runs = Parallel(n_jobs=load_n_jobs, backend=load_backend, pre_dispatch='n_jobs')
+    preprocessed_data = load_runs(
+        delayed(preprocess_bold_fmri)(bold_file, mask=voxels, cache=bold_cache, **bold_prep_kwargs)
+        for bold_file in bold_files)
+
+    # the lagged stimulus depends on the stimulus files, the fMRI run lengths, and the alignment parameters
+    stimulus_params = {'RepetitionTime': task_meta['RepetitionTime'],
+                       'fmri_samples': [run.shape[0] for run in preprocessed_data],
+                       'preprocess_kwargs': preprocess_kwargs,
+                       'sparse': stim_read_kwargs.get('sparse', False)}
+    stimulus_key = None
+    if shared_stimulus is not None or return_shared:
+        stimulus_key = ArrayCache.key(stim_tsv + stim_json, params=stimulus_params)
+
+    stimuli = rows = None
+    # lazy designs are cheap to construct and not cached
+    use_cache = stimulus_cache is not None and not preprocess_kwargs.get('lazy', False)
+    if shared_stimulus is not None:
+        shared_key, stimuli, rows = shared_stimulus
+        if stimulus_key != shared_key:
+            raise ValueError('The stimulus of subject {} differs from the shared stimulus, '
+                             'group models require the same stimulus for all subjects.'.format(subject_label))
+    elif use_cache:
+        if not isinstance(stimulus_cache, ArrayCache):
+            stimulus_cache = ArrayCache(stimulus_cache)
+        cache_key = stimulus_cache.key(stim_tsv + stim_json, params=stimulus_params)
+        cached = stimulus_cache.get(cache_key)
+        if cached is not None:
+            rows = np.split(cached['rows'], np.cumsum(cached['n_rows'])[:-1])
+            if 'X' in cached:
+                stimuli = cached['X']
+            else:
+                stimuli = csr_matrix((cached['X_data'], cached['X_indices'], cached['X_indptr']),
+                                     shape=tuple(cached['X_shape']))
+
+    if stimuli is not None:
+        preprocessed_data = align_fmri(preprocessed_data, rows, dtype=preprocess_kwargs.get('dtype'))
+    else:
+        # load stimulus
+        stimuli, stim_meta = zip(*load_runs(delayed(_load_stimulus)(tsv_fl, json_fl, **stim_read_kwargs)
+                                            for tsv_fl, json_fl in zip(stim_tsv, stim_json)))
+        stimuli = list(stimuli)
+
+        start_times = [st_meta['StartTime'] for st_meta in stim_meta]
+        stim_TR = 1. / stim_meta[0]['SamplingFrequency']
+
+        # temporally align stimulus and fmri data
+        stimuli, preprocessed_data, rows = make_X_Y(
+            stimuli, preprocessed_data, task_meta['RepetitionTime'],
+            stim_TR, start_times=start_times, return_rows=True, **preprocess_kwargs)
+        if use_cache:
+            arrays = {'rows': np.concatenate(rows), 'n_rows': np.array([run_rows.shape[0] for run_rows in rows])}
+            if issparse(stimuli):
+                # sparse stimuli are stored by their CSR arrays
+                arrays.update({'X_data': stimuli.data, 'X_indices': stimuli.indices, 'X_indptr': stimuli.indptr,
+                               'X_shape': np.array(stimuli.shape)})
+            else:
+                arrays['X'] = stimuli
+            stimulus_cache.put(cache_key, arrays)
+    results = (stimuli, preprocessed_data, mask)
+    if return_shared:
+        results += ((stimulus_key, stimuli, rows),)
+    if return_rows:
+        results += (rows,)
+    return results
+
+def _load_stimulus(tsv_fl, json_fl, **kwargs):
+    '''Returns the stimulus in tsv_fl and its metadata in json_fl'''
+    with open(json_fl, 'r') as fl:
+        stim_meta = json.load(fl)
+    return read_stimulus_tsv(tsv_fl, **kwargs), stim_meta
+
+def _compute_epi_mask(bold_file, cache=None):
+    '''Computes the epi mask of bold_file, which is stored in cache if given'''
+    if cache is None:
+        return compute_epi_mask(bold_file)
+    key = cache.key([bold_file], params={'mask': 'epi'}, hash_files=False)
+    cached = cache.get(key)
+    if cached is None:
+        mask = compute_epi_mask(bold_file)
+        cache.put(key, {'mask': np.asarray(mask.dataobj), 'affine': mask.affine})
+        return mask
+    return nibabel.Nifti1Image(np.array(cached['mask']), np.array(cached['affine']))
+
+# Cell
+
+def compute_subject_mask(bold_file, mask_file):
+    '''Computes the epi mask of bold_file and saves it to mask_file, unless mask_file already contains it
+
+    The mask is saved together with a JSON sidecar that records the BOLD file it was computed from,
+    and is reused as long as this file did not change. A mask_file without sidecar, e.g. one that
+    was provided by the user, is always reused.
+
+    Parameters
+
+        bold_file : path to the BOLD NifTI from which the mask is computed
+        mask_file : path to the .nii.gz file in which the mask is stored
+
+    Returns
+        mask_file
+    '''
+    provenance = _mask_provenance([bold_file], 'nilearn.masking.compute_epi_mask')
+    if _reuse_mask(mask_file, provenance):
+        return mask_file
+    _save_mask(compute_epi_mask(bold_file), mask_file, provenance)
+    return mask_file
+
+def compute_group_mask(bold_files, mask_file, threshold=1., n_jobs=1):
+    '''Computes a group mask from the epi masks of the bold_files of all subjects and saves it to mask_file
+
+    The epi masks of the subjects are computed in parallel and saved next to mask_file
+    as sub-<label>_mask.nii.gz, so that they are reused like the group mask (see compute_subject_mask).
+
+    Parameters
+
+        bold_files : dict of subject label and path to the BOLD NifTI from which the subject mask is computed
+        mask_file : path to the .nii.gz file in which the group mask is stored
+        threshold : float, optional, default 1.
+                    fraction of subject masks that need to contain a voxel so that it is in the group mask,
+                    1. gives the intersection and 0. the union of the subject masks
+        n_jobs : int, optional, default 1
+                 number of subject masks that are computed in parallel
+
+    Returns
+        mask_file
+    '''
+    provenance = _mask_provenance([bold_files[subject] for subject in sorted(bold_files)],
+                                  'nilearn.masking.intersect_masks', threshold=threshold)
+    if _reuse_mask(mask_file, provenance):
+        return mask_file
+    mask_dir = os.path.dirname(mask_file)
+    subject_masks = Parallel(n_jobs=n_jobs)(
+        delayed(compute_subject_mask)(bold_files[subject],
+                                      os.path.join(mask_dir, 'sub-{}_mask.nii.gz'.format(subject)))
+        for subject in sorted(bold_files))
+    _save_mask(intersect_masks(subject_masks, threshold=threshold), mask_file, provenance)
+    return mask_file
+
+def _mask_provenance(bold_files, method, **parameters):
+    '''Returns the description of a mask computed by method from bold_files that is saved with the mask'''
+    sources = []
+    for bold_file in bold_files:
+        stat = os.stat(bold_file)
+        sources.append({'path': os.path.abspath(bold_file), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns})
+    return {'Sources': sources, 'Method': method, 'Parameters': parameters}
+
+def _reuse_mask(mask_file, provenance):
+    '''Returns whether mask_file exists and was provided by the user or computed as described by provenance'''
+    if not os.path.exists(mask_file):
+        return False
+    sidecar = mask_file.replace('.nii.gz', '.json')
+    if not os.path.exists(sidecar):
+        return True
+    with open(sidecar, 'r') as fl:
+        saved = json.load(fl)
+    return all(saved.get(key) == value for key, value in provenance.items())
+
+def _save_mask(mask, mask_file, provenance):
+    '''Saves the mask image and its provenance as JSON sidecar'''
+    os.makedirs(os.path.dirname(os.path.abspath(mask_file)), exist_ok=True)
+    save(mask, mask_file)
+    with open(mask_file.replace('.nii.gz', '.json'), 'w') as fl:
+        json.dump(dict(provenance, Type='Brain', Created=time.strftime('%Y-%m-%dT%H:%M:%S')), fl, indent=2)
+
+# Cell
+
 def run_model_for_subject(subject_label, bids_dir, mask=None, bold_prep_kwargs=None,
                           preprocess_kwargs=None, estimator=None, encoding_kwargs=None,
                           **kwargs):
@@ -201,53 +631,207 @@ def run_model_for_subject(subject_label, bids_dir, mask=None, bold_prep_kwargs=N
         preprocess_kwargs : None or dict containing the parameters for lagging and aligning fMRI and stimulus
                             acceptable parameters are ones used by preprocessing.make_X_Y
         estimator : None or sklearn-like estimator to use as an encoding model
-                    default uses RidgeCV with individual alpha per target when possible
+                    default uses SVDRidgeCV with individual alpha per target
         encoding_kwargs : None or dict containing the parameters for evaluating the encoding model
-                          Valid parameters are the ones accepted by encoding.get_model_plus_scores
+                          Valid parameters are the ones accepted by encoding.get_model_plus_scores,
+                          except groups, which are the runs of the samples, so that folds leave out whole runs
+                          unless a cross-validation object is given as cv
 
-        kwargs : additional BIDS specific arguments such as task, ses, desc, and recording
+        kwargs : additional BIDS specific arguments such as task, ses, desc, and recording,
+                 and stimulus_cache, bold_cache, load_n_jobs, and load_backend (see load_subject_data)
 
     Returns
-        list of Ridge regressions, scores per voxel per fold
+        list of Ridge regressions, scores per voxel per fold, (alphas per voxel per fold if return_alphas is True), mask
 
     '''
-    if bold_prep_kwargs is None:
-        bold_prep_kwargs = {}
     if encoding_kwargs is None:
         encoding_kwargs = {}
-    if preprocess_kwargs is None:
-        preprocess_kwargs = {}
 
+    stimuli, preprocessed_data, mask, rows = load_subject_data(
+        subject_label, bids_dir, mask=mask, bold_prep_kwargs=bold_prep_kwargs,
+        preprocess_kwargs=preprocess_kwargs, return_rows=True, **kwargs)
+    # compute ridge and scores (and alphas if return_alphas is given) for folds
+    results = get_model_plus_scores(stimuli, preprocessed_data,
+                                    estimator=estimator, groups=_run_groups(rows),
+                                    **encoding_kwargs)
+    return results + (mask,)
 
-    bold_files, task_meta, stim_tsv, stim_json = process_bids_subject(subject_label, bids_dir, **kwargs)
+# Cell
 
-    # compute epi mask if required
-    if mask == 'epi':
-        mask = compute_epi_mask(bold_files[0])
+def run_model_for_subjects(subject_labels, bids_dir, masks=None, bold_prep_kwargs=None,
+                           preprocess_kwargs=None, encoding_kwargs=None, **kwargs):
+    '''Runs voxel-wise encoding models for several subjects that were presented with the same stimulus
 
-    # do BOLD preprocessing
-    preprocessed_data = []
-    for bold_file in bold_files:
-        preprocessed_data.append(preprocess_bold_fmri(bold_file, mask=mask, **bold_prep_kwargs))
-
-    # load stimulus
-    stim_meta = []
-    stimuli = []
-    for tsv_fl, json_fl in zip(stim_tsv, stim_json):
-        with open(json_fl, 'r') as fl:
-            stim_meta.append(json.load(fl))
-        stimuli.append(np.loadtxt(tsv_fl, delimiter='\t'))
-
-    start_times = [st_meta['StartTime'] for st_meta in stim_meta]
-    stim_TR = 1. / stim_meta[0]['SamplingFrequency']
-
-    # temporally align stimulus and fmri data
-    stimuli, preprocessed_data = make_X_Y(
-        stimuli, preprocessed_data, task_meta['RepetitionTime'],
-        stim_TR, start_times=start_times, **preprocess_kwargs)
-
-    # compute ridge and scores for folds
-    models, scores = get_model_plus_scores(stimuli, preprocessed_data,
-                                           estimator=estimator,
-                                           **encoding_kwargs)
-    return models, scores, mask
\ No newline at end of file
+    The lagged stimulus is built once and decomposed once per fold for all subjects,
+    see encoding.get_group_model_plus_scores.
+
+    Parameters
+
+        subject_labels : list of BIDS subject labels
+        bids_dir : the path to the BIDS directory
+        masks : None, a single mask, or a list with one mask per subject,
+                where each mask is a path to a mask file or 'epi' if an epi mask should be computed from the first BOLD run
+        bold_prep_kwargs : None or dict containing the parameters for preprocessing the BOLD files
+                           everything that is accepted by nilearn's clean function is an acceptable parameter
+        preprocess_kwargs : None or dict containing the parameters for lagging and aligning fMRI and stimulus
+                            acceptable parameters are ones used by preprocessing.make_X_Y
+        encoding_kwargs : None or dict containing the parameters for evaluating the encoding models
+                          Valid parameters are the ones accepted by encoding.get_group_model_plus_scores,
+                          except groups, which are the runs of the samples as in run_model_for_subject
+
+        kwargs : additional BIDS specific arguments such as task, ses, desc, and recording,
+                 and stimulus_cache, bold_cache, load_n_jobs, and load_backend (see load_subject_data)
+
+    Returns
+        list of (list of Ridge regressions, scores per voxel per fold, (alphas per voxel per fold), mask) for each subject
+
+    '''
+    if encoding_kwargs is None:
+        encoding_kwargs = {}
+    if not isinstance(masks, (list, tuple)):
+        masks = [masks] * len(subject_labels)
+
+    shared_stimulus = None
+    subject_data = []
+    subject_masks = []
+    for subject_label, mask in zip(subject_labels, masks):
+        # the stimulus is only loaded and lagged for the first subject, the stimulus files of all others
+        # are compared to it by their content without building their lagged stimulus
+        _, preprocessed_data, mask, shared_stimulus = load_subject_data(
+            subject_label, bids_dir, mask=mask, bold_prep_kwargs=bold_prep_kwargs,
+            preprocess_kwargs=preprocess_kwargs, shared_stimulus=shared_stimulus, return_shared=True, **kwargs)
+        subject_data.append(preprocessed_data)
+        subject_masks.append(mask)
+
+    results = get_group_model_plus_scores(shared_stimulus[1], subject_data, groups=_run_groups(shared_stimulus[2]),
+                                          **encoding_kwargs)
+    return [result + (mask,) for result, mask in zip(results, subject_masks)]
+
+def _run_groups(rows):
+    '''Returns the run of every sample given the kept samples of each run, e.g. as groups of get_model_plus_scores'''
+    return np.concatenate([np.full(run_rows.shape[0], run) for run, run_rows in enumerate(rows)])
+
+# Cell
+
+def config_hash(*configs):
+    '''Returns a hash of configs, which identifies the outputs that were computed with them
+
+    Parameters
+
+        configs : JSON serializable objects, e.g. dicts of the preprocessing and encoding parameters,
+                  other objects are represented by their string representation
+
+    Returns
+        hexadecimal string of the SHA-1 hash of the JSON representation of configs
+    '''
+    return hashlib.sha1(json.dumps(configs, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def estimate_subject_memory(bold_files, mask=None, copies=3, dtype=np.float32):
+    '''Estimates the memory in bytes that is needed for the BOLD data of a subject when fitting its models
+
+    The estimate only reads the headers of the NifTIs and counts copies arrays of the masked data in dtype,
+    for the loaded, preprocessed, and cross-validation data.
+
+    Parameters
+
+        bold_files : list of paths to the BOLD NifTIs of the subject
+        mask : None or path to a mask file, if None all voxels are counted
+        copies : int, optional, default 3
+                 number of copies of the BOLD data that are held in memory at the same time
+        dtype : numpy dtype, optional, default np.float32
+                dtype of the preprocessed BOLD data, see preprocess_bold_fmri
+
+    Returns
+        estimated memory in bytes
+    '''
+    shapes = [nibabel.load(bold_file).shape for bold_file in bold_files]
+    if mask is None:
+        n_voxels = int(np.prod(shapes[0][:3]))
+    else:
+        n_voxels = int(np.count_nonzero(np.asanyarray(nibabel.load(mask).dataobj)))
+    n_samples = sum(shape[3] if len(shape) > 3 else 1 for shape in shapes)
+    return copies * n_voxels * n_samples * np.dtype(dtype).itemsize
+
+def plan_workers(memory_estimates, n_jobs=1, memory_budget=None):
+    '''Returns how many subjects are processed in parallel and how many BLAS threads each of them uses
+
+    The number of parallel subjects is limited by n_jobs, the number of subjects, and the number of subjects
+    with the largest memory estimate that fit into memory_budget. The CPUs are divided evenly between them.
+
+    Parameters
+
+        memory_estimates : list of the estimated memory in bytes of each subject (see estimate_subject_memory)
+        n_jobs : int, optional, default 1
+                 maximum number of subjects that are processed in parallel, -1 uses one per CPU
+        memory_budget : None or memory in bytes that all parallel subjects together may use
+
+    Returns
+        tuple of the number of parallel subjects and the number of threads per subject
+    '''
+    n_workers = max(1, min(effective_n_jobs(n_jobs), len(memory_estimates)))
+    if memory_budget is not None and memory_estimates:
+        n_workers = max(1, min(n_workers, int(memory_budget // max(max(memory_estimates), 1))))
+    return n_workers, max(1, cpu_count() // n_workers)
+
+# Cell
+
+def save_voxel_maps(maps, mask, filename, compresslevel=1, n_jobs=1, chunk_size=2**24, voxels=None):
+    '''Saves maps of the voxels in mask, e.g. the scores or alphas of all folds, as a 4D float32 NifTI
+
+    All maps are scattered at once into a single preallocated volume instead of unmasking each map separately.
+    The volume is written uncompressed if filename ends with .nii and gzip-compressed if it ends with .nii.gz.
+    Compressed files are written from the header followed by chunks of the volume, without a copy of the whole file
+    in memory, and with n_jobs threads the chunks are compressed in parallel and written as consecutive gzip members.
+
+    Parameters
+
+        maps : ndarray of shape (voxels,) or (voxels, maps) of the voxels in mask in the order of the mask
+        mask : path to or NifTI image of the mask, whose non-zero voxels are filled with maps
+        filename : path of the .nii or .nii.gz file
+        compresslevel : int, optional, default 1
+                        gzip compression level, 1 is fastest and 9 gives the smallest files
+        n_jobs : int, optional, default 1
+                 number of threads that compress chunks of the file in parallel
+        chunk_size : int, optional, default 16 MB
+                     size in bytes of the chunks of the volume that are compressed one at a time
+        voxels : None or boolean ndarray, optional, default None
+                 the voxels of mask as returned by preprocessing.mask_voxels, e.g. computed once for several maps,
+                 None computes them from mask
+
+    Returns
+        filename
+    '''
+    if not hasattr(mask, 'dataobj'):
+        mask = nibabel.load(mask)
+    if voxels is None:
+        voxels = mask_voxels(mask)
+    maps = np.asarray(maps, dtype=np.float32).reshape((int(voxels.sum()), -1))
+    # NifTIs store data in Fortran order, so this volume is written without another copy
+    volume = np.zeros(voxels.shape + maps.shape[1:], dtype=np.float32, order='F')
+    volume[voxels] = maps
+    img = nibabel.Nifti1Image(volume, mask.affine)
+    if not filename.endswith('.gz'):
+        img.to_filename(filename)
+        return filename
+    # the data is written unscaled, as img.to_filename does
+    img.header.set_slope_inter(1, 0)
+    header = io.BytesIO()
+    img.header.write_to(header)
+    header.write(b'\x00' * (int(img.header.get_data_offset()) - header.tell()))
+    # a byte view of the volume in its Fortran memory order, which slices into chunks without copying
+    data = memoryview(volume.T).cast('B')
+    if effective_n_jobs(n_jobs) == 1:
+        with gzip.GzipFile(filename, 'wb', compresslevel=compresslevel) as fl:
+            fl.write(header.getvalue())
+            for start in range(0, len(data), chunk_size):
+                fl.write(data[start:start + chunk_size])
+        return filename
+    # zlib releases the GIL, so the chunks are compressed by threads
+    members = Parallel(n_jobs=n_jobs, backend='threading')(
+        delayed(gzip.compress)(chunk, compresslevel)
+        for chunk in [header.getvalue()] + [data[start:start + chunk_size]
+                                            for start in range(0, len(data), chunk_size)])
+    with open(filename, 'wb') as fl:
+        for member in members:
+            fl.write(member)
+    return filename